@@ -0,0 +1,357 @@
+"""
+Drive the log consumer with generated messages through a fake pika
+connection, and channel, and measure ingest throughput, message handling,
+and acknowledgement latency, and memory. The consumer runs its real setup,
+commit, and shutdown paths; only the broker is simulated
+
+Usage: python -m benchmarks.ingest [--messages N] [--size BYTES]
+    [--stages N] [--rate N] [--durability POLICY] [--listeners N]
+    [--output FILE] [--compare FILE]
+"""
+import argparse
+import collections
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import py
+
+from dockci.logserve.consumer import Consumer
+from dockci.logserve.notify import Notifier
+from dockci.logserve.storage import StageWriterPool, DURABILITY_CHOICES
+
+from .results import add_arguments, latency_stats, peak_rss, report
+
+
+Deliver = collections.namedtuple('Deliver', ['routing_key', 'delivery_tag'])
+Properties = collections.namedtuple('Properties', ['timestamp'])
+Method = collections.namedtuple('Method', ['message_count'])
+Frame = collections.namedtuple('Frame', ['method'])
+
+STAGES_PER_JOB = 10
+
+
+class FakeIOLoop(object):
+    """
+    Stands in for pika's IOLoop. Delivers the generated messages at the
+    target rate (or as fast as the consumer takes them), runs timers when
+    they're due, and stops the consumer once every message is delivered
+    """
+    def __init__(self, messages, rate=0):
+        self.messages = messages
+        self.rate = rate
+        self.connection = None
+        self.consumer = None
+        self.delivered = 0
+        self.call_seconds = []
+        self.ack_seconds = []
+        self.started = None
+        self.finished = None
+        self._delivered_at = []
+        self._acked = 0
+        self._timers = []
+        self._seq = itertools.count()
+        self._running = False
+
+    def add_timeout(self, delay, callback):
+        """ Run ``callback`` after ``delay`` seconds """
+        timer = [time.monotonic() + delay, next(self._seq), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        """ Cancel a timer """
+        timer[2] = None
+
+    def acked(self, delivery_tag):
+        """ Record acknowledgement of every delivery up to a tag """
+        now = time.perf_counter()
+        for idx in range(self._acked, delivery_tag):
+            self.ack_seconds.append(now - self._delivered_at[idx])
+        self._acked = max(self._acked, delivery_tag)
+
+    def _run_timers(self):
+        """ Run timers that are due. Returns when the next one is """
+        while self._timers and self._timers[0][0] <= time.monotonic():
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                callback()
+        return self._timers[0][0] if self._timers else None
+
+    def _deliver(self, channel):
+        """ Deliver the next message """
+        routing_key, body = self.messages[self.delivered]
+        self.delivered += 1
+        start = time.perf_counter()
+        self._delivered_at.append(start)
+        channel.on_message(
+            channel, Deliver(routing_key, self.delivered),
+            Properties(int(time.time())), body,
+        )
+        self.call_seconds.append(time.perf_counter() - start)
+
+    def start(self):
+        """ Run until the consumer has stopped """
+        self._running = True
+        self.connection.open()
+        self.started = time.perf_counter()
+        while self._running:
+            next_timer = self._run_timers()
+            channel = self.connection.channel_object
+            if self.delivered < len(self.messages):
+                due = self.started + self.delivered / self.rate \
+                    if self.rate else 0
+                wait = due - time.perf_counter()
+                if wait <= 0:
+                    self._deliver(channel)
+                    continue
+                if next_timer is not None:
+                    wait = min(wait, next_timer - time.monotonic())
+                time.sleep(max(wait, 0))
+
+            elif self.finished is None:
+                self.finished = time.perf_counter()
+                self.consumer.start_stopping()
+
+            elif next_timer is not None:
+                time.sleep(max(next_timer - time.monotonic(), 0))
+
+            else:
+                raise RuntimeError("Consumer didn't stop")
+
+    def stop(self):
+        """ Stop running """
+        self._running = False
+
+
+class FakeChannel(object):
+    """ Stands in for a pika channel. RPCs complete at once """
+    def __init__(self, connection):
+        self.connection = connection
+        self.on_message = None
+        self._on_close = []
+
+    def add_on_close_callback(self, callback):
+        """ Call ``callback`` when the channel closes """
+        self._on_close.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        """ The broker never cancels """
+
+    def exchange_declare(self, callback, *_, **__):
+        """ Declare, or bind anything """
+        callback(None)
+
+    exchange_bind = queue_bind = exchange_declare
+
+    def basic_qos(self, callback, **_):
+        """ Set prefetch """
+        callback(None)
+
+    def queue_declare(self, callback, *_, **__):
+        """ Declare the queue, with the messages still to be delivered """
+        ioloop = self.connection.ioloop
+        callback(Frame(Method(len(ioloop.messages) - ioloop.delivered)))
+
+    def basic_consume(self, callback, *_, **__):
+        """ Start delivering to ``callback`` """
+        self.on_message = callback
+        return 'benchmark'
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        """ Acknowledge deliveries """
+        assert multiple
+        self.connection.ioloop.acked(delivery_tag)
+
+    def basic_cancel(self, callback, _):
+        """ Stop delivering """
+        self.on_message = None
+        callback(None)
+
+    def close(self):
+        """ Close the channel, then the connection, like the broker does
+        once the consumer is cancelled """
+        for callback in self._on_close:
+            callback(1, 200, 'Normal shutdown')
+
+
+class FakeConnection(object):
+    """ Stands in for a pika connection, on a ``FakeIOLoop`` """
+    def __init__(self, ioloop, _, on_open_callback, **__):
+        self.ioloop = ioloop
+        self.channel_object = None
+        self._on_open = on_open_callback
+        self._on_close = []
+        ioloop.connection = self
+
+    def open(self):
+        """ Open the connection """
+        self._on_open(self)
+
+    def add_on_close_callback(self, callback):
+        """ Call ``callback`` when the connection closes """
+        self._on_close.append(callback)
+
+    def add_timeout(self, delay, callback):
+        """ Run ``callback`` after ``delay`` seconds """
+        return self.ioloop.add_timeout(delay, callback)
+
+    def channel(self, on_open_callback):
+        """ Open a channel """
+        self.channel_object = FakeChannel(self)
+        on_open_callback(self.channel_object)
+
+    def close(self):
+        """ Close the connection """
+        for callback in self._on_close:
+            callback(self, 200, 'Normal shutdown')
+
+
+def generate_messages(count, size, stages, finalize, seed=0):
+    """ Content messages of ``size`` bytes for random stages, and a final
+    status message for each job if ``finalize`` """
+    rand = random.Random(seed)
+    keys = [
+        'dockci.bench.job%d.stage%d.content' % (
+            idx // STAGES_PER_JOB, idx % STAGES_PER_JOB,
+        )
+        for idx in range(stages)
+    ]
+    bodies = [
+        (''.join(
+            rand.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(size - 1)
+        ) + '\n').encode()
+        for _ in range(64)
+    ]
+    messages = [
+        (rand.choice(keys), rand.choice(bodies)) for _ in range(count)
+    ]
+    if finalize:
+        jobs = sorted(set(key.split('.')[2] for key in keys))
+        messages.extend(
+            ('dockci.bench.%s.status' % job, b'{"state": "success"}')
+            for job in jobs
+        )
+    return messages
+
+
+def drain_listeners(path, count, stop):
+    """ Bind ``count`` notify listener sockets in ``path``, and read them
+    until ``stop`` is set, like HTTP workers would """
+    listeners = []
+    for idx in range(count):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(os.path.join(path, 'bench-%d.sock' % idx))
+        sock.settimeout(0.1)
+        listeners.append(sock)
+
+    def drain(sock):
+        """ Read, and drop events """
+        while not stop.is_set():
+            try:
+                sock.recv(65536)
+            except socket.timeout:
+                pass
+        sock.close()
+
+    threads = [
+        threading.Thread(target=drain, args=(sock,), daemon=True)
+        for sock in listeners
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main():
+    """ Run the benchmark, and report the results """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200000,
+                        help="Number of content messages")
+    parser.add_argument('--size', type=int, default=120,
+                        help="Bytes in each message")
+    parser.add_argument('--stages', type=int, default=50,
+                        help="Stages the messages are spread over")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Messages per second (0 for unlimited)")
+    parser.add_argument('--durability', choices=DURABILITY_CHOICES,
+                        default='flush')
+    parser.add_argument('--commit-size', type=int, default=128)
+    parser.add_argument('--commit-interval', type=float, default=0.1)
+    parser.add_argument('--max-handles', type=int, default=64)
+    parser.add_argument('--buffer-size', type=int, default=64 * 1024)
+    parser.add_argument('--listeners', type=int, default=0,
+                        help="Notify listeners to publish stage events to")
+    parser.add_argument('--no-finalize', action='store_true',
+                        help="Don't finalize the stages at the end")
+    parser.add_argument('--data',
+                        help="Directory to make the temporary data "
+                             "directory in")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    messages = generate_messages(
+        args.messages, args.size, args.stages, not args.no_finalize,
+    )
+
+    # Always a new directory, so runs never append to old logs, or leave
+    # theirs behind
+    data_path = tempfile.mkdtemp(dir=args.data)
+    stop_listeners = threading.Event()
+    notifier = None
+    if args.listeners:
+        notify_path = os.path.join(data_path, '.notify')
+        os.makedirs(notify_path, exist_ok=True)
+        drain_listeners(notify_path, args.listeners, stop_listeners)
+        notifier = Notifier(notify_path)
+
+    ioloop = FakeIOLoop(messages, args.rate)
+    consumer = Consumer(
+        None, logger,
+        StageWriterPool(
+            py.path.local(data_path),
+            max_handles=args.max_handles,
+            buffer_size=args.buffer_size,
+            durability=args.durability,
+            notifier=notifier,
+        ),
+        commit_size=args.commit_size,
+        commit_interval=args.commit_interval,
+        connection_class=functools.partial(FakeConnection, ioloop),
+    )
+    ioloop.consumer = consumer
+
+    try:
+        consumer.run()
+        consumer.finish_stopping()
+        elapsed = time.perf_counter() - ioloop.started
+
+    finally:
+        stop_listeners.set()
+        shutil.rmtree(data_path)
+
+    content_bytes = args.messages * args.size
+    results = {
+        'messages_per_second': len(messages) / elapsed,
+        'mb_per_second': content_bytes / elapsed / 1024 / 1024,
+        'elapsed_seconds': elapsed,
+        'peak_rss_mb': peak_rss() / 1024.0 / 1024,
+    }
+    results.update(latency_stats('message', ioloop.call_seconds))
+    results.update(latency_stats('ack', ioloop.ack_seconds))
+    report(args, 'ingest', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
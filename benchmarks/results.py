@@ -0,0 +1,172 @@
+"""
+Measurements, and machine readable results shared by the benchmarks. Results
+are saved as JSON with the revision they were taken at, so that runs from
+different commits can be compared with ``--compare``
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def percentile(values, pct):
+    """ The ``pct`` percentile of ``values``, by nearest rank """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def latency_stats(prefix, seconds):
+    """ p50, p99, and max of latencies in seconds, as milliseconds """
+    stats = {}
+    for name, value in (
+            ('p50', percentile(seconds, 50)),
+            ('p99', percentile(seconds, 99)),
+            ('max', max(seconds) if seconds else None),
+    ):
+        stats['%s_%s_ms' % (prefix, name)] = (
+            None if value is None else value * 1000
+        )
+    return stats
+
+
+def peak_rss():
+    """ Peak resident set size of this process, in bytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def peak_rss_of(pid):
+    """ Peak resident set size of another process in bytes, or ``None`` if
+    it can't be read """
+    try:
+        with open('/proc/%d/status' % pid) as handle:
+            for line in handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _children(pid):
+    """ Pids of the child processes of a process """
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as handle:
+                # The process name is in brackets, and may have spaces
+                fields = handle.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+
+def peak_rss_of_tree(pid):
+    """ Sum of the peak resident set sizes of a process, and its
+    descendants, in bytes, or ``None`` if they can't be read """
+    total = None
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        rss = peak_rss_of(pid)
+        if rss is not None:
+            total = (total or 0) + rss
+        try:
+            pending.extend(_children(pid))
+        except OSError:
+            pass
+    return total
+
+
+def revision():
+    """ Git revision of the working tree, marked if it has changes """
+    def git(*args):
+        """ Output of a git command, in the repo root """
+        return subprocess.check_output(
+            ('git',) + args, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+
+    try:
+        rev = git('rev-parse', '--short', 'HEAD')
+        if git('status', '--porcelain', '--untracked-files=no'):
+            rev += '-dirty'
+        return rev
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_arguments(parser):
+    """ Add the args for saving, and comparing results """
+    parser.add_argument('--output', help="Save results as JSON to this file")
+    parser.add_argument('--compare',
+                        help="Compare with results saved by an earlier run")
+
+
+def report(args, benchmark, params, results):
+    """ Print results, then save, and compare them as ``args`` ask """
+    print('%-28s %14s' % ('result', benchmark))
+    for name, value in sorted(results.items()):
+        print('%-28s %14s' % (name, _format(value)))
+
+    params = dict(
+        (name, value) for name, value in params.items()
+        if name not in ('output', 'compare')
+    )
+    document = {
+        'benchmark': benchmark,
+        'revision': revision(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(document, handle, indent=2, sort_keys=True)
+        print('Saved results to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(json.load(handle), document)
+
+
+def compare(previous, current):
+    """ Print each result next to the same result from an earlier run """
+    if previous.get('benchmark') != current['benchmark']:
+        raise ValueError("Can't compare %s results with %s results" % (
+            previous.get('benchmark'), current['benchmark'],
+        ))
+    if previous.get('params') != current['params']:
+        print('Warning: params differ from the earlier run')
+
+    print('%-28s %14s %14s %9s' % (
+        'result', previous.get('revision'), current['revision'], 'change',
+    ))
+    for name, value in sorted(current['results'].items()):
+        before = previous.get('results', {}).get(name)
+        change = '-'
+        if before and value is not None:
+            change = '%+.1f%%' % ((value - before) * 100.0 / before)
+        print('%-28s %14s %14s %9s' % (
+            name, _format(before), _format(value), change,
+        ))
+
+
+def _format(value):
+    """ A result for a table """
+    if isinstance(value, float):
+        return '%.3f' % value
+    return '-' if value is None else str(value)
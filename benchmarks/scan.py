@@ -0,0 +1,209 @@
+"""
+Compare block based line scanning against the byte at a time seekers it
+replaced, on a generated multi-hundred-MB log
+
+Usage: python -m benchmarks.scan [--size MB] [--path FILE] [--no-legacy]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from dockci.logserve.scan import (
+    find_nth, BLOCK_SIZE, skip_lines, skip_lines_back,
+)
+
+
+def legacy_seeker_lines(handle, seek):
+    """ ``_seeker_lines`` as it was before block scanning """
+    if seek >= 0:
+        for _ in range(seek):
+            legacy_seeker_lines_one_ahead(handle)
+    else:
+        handle.seek(0, 2)
+        seek = seek * -1
+        for idx in range(seek):
+            current_pos = legacy_seeker_lines_one_back(handle)
+
+            if current_pos == 0:
+                return
+
+            # unless last iter, seek back 1 for the new line
+            if idx + 1 < seek:
+                handle.seek(current_pos - 1)
+
+
+def legacy_seeker_lines_one_ahead(handle):
+    """ ``_seeker_lines_one_ahead`` as it was before block scanning """
+    while handle.read(1) not in ('\n', b'\n', None, '', b''):
+        pass
+
+
+def legacy_seeker_lines_one_back(handle):
+    """ ``_seeker_lines_one_back`` as it was before block scanning """
+    first = True
+    current_pos = handle.tell()
+    while first or handle.read(1) not in ('\n', b'\n', None, '', b''):
+        first = False
+        current_pos -= 1
+
+        if current_pos < 0:
+            handle.seek(0)
+            return 0
+
+        handle.seek(current_pos)
+
+    return current_pos + 1  # add 1 for the read
+
+
+def legacy_reader_lines(handle, count=None):
+    """ ``_reader_lines`` as it was before block scanning """
+    remain = count
+    while remain is None or remain > 0:
+        data = handle.readline()
+
+        if remain is not None:
+            remain -= 1
+
+        yield data
+
+        search_char = b'\n' if isinstance(data, bytes) else '\n'
+        if search_char not in data:
+            return
+
+
+def read_lines(handle, count=None, block_size=BLOCK_SIZE):
+    """ Block based replacement for ``legacy_reader_lines``. Reads ``count``
+    lines in blocks of up to ``block_size``, leaving binary handles just
+    after the data read. It's kept here, rather than with the scanners,
+    because the log endpoints find the end of a line count with
+    ``skip_lines``, and stream the byte range instead """
+    if count is None:
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                return
+            yield block
+
+    while count > 0:
+        block = handle.read(block_size)
+        if not block:
+            return
+
+        newline = b'\n' if isinstance(block, bytes) else '\n'
+        found = block.count(newline)
+        if found < count:
+            count -= found
+            yield block
+            continue
+
+        idx = find_nth(block, newline, count) + 1
+        if isinstance(block, bytes) and idx < len(block):
+            handle.seek(idx - len(block), 1)
+        yield block[:idx]
+        return
+
+
+def generate_log(path, size, seed=0):
+    """ Write ``size`` bytes of build-log-ish lines to ``path`` """
+    rand = random.Random(seed)
+    lines = [
+        ('Step %d : %s\n' % (idx, 'x' * rand.randint(0, 160))).encode()
+        for idx in range(4096)
+    ]
+    written = 0
+    with open(path, 'wb') as handle:
+        while written < size:
+            chunk = b''.join(rand.sample(lines, 512))
+            handle.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def seek_block(handle, seek):
+    """ Line seek with the block scanner """
+    if seek >= 0:
+        skip_lines(handle, seek)
+    else:
+        skip_lines_back(handle, -seek)
+
+
+def read_legacy(handle, count):
+    """ Drain the legacy line reader """
+    for _ in legacy_reader_lines(handle, count):
+        pass
+
+
+def read_block(handle, count):
+    """ Drain the block line reader """
+    for _ in read_lines(handle, count):
+        pass
+
+
+def time_call(path, func, *args):
+    """ Time ``func(handle, *args)`` on a fresh handle. Returns the time, and
+    the handle position afterwards """
+    with open(path, 'rb') as handle:
+        start = time.perf_counter()
+        func(handle, *args)
+        elapsed = time.perf_counter() - start
+        return elapsed, handle.tell()
+
+
+def main():
+    """ Run the benchmark, and print a comparison table """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256,
+                        help="Size of the generated log in MB")
+    parser.add_argument('--path', help="Use an existing log instead")
+    parser.add_argument('--no-legacy', action='store_true',
+                        help="Skip the (slow) legacy implementations")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    path = args.path
+    if path is None:
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'stage')
+        generate_log(path, args.size * 1024 * 1024)
+
+    with open(path, 'rb') as handle:
+        lines = sum(chunk.count(b'\n') for chunk in read_lines(handle))
+
+    cases = (
+        ('tail -n 100', legacy_seeker_lines, seek_block, -100),
+        ('tail -n 100000', legacy_seeker_lines, seek_block, -100000),
+        ('seek_lines lines/10', legacy_seeker_lines, seek_block, lines // 10),
+        ('seek_lines lines/2', legacy_seeker_lines, seek_block, lines // 2),
+        ('count_lines 100000', read_legacy, read_block, 100000),
+        ('count_lines all', read_legacy, read_block, None),
+    )
+
+    print('%s: %d bytes, %d lines' % (path, os.path.getsize(path), lines))
+    print('%-22s %12s %12s %9s' % (
+        'case', 'legacy (s)', 'block (s)', 'speedup',
+    ))
+    try:
+        for name, legacy_func, block_func, arg in cases:
+            block_time, block_pos = time_call(path, block_func, arg)
+            if args.no_legacy:
+                print('%-22s %12s %12.4f %9s' % (name, '-', block_time, '-'))
+                continue
+
+            legacy_time, legacy_pos = time_call(path, legacy_func, arg)
+            if legacy_pos != block_pos and block_func is seek_block:
+                raise AssertionError('%s: legacy ended at %d, block at %d' % (
+                    name, legacy_pos, block_pos,
+                ))
+            print('%-22s %12.4f %12.4f %8.1fx' % (
+                name, legacy_time, block_time, legacy_time / block_time,
+            ))
+    finally:
+        if tmp_dir is not None:
+            os.remove(path)
+            os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+Serve generated stage logs with the HTTP API in a child process, and measure
+it with many concurrent ``log_init`` clients, using a weighted mix of seek,
+count, seek_lines, and tail queries. Reports request throughput, time to
+first byte, and total latency for each kind of query, and the server's
+memory. Generating a multi-GB data directory takes a while, so ``--data``
+keeps it to be reused by later runs
+
+Usage: python -m benchmarks.streaming [--stages N] [--size MB] [--data DIR]
+    [--final] [--workers N] [--clients N] [--requests N] [--gzip]
+    [--mix KIND=WEIGHT,...]
+    [--output FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import py
+
+from .results import (
+    add_arguments, latency_stats, peak_rss, peak_rss_of_tree, report,
+)
+from .scan import generate_log
+
+
+PROJECT = 'bench'
+STAGES_PER_JOB = 10
+DEFAULT_MIX = 'seek=3,seek_lines=2,tail=4,tail_bytes=1,count=1,whole=0'
+READ_SIZE = 256 * 1024
+# Query string for each kind of request, from a random generator, and the
+# size, and line count of the log
+QUERIES = {
+    'seek': lambda rand, size, lines: 'seek=%d&count=65536' % (
+        rand.randrange(size),
+    ),
+    'seek_lines': lambda rand, size, lines: (
+        'seek_lines=%d&count_lines=1000' % rand.randrange(lines)
+    ),
+    'tail': lambda rand, size, lines: 'seek_lines=-100',
+    'tail_bytes': lambda rand, size, lines: 'seek=-65536',
+    'count': lambda rand, size, lines: 'count=1048576',
+    'whole': lambda rand, size, lines: '',
+}
+
+
+def stage_paths(data_path, stages):
+    """ ``(job, stage)`` slugs, and log path of each generated stage """
+    for idx in range(stages):
+        job_slug = 'job%d' % (idx // STAGES_PER_JOB)
+        stage_slug = 'stage%d' % (idx % STAGES_PER_JOB)
+        yield job_slug, stage_slug, os.path.join(
+            data_path, 'data', PROJECT, job_slug, stage_slug,
+        )
+
+
+def prepare_data(data_path, stages, size, final):
+    """
+    Generate ``stages`` logs of ``size`` bytes under ``data_path``, unless
+    they're there from an earlier run with the same params. If ``final``,
+    they're finalized, with line indexes. Returns ``(job, stage, size,
+    lines)`` of each
+    """
+    params = {'stages': stages, 'size': size, 'final': final}
+    meta_path = os.path.join(data_path, 'benchmark.json')
+    try:
+        with open(meta_path) as handle:
+            meta = json.load(handle)
+        if meta['params'] == params:
+            return [tuple(stage) for stage in meta['stages']]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from dockci.logserve.storage import finalize_log
+
+    generated = []
+    for idx, (job_slug, stage_slug, path) in enumerate(
+            stage_paths(data_path, stages)
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        print('Generating %s' % path)
+        written = generate_log(path, size, seed=idx)
+        with open(path, 'rb') as handle:
+            lines = sum(
+                block.count(b'\n')
+                for block in iter(lambda: handle.read(1024 * 1024), b'')
+            )
+        if final:
+            finalize_log(py.path.local(path))
+        generated.append((job_slug, stage_slug, written, lines))
+
+    with open(meta_path, 'w') as handle:
+        json.dump({'params': params, 'stages': generated}, handle)
+    return generated
+
+
+def parse_mix(value):
+    """ Query kinds, and their weights from ``KIND=WEIGHT,...`` """
+    mix = []
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in QUERIES:
+            raise argparse.ArgumentTypeError('Unknown query kind: %s' % kind)
+        if float(weight) > 0:
+            mix.append((kind, float(weight)))
+    if not mix:
+        raise argparse.ArgumentTypeError('No query kinds have weight')
+    return mix
+
+
+def plan_requests(stages, mix, count, seed=0):
+    """ ``(kind, path)`` of ``count`` requests, drawn from the query mix """
+    rand = random.Random(seed)
+    totals = list(itertools.accumulate(weight for _, weight in mix))
+    requests = []
+    for _ in range(count):
+        job_slug, stage_slug, size, lines = rand.choice(stages)
+        kind = mix[bisect.bisect(totals, rand.random() * totals[-1])][0]
+        query = QUERIES[kind](rand, size, max(lines, 1))
+        requests.append((kind, '/projects/%s/jobs/%s/log_init/%s?%s' % (
+            PROJECT, job_slug, stage_slug, query,
+        )))
+    return requests
+
+
+def run_server(data_path, port, workers):
+    """ Run the HTTP API in this process, serving ``data_path`` """
+    os.chdir(data_path)
+    os.environ.update({
+        'LOGSERVE_HTTP_HOST': '127.0.0.1',
+        'LOGSERVE_HTTP_PORT': str(port),
+        'LOGSERVE_HTTP_WORKERS': str(workers),
+        'LOGSERVE_HTTP_METRICS_PORT': '0',
+    })
+    logging.basicConfig(level=logging.WARNING)
+    from dockci.logserve import http
+    http.run()
+
+
+def free_port():
+    """ A port that nothing is listening on """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(server, port, timeout=30):
+    """ Wait until the server accepts connections """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if not server.is_alive() or time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@asyncio.coroutine
+def fetch(port, path, headers=''):
+    """ Send a request, and read the whole response. Returns the status,
+    seconds to the first byte, and to the end, and the bytes received """
+    start = time.perf_counter()
+    reader, writer = yield from asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write((
+            'GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+            '%s\r\n' % (path, headers)
+        ).encode())
+        status_line = yield from reader.readline()
+        first_byte = time.perf_counter() - start
+        received = len(status_line)
+        while True:
+            data = yield from reader.read(READ_SIZE)
+            if not data:
+                break
+            received += len(data)
+    finally:
+        writer.close()
+
+    status = int(status_line.split()[1])
+    return status, first_byte, time.perf_counter() - start, received
+
+
+@asyncio.coroutine
+def run_clients(port, requests, clients, headers=''):
+    """ Make the requests from ``clients`` concurrent clients. Returns
+    ``(kind, status, first byte, total, received)`` for each """
+    pending = list(reversed(requests))
+    done = []
+
+    @asyncio.coroutine
+    def client():
+        """ Make requests one at a time until there are none left """
+        while pending:
+            kind, path = pending.pop()
+            done.append((kind,) + (yield from fetch(port, path, headers)))
+
+    yield from asyncio.gather(*[client() for _ in range(clients)])
+    return done
+
+
+def main():
+    """ Run the benchmark, and report the results """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stages', type=int, default=8,
+                        help="Number of stage logs to generate")
+    parser.add_argument('--size', type=int, default=256,
+                        help="Size of each stage log in MB")
+    parser.add_argument('--final', action='store_true',
+                        help="Finalize, and index the logs")
+    parser.add_argument('--data',
+                        help="Directory to generate logs in, and keep")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="HTTP worker processes")
+    parser.add_argument('--clients', type=int, default=64,
+                        help="Concurrent clients")
+    parser.add_argument('--requests', type=int, default=5000,
+                        help="Total requests to make")
+    parser.add_argument('--gzip', action='store_true',
+                        help="Accept gzip encoded responses")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="Weights of each kind of query (default %s)"
+                        % DEFAULT_MIX)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    data_path = os.path.abspath(args.data or tempfile.mkdtemp())
+    port = free_port()
+    server = None
+    try:
+        stages = prepare_data(
+            data_path, args.stages, args.size * 1024 * 1024, args.final,
+        )
+        requests = plan_requests(stages, args.mix, args.requests)
+
+        server = multiprocessing.Process(
+            target=run_server, args=(data_path, port, args.workers),
+        )
+        server.start()
+        wait_for_server(server, port)
+
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        done = loop.run_until_complete(
+            run_clients(
+                port, requests, args.clients,
+                'Accept-Encoding: gzip\r\n' if args.gzip else '',
+            ),
+        )
+        elapsed = time.perf_counter() - start
+        server_rss = peak_rss_of_tree(server.pid)
+
+    finally:
+        if server is not None and server.is_alive():
+            os.kill(server.pid, signal.SIGINT)
+            server.join(30)
+        if args.data is None:
+            shutil.rmtree(data_path)
+
+    errors = sum(1 for _, status, _, _, _ in done if status >= 400)
+    received = sum(item[4] for item in done)
+    results = {
+        'requests_per_second': len(done) / elapsed,
+        'mb_per_second': received / elapsed / 1024 / 1024,
+        'errors': errors,
+        'elapsed_seconds': elapsed,
+        'server_peak_rss_mb': (
+            None if server_rss is None else server_rss / 1024.0 / 1024
+        ),
+        'client_peak_rss_mb': peak_rss() / 1024.0 / 1024,
+    }
+    results.update(latency_stats('ttfb', [item[2] for item in done]))
+    results.update(latency_stats('total', [item[3] for item in done]))
+    for kind, _ in args.mix:
+        results.update(latency_stats(kind, [
+            item[3] for item in done if item[0] == kind
+        ]))
+
+    params = dict(vars(args), mix=dict(args.mix))
+    report(args, 'streaming', params, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+""" Asynchronous log file access, with blocking work done on an executor """
+import asyncio
+import io
+import os
+
+
+class ReadAhead(object):
+    """
+    Advance a blocking chunk generator on an executor. As soon as one chunk
+    is handed over, the next one is requested, so it's read while the caller
+    is busy writing the current one out
+
+    Examples:
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> loop = asyncio.new_event_loop()
+    >>> executor = ThreadPoolExecutor(max_workers=1)
+
+    >>> reader = ReadAhead(iter([b'abc', b'def']), executor, loop)
+    >>> loop.run_until_complete(reader.read())
+    b'abc'
+    >>> loop.run_until_complete(reader.read())
+    b'def'
+    >>> loop.run_until_complete(reader.read())
+    >>> loop.run_until_complete(reader.read())
+
+    >>> reader = ReadAhead(iter([b'abc', b'def']), executor, loop)
+    >>> loop.run_until_complete(reader.read())
+    b'abc'
+    >>> loop.run_until_complete(reader.close())
+
+    >>> executor.shutdown()
+    >>> loop.close()
+    """
+    def __init__(self, gen, executor, loop):
+        self._gen = gen
+        self._executor = executor
+        self._loop = loop
+        self._future = None
+        self._done = False
+
+    def _next(self):
+        """ Get the next chunk, or ``None`` when the generator is done """
+        return next(self._gen, None)
+
+    def _request(self):
+        """ Start reading the next chunk on the executor """
+        self._future = self._loop.run_in_executor(self._executor, self._next)
+
+    @asyncio.coroutine
+    def read(self):
+        """ Get the next chunk, or ``None`` if there is no more data """
+        if self._done:
+            return None
+        if self._future is None:
+            self._request()
+
+        data = yield from self._future
+        self._future = None
+
+        if data is None:
+            self._done = True
+        else:
+            self._request()
+        return data
+
+    @asyncio.coroutine
+    def close(self):
+        """ Wait for any read in progress, so its handle can be closed """
+        self._done = True
+        if self._future is not None:
+            try:
+                yield from self._future
+            finally:
+                self._future = None
+
+
+@asyncio.coroutine
+def run_io(request, func, *args):
+    """ Run a blocking call on the app's file I/O executor """
+    return (yield from request.app.loop.run_in_executor(
+        request.app.executor, func, *args
+    ))
+
+
+def _sendfile_cb(loop, future,  # pylint:disable=too-many-arguments
+                 out_fd, in_fd, offset, count, registered, progress):
+    """ Send as much as the socket will take, then wait for it to be
+    writable again if there's more to go. The time of the last send is
+    kept in ``progress``. If the file ends early, the future gets an
+    ``EOFError`` """
+    if registered:
+        loop.remove_writer(out_fd)
+    if future.cancelled():
+        return
+
+    try:
+        sent = os.sendfile(out_fd, in_fd, offset, count)
+        if sent == 0:  # file was truncated under us
+            future.set_exception(EOFError(
+                'File ended %d bytes short of the range' % count
+            ))
+            return
+        progress[0] = loop.time()
+    except (BlockingIOError, InterruptedError):
+        sent = 0
+    except Exception as ex:  # pylint:disable=broad-except
+        future.set_exception(ex)
+        return
+
+    if sent < count:
+        loop.add_writer(
+            out_fd, _sendfile_cb, loop, future,
+            out_fd, in_fd, offset + sent, count - sent, True, progress,
+        )
+    else:
+        future.set_result(None)
+
+
+def _sendfile_fds(request, handle):
+    """ Socket, and file descriptors to use with ``os.sendfile``, or
+    ``None`` if it can't be used """
+    transport = request.transport
+    if not hasattr(os, 'sendfile') or transport is None:
+        return None
+    if transport.get_extra_info('sslcontext') is not None:
+        return None
+
+    sock = transport.get_extra_info('socket')
+    if sock is None:
+        return None
+
+    try:
+        return sock.fileno(), handle.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+@asyncio.coroutine
+def sendfile(  # pylint:disable=too-many-arguments
+        request, response, handle, start, end, stall_timeout=None,
+):
+    """
+    Send bytes ``start`` to ``end`` of ``handle`` to the client with
+    ``os.sendfile``, so they go straight from the page cache to the socket.
+    The response must be prepared with a matching content length. Returns
+    ``False`` without sending anything if the transport doesn't support it.
+    Raises ``asyncio.TimeoutError`` if the client takes nothing for
+    ``stall_timeout`` seconds. If the file ends before ``end``, the content
+    length can't be met, so the connection is aborted, and ``EOFError``
+    raised
+    """
+    fds = _sendfile_fds(request, handle)
+    if fds is None:
+        return False
+    out_fd, in_fd = fds
+
+    # Data goes to the socket directly, so anything the transport has
+    # buffered (the headers) must be sent first
+    loop = request.app.loop
+    transport = request.transport
+    low, high = transport.get_write_buffer_limits()
+    transport.set_write_buffer_limits(high=0)
+    try:
+        yield from asyncio.wait_for(
+            response.drain(), stall_timeout, loop=loop,
+        )
+    finally:
+        transport.set_write_buffer_limits(high=high, low=low)
+
+    if end <= start:
+        return True
+
+    # The transport owns the socket's fd in the event loop, so we wait for
+    # writability on a duplicate of it
+    out_fd = os.dup(out_fd)
+    future = asyncio.Future(loop=loop)
+    progress = [loop.time()]
+    try:
+        _sendfile_cb(
+            loop, future, out_fd, in_fd, start, end - start, False, progress,
+        )
+        while stall_timeout is not None and not future.done():
+            yield from asyncio.wait(
+                [future], timeout=stall_timeout, loop=loop,
+            )
+            if (
+                    not future.done() and
+                    loop.time() - progress[0] >= stall_timeout
+            ):
+                raise asyncio.TimeoutError()
+        yield from future
+    except EOFError:
+        transport.abort()
+        raise
+    finally:
+        if not future.done():
+            future.cancel()
+            loop.remove_writer(out_fd)
+        os.close(out_fd)
+
+    return True
@@ -0,0 +1,135 @@
+""" pika connection adapter for an asyncio event loop """
+import asyncio
+
+from pika import exceptions
+from pika.adapters import base_connection
+
+
+class IOLoopAdapter(object):
+    """
+    The parts of the pika IOLoop interface that connections use, on top of
+    an asyncio event loop. The event loop is run by the application, so
+    ``start`` never blocks; ``stop`` just marks the adapter as stopped, so
+    that the application can wait for the connection to finish closing
+
+    Examples:
+
+    >>> loop = asyncio.new_event_loop()
+    >>> ioloop = IOLoopAdapter(loop)
+    >>> called = []
+    >>> _ = ioloop.add_timeout(0, lambda: called.append('timeout'))
+    >>> ioloop.remove_timeout(ioloop.add_timeout(0, called.append))
+    >>> ioloop.start()
+    >>> ioloop.stop()
+    >>> loop.run_until_complete(ioloop.wait_stopped())
+    >>> called
+    ['timeout']
+    >>> loop.close()
+    """
+    READ = base_connection.BaseConnection.READ
+    WRITE = base_connection.BaseConnection.WRITE
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._handlers = {}
+        self._readers = set()
+        self._writers = set()
+        self._stopped = asyncio.Event(loop=loop)
+
+    def add_timeout(self, deadline, callback_method):
+        """ Call ``callback_method`` after ``deadline`` seconds """
+        return self.loop.call_later(deadline, callback_method)
+
+    @staticmethod
+    def remove_timeout(timeout_id):
+        """ Cancel a timeout added with ``add_timeout`` """
+        timeout_id.cancel()
+
+    def add_handler(self, fileno, handler, event_state):
+        """ Call ``handler(fileno, events)`` for events on a file """
+        self._handlers[fileno] = handler
+        self.update_handler(fileno, event_state)
+
+    def update_handler(self, fileno, event_state):
+        """ Change the events that a handler is called for """
+        for event, fds, add, remove in (
+            (self.READ, self._readers,
+             self.loop.add_reader, self.loop.remove_reader),
+            (self.WRITE, self._writers,
+             self.loop.add_writer, self.loop.remove_writer),
+        ):
+            if event_state & event:
+                if fileno not in fds:
+                    add(fileno, self._handlers[fileno], fileno, event)
+                    fds.add(fileno)
+            elif fileno in fds:
+                remove(fileno)
+                fds.remove(fileno)
+
+    def remove_handler(self, fileno):
+        """ Stop calling the handler for a file """
+        self.update_handler(fileno, 0)
+        self._handlers.pop(fileno, None)
+
+    def start(self):
+        """ The event loop is already running; nothing to do """
+        self._stopped.clear()
+
+    def stop(self):
+        """ Mark the connection as done with the loop """
+        self._stopped.set()
+
+    @asyncio.coroutine
+    def wait_stopped(self):
+        """ Wait until ``stop`` is called """
+        yield from self._stopped.wait()
+
+
+class AsyncioConnection(base_connection.BaseConnection):
+    """
+    pika connection that runs on an asyncio event loop shared with the rest
+    of the application, such as the HTTP server. As with pika's other
+    adapters, the initial socket connect is blocking.
+
+    Errors opening the connection are passed to ``on_open_error_callback``,
+    including those found after the socket is connected. Other adapters
+    raise those out of ``ioloop.start``, but the event loop would just log
+    them
+    """
+    def __init__(self,  # pylint:disable=too-many-arguments
+                 parameters=None,
+                 on_open_callback=None,
+                 on_open_error_callback=None,
+                 on_close_callback=None,
+                 stop_ioloop_on_close=False,
+                 loop=None):
+        super(AsyncioConnection, self).__init__(
+            parameters, on_open_callback,
+            on_open_error_callback, on_close_callback,
+            IOLoopAdapter(loop or asyncio.get_event_loop()),
+            stop_ioloop_on_close,
+        )
+
+    def _adapter_connect(self):
+        """ Connect, and add the socket to the event loop """
+        error = super(AsyncioConnection, self)._adapter_connect()
+        if not error:
+            self.ioloop.add_handler(self.socket.fileno(), self._handle_events,
+                                    self.event_state)
+        return error
+
+    def _adapter_disconnect(self):
+        """ Remove the socket from the event loop, and disconnect """
+        if self.socket:
+            self.ioloop.remove_handler(self.socket.fileno())
+        super(AsyncioConnection, self)._adapter_disconnect()
+
+    def _handle_events(self, fd, events, error=None, write_only=False):
+        """ Handle socket events, passing errors opening the connection to
+        the open error callback """
+        try:
+            super(AsyncioConnection, self)._handle_events(
+                fd, events, error, write_only,
+            )
+        except exceptions.AMQPConnectionError as ex:
+            self.callbacks.process(0, self.ON_CONNECTION_ERROR, self, self, ex)
@@ -0,0 +1,216 @@
+""" Instrumentation, responses, and params shared by the HTTP API handlers """
+import asyncio
+import functools
+import json
+import time
+
+from aiohttp import web
+
+from .metrics import Counter, Histogram
+
+
+REQUEST_SECONDS = Histogram(
+    'logserve_http_request_seconds',
+    'Time to handle a request, by endpoint, and how logs were queried.',
+    ['endpoint', 'mode'],
+)
+REQUESTS = Counter(
+    'logserve_http_requests_total', 'Requests handled, by status.',
+    ['endpoint', 'status'],
+)
+RANGE_PARAMS = ('seek', 'seek_lines', 'count', 'count_lines')
+
+
+def instrumented(endpoint, mode=None):
+    """
+    Decorate a handler to record how long requests take, and their status.
+    If given, ``mode`` is called with each request for the ``mode`` label.
+    Requests cancelled when the client goes away have status 499
+    """
+    def decorator(handler):
+        """ Wrap the handler """
+        @functools.wraps(handler)
+        @asyncio.coroutine
+        def wrapper(request):
+            """ Call the handler, and record the request """
+            start = time.monotonic()
+            status = 500
+            try:
+                response = yield from handler(request)
+                status = response.status
+                return response
+            except asyncio.CancelledError:
+                status = 499
+                raise
+            finally:
+                REQUEST_SECONDS.labels(
+                    endpoint, '' if mode is None else mode(request),
+                ).observe(time.monotonic() - start)
+                REQUESTS.labels(endpoint, str(status)).inc()
+
+        return wrapper
+    return decorator
+
+
+def json_response(data, status=200):
+    """ Uncached JSON response """
+    return web.Response(
+        body=json.dumps(data, sort_keys=True).encode(),
+        status=status,
+        headers={
+            'content-type': 'application/json',
+            'cache-control': 'no-cache',
+        },
+    )
+
+
+def try_qs_int(request, key):
+    """
+    Try to get a query string arg, and parse it as an ``int``. Returns
+    ``None`` if the key doesn't exist, or if the value resolves to ``'None'``
+
+    Examples:
+
+    >>> from aiohttp import MultiDict
+    >>> class TestClass(object):
+    ...     pass
+    >>> request = TestClass()
+
+    >>> request.GET = MultiDict([
+    ...     ('a', '1'),
+    ...     ('b', '2'),
+    ...     ('b', '3'),
+    ...     ('c', b'4'),
+    ...     ('d', 'None'),
+    ...     ('e', b'None'),
+    ...     ('f', 'null'),
+    ...     ('g', b'null'),
+    ... ])
+
+    >>> try_qs_int(request, 'a')
+    1
+
+    >>> try_qs_int(request, 'b')
+    2
+
+    >>> try_qs_int(request, 'c')
+    4
+
+    >>> type(try_qs_int(request, 'no'))
+    <class 'NoneType'>
+
+    >>> type(try_qs_int(request, 'd'))
+    <class 'NoneType'>
+
+    >>> type(try_qs_int(request, 'e'))
+    <class 'NoneType'>
+
+    >>> type(try_qs_int(request, 'f'))
+    <class 'NoneType'>
+
+    >>> type(try_qs_int(request, 'g'))
+    <class 'NoneType'>
+    """
+    try:
+        value = request.GET[key]
+    except KeyError:
+        return None
+
+    return (
+        None if value in ('None', b'None', 'null', b'null')
+        else int(value)
+    )
+
+
+def json_int(params, name, minimum=None, maximum=None):
+    """
+    An ``int`` param from a JSON object, or ``None`` if it's not given.
+    Raises ``ValueError`` if it's not an integer in range
+
+    Examples:
+
+    >>> json_int({'seek': -3}, 'seek')
+    -3
+    >>> json_int({'seek': None}, 'seek')
+    >>> json_int({}, 'seek')
+    >>> json_int({'seek': '3'}, 'seek')
+    Traceback (most recent call last):
+      ...
+    ValueError: seek must be an integer
+    >>> json_int({'credit': 0}, 'credit', minimum=1)
+    Traceback (most recent call last):
+      ...
+    ValueError: credit must be between 1, and None
+    """
+    value = params.get(name)
+    if value is None:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError("%s must be an integer" % name)
+    if (
+        (minimum is not None and value < minimum) or
+        (maximum is not None and value > maximum)
+    ):
+        raise ValueError("%s must be between %s, and %s" % (
+            name, minimum, maximum,
+        ))
+    return value
+
+
+def check_slug(name, slug):
+    """
+    Raise ``ValueError`` unless ``slug`` can name a log. Slugs from the
+    router can't have a ``/``; other slugs must be checked
+
+    Examples:
+
+    >>> check_slug('stage', 'build')
+    'build'
+    >>> check_slug('stage', '../build')
+    Traceback (most recent call last):
+      ...
+    ValueError: stage must be a slug
+    >>> check_slug('stage', '.build.idx')
+    Traceback (most recent call last):
+      ...
+    ValueError: stage must be a slug
+    """
+    if (
+        not isinstance(slug, str) or not slug or
+        slug.startswith('.') or '/' in slug
+    ):
+        raise ValueError("%s must be a slug" % name)
+    return slug
+
+
+def check_ranges(byte_seek, line_seek, bytes_count, lines_count):
+    """
+    Raise ``ValueError`` if seek, or count params conflict. Returns them as
+    a tuple
+
+    Examples:
+
+    >>> check_ranges(None, -10, 5, None)
+    (None, -10, 5, None)
+    >>> check_ranges(1, 1, None, None)
+    Traceback (most recent call last):
+      ...
+    ValueError: byte_seek and line_seek are mutually exclusive
+    """
+    if byte_seek and line_seek:
+        raise ValueError("byte_seek and line_seek are mutually exclusive")
+    if bytes_count and lines_count:
+        raise ValueError("bytes_count and lines_count are mutually exclusive")
+    return byte_seek, line_seek, bytes_count, lines_count
+
+
+def qs_ranges(request):
+    """ ``(seek, seek_lines, count, count_lines)`` query args of a request.
+    Raises ``ValueError`` if they conflict """
+    return check_ranges(*(try_qs_int(request, name) for name in RANGE_PARAMS))
+
+
+def json_ranges(params):
+    """ ``(seek, seek_lines, count, count_lines)`` from a JSON object, with
+    the meaning of the ``log_init`` query args """
+    return check_ranges(*(json_int(params, name) for name in RANGE_PARAMS))
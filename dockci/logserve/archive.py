@@ -0,0 +1,308 @@
+"""
+Compressed archive format for finished stage logs.
+
+The log is split into frames of ``frame_size`` bytes, which are compressed
+independently, so reading any part of the log only needs the frames it
+touches. After the frames come the offsets of their ends in the archive,
+then a trailer with the size of the log, and where the offsets start::
+
+    header | frame 0 | frame 1 | ... | frame ends | trailer
+"""
+import array
+import collections
+import errno
+import io
+import os
+import struct
+import sys
+import zlib
+
+import py
+
+
+ARCHIVE_EXT = '.zlog'
+DEFAULT_FRAME_SIZE = 256 * 1024
+
+HEADER = struct.Struct('<4sI')
+TRAILER = struct.Struct('<QQ4s')
+MAGIC = b'DCLZ'
+
+LogStat = collections.namedtuple('LogStat', ['size', 'mtime', 'mtime_ns'])
+
+
+def is_archive(log_path):
+    """
+    Whether a log path is an archive
+
+    Examples:
+
+    >>> is_archive(py.path.local('/data/proj/job/stage.zlog'))
+    True
+    >>> is_archive(py.path.local('/data/proj/job/stage.log'))
+    False
+    """
+    return log_path.basename.endswith(ARCHIVE_EXT)
+
+
+def archive_path(log_path):
+    """
+    Path to the archive of a stage log. Legacy ``.log`` logs are archived to
+    the same path as bare ones
+
+    Examples:
+
+    >>> archive_path(py.path.local('/data/proj/job/stage')).strpath
+    '/data/proj/job/stage.zlog'
+    >>> archive_path(py.path.local('/data/proj/job/stage.log')).strpath
+    '/data/proj/job/stage.zlog'
+    """
+    basename = log_path.basename
+    if basename.endswith('.log'):
+        basename = basename[:-len('.log')]
+    return log_path.dirpath().join(basename + ARCHIVE_EXT)
+
+
+def _pack(offsets):
+    """ Offsets as little endian bytes """
+    if sys.byteorder != 'little':
+        offsets = array.array('Q', offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def write_archive(src, dest, frame_size=DEFAULT_FRAME_SIZE, level=6,
+                  index=None):
+    """
+    Compress all of the ``src`` file handle into an archive written to
+    ``dest``. If a ``LineIndex`` is given, the data is fed to it as it's
+    read. Returns the size of the log
+    """
+    dest.write(HEADER.pack(MAGIC, frame_size))
+    ends = array.array('Q')
+    offset = HEADER.size
+    size = 0
+    while True:
+        data = src.read(frame_size)
+        if not data:
+            break
+        if index is not None:
+            index.feed(data)
+
+        frame = zlib.compress(data, level)
+        dest.write(frame)
+        offset += len(frame)
+        size += len(data)
+        ends.append(offset)
+
+    dest.write(_pack(ends))
+    dest.write(TRAILER.pack(size, offset, MAGIC))
+    return size
+
+
+class ArchiveReader(io.RawIOBase):
+    """
+    Binary file object for reading the log in an archive. Frames are only
+    decompressed when they're read from, and the last one read is kept
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log = b''.join(b'line %d\\n' % num for num in range(100))
+    >>> with tmp_dir.join('stage.zlog').open('wb') as handle:
+    ...     write_archive(io.BytesIO(log), handle, frame_size=64)
+    790
+
+    >>> reader = ArchiveReader.open(tmp_dir.join('stage.zlog'))
+    >>> reader.size, reader.frames
+    (790, 13)
+    >>> reader.read(12)
+    b'line 0\\nline '
+    >>> reader.seek(60)
+    60
+    >>> reader.read(10)
+    b' 8\\nline 9\\n'
+    >>> reader.tell()
+    70
+    >>> reader.seek(-8, 2)
+    782
+    >>> reader.read()
+    b'line 99\\n'
+    >>> reader.read()
+    b''
+    >>> reader.seek(0)
+    0
+    >>> reader.read() == log
+    True
+    >>> reader.seek(-1)
+    Traceback (most recent call last):
+      ...
+    OSError: [Errno 22] Invalid argument
+    >>> reader.fileno()
+    Traceback (most recent call last):
+      ...
+    io.UnsupportedOperation: fileno
+    >>> reader.close()
+
+    >>> tmp_dir.join('bad.zlog').write('not an archive')
+    >>> ArchiveReader.open(tmp_dir.join('bad.zlog'))
+    Traceback (most recent call last):
+      ...
+    ValueError: Not a log archive
+    """
+    def __init__(self, handle):
+        super(ArchiveReader, self).__init__()
+        self._handle = handle
+        try:
+            self._load_index()
+        except ValueError:
+            handle.close()
+            raise
+
+        self._pos = 0
+        self._frame_num = None
+        self._frame = b''
+
+    @classmethod
+    def open(cls, path):
+        """ Open the archive at ``path`` """
+        return cls(path.open('rb'))
+
+    def _load_index(self):
+        """ Read the header, trailer, and frame offsets """
+        header = self._handle.read(HEADER.size)
+        archive_size = self._handle.seek(0, 2)
+        if (
+            len(header) < HEADER.size or
+            archive_size < HEADER.size + TRAILER.size
+        ):
+            raise ValueError("Not a log archive")
+
+        self._handle.seek(-TRAILER.size, 2)
+        self.size, index_start, trailer_magic = TRAILER.unpack(
+            self._handle.read(TRAILER.size),
+        )
+        magic, self.frame_size = HEADER.unpack(header)
+        if MAGIC not in (magic, trailer_magic) or magic != trailer_magic:
+            raise ValueError("Not a log archive")
+
+        self._handle.seek(index_start)
+        self._ends = array.array('Q')
+        self._ends.frombytes(self._handle.read(
+            archive_size - TRAILER.size - index_start
+        ))
+        if sys.byteorder != 'little':
+            self._ends.byteswap()
+
+    @property
+    def frames(self):
+        """ Number of frames in the archive """
+        return len(self._ends)
+
+    def _read_frame(self, frame_num):
+        """ Decompressed data of a frame """
+        if frame_num != self._frame_num:
+            start = self._ends[frame_num - 1] if frame_num else HEADER.size
+            self._handle.seek(start)
+            self._frame = zlib.decompress(
+                self._handle.read(self._ends[frame_num] - start),
+            )
+            self._frame_num = frame_num
+        return self._frame
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self._pos < self.size:
+            frame_num, rel = divmod(self._pos, self.frame_size)
+            data = self._read_frame(frame_num)[rel:rel + len(view) - filled]
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self._pos += len(data)
+        return filled
+
+    def stat(self):
+        """ ``LogStat`` of the log in the open archive """
+        stat = os.fstat(self._handle.fileno())
+        return LogStat(self.size, stat.st_mtime, stat.st_mtime_ns)
+
+    def close(self):
+        if not self.closed:
+            self._handle.close()
+            self._frame = b''
+        super(ArchiveReader, self).close()
+
+
+def open_log(log_path):
+    """
+    Open a stage log for binary reading, whether it's plain, or archived.
+    If a plain log was compacted after it was found, its archive is opened
+    """
+    if is_archive(log_path):
+        return ArchiveReader.open(log_path)
+
+    try:
+        return log_path.open('rb')
+    except py.error.ENOENT:
+        if not archive_path(log_path).check():
+            raise
+        return ArchiveReader.open(archive_path(log_path))
+
+
+def stat_log(log_path):
+    """
+    Size, and modification time of the data in a stage log, whether it's
+    plain, or archived. Compaction keeps the modification time of the log
+    """
+    stat = log_path.stat()
+    size = stat.size
+    if is_archive(log_path):
+        with ArchiveReader.open(log_path) as reader:
+            size = reader.size
+    return LogStat(size, stat.mtime, stat.mtime_ns)
+
+
+def fstat_log(handle):
+    """
+    ``stat_log`` for a handle from ``open_log``. It describes the data read
+    from the handle, even if the log has been compacted, or appended to
+    since it was opened
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage')
+    >>> log_path.write('abc\\n')
+    >>> with log_path.open('rb') as handle:
+    ...     fstat_log(handle) == stat_log(log_path)
+    True
+
+    >>> with tmp_dir.join('stage.zlog').open('wb') as handle:
+    ...     write_archive(io.BytesIO(b'abc\\ndef\\n'), handle)
+    8
+    >>> with open_log(tmp_dir.join('stage.zlog')) as handle:
+    ...     fstat_log(handle).size
+    8
+    """
+    if isinstance(handle, ArchiveReader):
+        return handle.stat()
+    stat = os.fstat(handle.fileno())
+    return LogStat(stat.st_size, stat.st_mtime, stat.st_mtime_ns)
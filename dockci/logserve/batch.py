@@ -0,0 +1,271 @@
+""" Logs of many stages of a job in one response """
+import asyncio
+import json
+import struct
+
+from aiohttp import web
+
+from .aiofile import run_io
+from .api import (
+    check_slug, instrumented, json_int, json_ranges, qs_ranges, try_qs_int,
+)
+from .archive import open_log
+from .encoding import accepts_gzip, GzipStreamResponse
+from .logs import log_range, resolve_log, response_flow, send_range
+
+
+# Length of the JSON header before each stage in a batch response
+BATCH_HEADER = struct.Struct('>I')
+
+
+def _tail_seek(handle, lines):
+    """
+    ``seek_lines`` value to get the last ``lines`` lines of a log. A newline
+    at the end of the log doesn't start another line
+
+    Examples:
+
+    >>> from dockci.logserve.logs import seeker_lines
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> tmp_file = tmp_dir.join('test')
+    >>> tmp_file.write('abc\\ndef\\nghi\\n')
+    >>> with tmp_file.open('rb') as handle:
+    ...     seeker_lines(handle, _tail_seek(handle, 2))
+    ...     handle.read()
+    b'def\\nghi\\n'
+
+    >>> tmp_file.write('abc\\ndef\\nghi')
+    >>> with tmp_file.open('rb') as handle:
+    ...     seeker_lines(handle, _tail_seek(handle, 2))
+    ...     handle.read()
+    b'def\\nghi'
+    """
+    size = handle.seek(0, 2)
+    if size > 0:
+        handle.seek(size - 1)
+        if handle.read(1) == b'\n':
+            lines += 1
+    handle.seek(0)
+    return -lines
+
+
+def _open_range(log_path,  # pylint:disable=too-many-arguments
+                tail_lines, byte_seek, line_seek, bytes_count, lines_count):
+    """ Open a log, and resolve seek and count params, or the last
+    ``tail_lines`` lines, to a byte range. Returns ``(handle, start, end)``
+    """
+    handle = open_log(log_path)
+    try:
+        if tail_lines is not None:
+            line_seek = _tail_seek(handle, tail_lines)
+        start, end = log_range(
+            log_path, handle, byte_seek, line_seek, bytes_count, lines_count,
+        )
+
+    except (OSError, ValueError):
+        handle.close()
+        raise
+
+    return handle, start, end
+
+
+def _batch_part(stage_slug, tail_lines, ranges):
+    """ Check a stage of a batch request. Returns it as ``(stage_slug,
+    tail_lines, (seek, seek_lines, count, count_lines))`` """
+    check_slug('stage', stage_slug)
+    if tail_lines is not None and (
+        ranges[0] is not None or ranges[1] is not None
+    ):
+        raise ValueError("tail can't be combined with seek, or seek_lines")
+    return stage_slug, tail_lines, ranges
+
+
+def _batch_parts_json(body):
+    """
+    Stages of a batch request from a JSON body
+
+    Examples:
+
+    >>> _batch_parts_json({'stages': [
+    ...     {'stage': 'a', 'tail': 10}, {'stage': 'b', 'count_lines': 5},
+    ... ]})
+    [('a', 10, (None, None, None, None)), ('b', None, (None, None, None, 5))]
+
+    >>> _batch_parts_json({'stages': [{'stage': 'a', 'tail': 10, 'seek': 2}]})
+    Traceback (most recent call last):
+      ...
+    ValueError: tail can't be combined with seek, or seek_lines
+    >>> _batch_parts_json([])
+    Traceback (most recent call last):
+      ...
+    ValueError: stages must be a list of objects
+    """
+    stages = body.get('stages') if isinstance(body, dict) else None
+    if not isinstance(stages, list) or not all(
+        isinstance(params, dict) for params in stages
+    ):
+        raise ValueError("stages must be a list of objects")
+
+    return [
+        _batch_part(
+            params.get('stage'),
+            json_int(params, 'tail', minimum=1),
+            json_ranges(params),
+        )
+        for params in stages
+    ]
+
+
+def _batch_parts_qs(request):
+    """ Stages of a batch request from the query string. Every ``stage``
+    arg gets the same seek, count, and ``tail`` params """
+    tail_lines = try_qs_int(request, 'tail')
+    if tail_lines is not None and tail_lines < 1:
+        raise ValueError("tail must be at least 1")
+    ranges = qs_ranges(request)
+    return [
+        _batch_part(stage_slug, tail_lines, ranges)
+        for stage_slug in request.GET.getall('stage', [])
+    ]
+
+
+@asyncio.coroutine
+def _open_batch_part(request, key, tail_lines, ranges):
+    """ Resolve, and open a stage of a batch. Returns the stage's JSON
+    header, and ``(handle, start, end)``, or ``None`` if it has no log """
+    found = yield from resolve_log(request, key)
+    if found is None:
+        return {'stage': key[2], 'status': 404, 'length': 0}, None
+    log_path, _, final = found
+
+    opened = yield from run_io(
+        request, _open_range, log_path, tail_lines, *ranges
+    )
+    _, start, end = opened
+    return {
+        'stage': key[2], 'status': 200,
+        'start': start, 'length': end - start, 'final': final is not None,
+    }, opened
+
+
+@asyncio.coroutine
+def _close_batch(request, stages):
+    """ Close the logs opened for the stages of a batch """
+    for _, opened in stages:
+        if opened is not None:
+            yield from run_io(request, opened[0].close)
+
+
+@asyncio.coroutine
+def _open_batch(request, parts):
+    """
+    Resolve, and open every stage of a batch concurrently on the executor.
+    Returns each stage's JSON header, and ``(handle, start, end)``, or
+    ``None`` if it has no log. If any stage fails, the others are closed,
+    and its error is raised
+    """
+    params = request.match_info
+    results = yield from asyncio.gather(*[
+        _open_batch_part(
+            request,
+            (params['project_slug'], params['job_slug'], stage_slug),
+            tail_lines, ranges,
+        )
+        for stage_slug, tail_lines, ranges in parts
+    ], loop=request.app.loop, return_exceptions=True)
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        yield from _close_batch(request, [
+            result for result in results
+            if not isinstance(result, Exception)
+        ])
+        raise errors[0]
+    return results
+
+
+def _frame_header(header):
+    """
+    A stage's JSON header, after its length
+
+    Examples:
+
+    >>> _frame_header({'stage': 'a', 'length': 0})
+    b'\\x00\\x00\\x00\\x1b{"length": 0, "stage": "a"}'
+    """
+    header = json.dumps(header, sort_keys=True).encode()
+    return BATCH_HEADER.pack(len(header)) + header
+
+
+def _batch_response(request, stages):
+    """
+    Response for a batch of stages, and whether it has a fixed length.
+    Unless it's gzipped, its length is known from the stage headers, so
+    the logs can be sent with ``sendfile``
+    """
+    headers = {
+        'content-type': 'application/octet-stream',
+        'cache-control': 'no-cache',
+        'vary': 'Accept-Encoding',
+    }
+    if accepts_gzip(request.headers.get('Accept-Encoding')):
+        return GzipStreamResponse(
+            status=200, headers=headers,
+            compresslevel=request.app.gzip_cache.compresslevel,
+        ), False
+
+    response = web.StreamResponse(status=200, headers=headers)
+    response.content_length = sum(
+        len(_frame_header(header)) + header['length']
+        for header, _ in stages
+    )
+    return response, True
+
+
+@instrumented('log_batch')
+@asyncio.coroutine
+def handle_log_batch(request):
+    """
+    Send logs of many stages of a job in one response. Stages are given as
+    repeated ``stage`` query args, which share the ``log_init`` seek, and
+    count args, or in a ``POST`` JSON body, with params for each::
+
+        {"stages": [{"stage": "build", "tail": 100}, {"stage": "test"}]}
+
+    ``tail`` gets the last lines of a log. Every stage is looked up, and
+    opened concurrently on the executor before any is sent.
+
+    Each stage is sent in order as a 4 byte big endian length, a JSON header
+    of that length, and the number of log bytes given by the header's
+    ``length``. The header also has the ``stage``, a ``status`` (404 if
+    there's no log), the ``start`` offset of the data, and whether the log
+    is ``final``
+    """
+    try:
+        if request.method == 'POST':
+            parts = _batch_parts_json((yield from request.json()))
+        else:
+            parts = _batch_parts_qs(request)
+    except ValueError as ex:
+        return web.Response(body=str(ex).encode(), status=400)
+
+    if len(parts) > request.app.batch_max_stages:
+        return web.Response(body="Too many stages".encode(), status=400)
+
+    stages = yield from _open_batch(request, parts)
+    try:
+        response, fixed_length = _batch_response(request, stages)
+        yield from response.prepare(request)
+        flow = response_flow(request, response)
+        for header, opened in stages:
+            response.write(_frame_header(header))
+            if opened is not None:
+                handle, start, end = opened
+                yield from send_range(
+                    request, response, flow, handle, start, end, fixed_length,
+                )
+
+    finally:
+        yield from _close_batch(request, stages)
+
+    return response
@@ -0,0 +1,69 @@
+""" Run the DockCI log server consumer, and API server on one event loop """
+import asyncio
+import functools
+
+from . import consumer as consumer_mod
+from . import http
+from .amqp import AsyncioConnection
+from .notify import LocalNotifier
+from .util import env_float, run_wrapper
+
+
+@asyncio.coroutine
+def _stop_consumer(consumer, logger, timeout, _):
+    """ Cleanly stop the consumer before the app shuts down """
+    consumer.start_stopping()
+    if consumer.ioloop is not None:
+        try:
+            yield from asyncio.wait_for(
+                consumer.ioloop.wait_stopped(), timeout, loop=http.APP.loop,
+            )
+        except asyncio.TimeoutError:
+            logger.warning('Timed out waiting for the connection to close')
+
+    stopped = asyncio.Future(loop=http.APP.loop)
+    consumer.finish_stopping(stopped.set_result)
+    yield from stopped
+
+
+def _run_sync(func, callback):
+    """ Run a consumer's writer calls on the HTTP server's file I/O
+    executor, so that they don't hold up requests """
+    future = http.APP.loop.run_in_executor(http.APP.executor, func)
+    future.add_done_callback(lambda done: callback(done.exception()))
+
+
+@run_wrapper('all')
+def run(logger, *_):
+    """
+    Run the consumer, and HTTP API server in one process. Stage events go
+    straight from the consumer's writers to the HTTP server's listener,
+    rather than over the notify sockets. Everything the consumer does with
+    its writers, from buffering, and committing data to finalizing stages,
+    runs on the HTTP server's executor, one call at a time
+    """
+    http.setup(logger)
+    loop = http.APP.loop
+
+    def on_open_error(_, error=None):
+        """ Retry connecting while the broker is unavailable """
+        logger.error('Connection issue: %s', error)
+        loop.call_later(1, consumer.run)
+
+    consumer = consumer_mod.from_env(
+        logger,
+        LocalNotifier(http.APP.notify, loop),
+        connection_class=functools.partial(
+            AsyncioConnection,
+            loop=loop,
+            on_open_error_callback=on_open_error,
+        ),
+        run_sync=_run_sync,
+    )
+
+    http.APP.on_shutdown.append(functools.partial(
+        _stop_consumer, consumer, logger,
+        env_float('LOGSERVE_STOP_TIMEOUT', 10),
+    ))
+    loop.call_soon(consumer.run)
+    http.serve()
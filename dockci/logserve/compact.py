@@ -0,0 +1,179 @@
+""" Background compaction of finalized stage logs into archives """
+import fcntl
+import os
+import time
+
+import py
+
+from .archive import (
+    archive_path, is_archive, write_archive, DEFAULT_FRAME_SIZE,
+)
+from .index import _log_paths, index_path, LineIndex
+from .notify import Notifier
+from .storage import final_path, load_final, save_final
+from .util import env_float, env_int, run_wrapper
+
+
+def compact_log(log_path, frame_size=DEFAULT_FRAME_SIZE, level=6):
+    """
+    Rewrite a finalized stage log as an archive, with its own index, and
+    final marker. The archive keeps the log's modification time, so its
+    cache validators don't change. The plain log, and its sidecar files are
+    removed once the archive is in place. The log is locked meanwhile, so
+    logs held open by a ``StageWriter`` are skipped, and aren't written to
+    while they're archived. Returns the archive path, or ``None`` if the log
+    isn't finalized, is being written, or is already archived
+
+    Examples:
+
+    >>> from .archive import open_log, stat_log
+    >>> from .storage import finalize_log
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage.log')
+    >>> log_path.write('abc\\ndef\\n')
+    >>> compact_log(log_path)
+
+    >>> _ = finalize_log(log_path)
+    >>> mtime_ns = log_path.stat().mtime_ns
+    >>> compact_log(log_path, frame_size=4).basename
+    'stage.zlog'
+    >>> sorted(path.basename for path in tmp_dir.listdir())
+    ['.stage.zlog.final', '.stage.zlog.idx', 'stage.zlog']
+
+    >>> stat = stat_log(tmp_dir.join('stage.zlog'))
+    >>> stat.size, stat.mtime_ns == mtime_ns
+    (8, True)
+    >>> load_final(tmp_dir.join('stage.zlog'))
+    {'lines': 2, 'size': 8}
+    >>> with open_log(log_path) as handle:
+    ...     handle.read()
+    b'abc\\ndef\\n'
+
+    >>> from .storage import StageWriter
+    >>> writer = StageWriter(tmp_dir.join('open'))
+    >>> writer.write(b'ghi\\n')
+    >>> writer.flush()
+    >>> _ = finalize_log(writer.path)
+    >>> compact_log(writer.path)
+
+    >>> writer.close()
+    >>> compact_log(writer.path).basename
+    'open.zlog'
+    """
+    with log_path.open('rb') as src:
+        try:
+            fcntl.flock(src.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        final = load_final(log_path)
+        stat = log_path.stat()
+        archive = archive_path(log_path)
+        if (
+            final is None or final.get('size') != stat.size or
+            not os.path.samestat(
+                os.fstat(src.fileno()), os.stat(log_path.strpath),
+            ) or
+            archive.check()
+        ):
+            return None
+
+        _write_archive(src, stat, archive, final, frame_size, level)
+
+        # Removed while locked, so that nothing is appended to it meanwhile
+        for path in (log_path, index_path(log_path), final_path(log_path)):
+            try:
+                path.remove()
+            except py.error.ENOENT:
+                pass
+
+    return archive
+
+
+def _write_archive(src, stat,  # pylint:disable=too-many-arguments
+                   archive, final, frame_size, level):
+    """ Write the archive of a locked log, and its sidecars. If the log
+    grew meanwhile, nothing is written, and ``OSError`` is raised """
+    tmp_path = archive.dirpath().join('.%s.%s.tmp' % (
+        archive.basename, os.getpid(),
+    ))
+    try:
+        index = LineIndex()
+        with tmp_path.open('wb') as dest:
+            size = write_archive(src, dest, frame_size, level, index)
+            dest.flush()
+            os.fsync(dest.fileno())
+
+        # Writers that don't lock the log, like older versions, could append
+        if size != final['size']:
+            raise OSError("%s grew while it was archived" % src.name)
+        os.utime(tmp_path.strpath, ns=(stat.atime_ns, stat.mtime_ns))
+
+        # Sidecars first, so they're there as soon as the archive is found
+        index.save(index_path(archive))
+        save_final(archive, final)
+        os.rename(tmp_path.strpath, archive.strpath)
+
+    finally:
+        if tmp_path.check():
+            tmp_path.remove()
+
+
+def compact_all(data_path, logger, notifier=None, min_age=0, **kwargs):
+    """
+    Compact every stage log that has been finalized for at least
+    ``min_age`` seconds, publishing a ``compact`` event to ``notifier`` for
+    each, since the log has moved. Extra args are passed to
+    ``compact_log``. Returns the number of logs compacted
+    """
+    compacted = 0
+    for log_path in _log_paths(data_path):
+        if is_archive(log_path):
+            continue
+        try:
+            marker_mtime = final_path(log_path).mtime()
+        except py.error.ENOENT:
+            continue
+        if time.time() - marker_mtime < min_age:
+            continue
+
+        try:
+            archive = compact_log(log_path, **kwargs)
+        except (OSError, ValueError):
+            logger.exception('Failed to compact %s', log_path)
+            continue
+
+        if archive is not None:
+            logger.info('Compacted %s', log_path)
+            compacted += 1
+            if notifier is not None:
+                notifier.publish({
+                    'event': 'compact',
+                    'project': archive.dirpath().dirpath().basename,
+                    'job': archive.dirpath().basename,
+                    'stage': archive.purebasename,
+                })
+
+    return compacted
+
+
+@run_wrapper('compactor')
+def run(logger, *_):
+    """
+    Compact finalized stage logs every ``LOGSERVE_COMPACT_INTERVAL``
+    seconds, once they've been final for ``LOGSERVE_COMPACT_AGE`` seconds
+    """
+    interval = env_float('LOGSERVE_COMPACT_INTERVAL', 60)
+    kwargs = dict(
+        min_age=env_float('LOGSERVE_COMPACT_AGE', 300),
+        frame_size=env_int('LOGSERVE_COMPACT_FRAME_SIZE', DEFAULT_FRAME_SIZE),
+        level=env_int('LOGSERVE_COMPACT_LEVEL', 6),
+    )
+    notifier = Notifier()
+    while True:
+        compacted = compact_all(
+            py.path.local('data'), logger, notifier, **kwargs
+        )
+        if compacted:
+            logger.info('Compacted %s stage logs', compacted)
+        time.sleep(interval)
@@ -1,13 +1,55 @@
 """ Setup and run the DockCI log server consumer """
+import functools
+import json
+import multiprocessing
 import os
+import time
 
 import pika
 import py
 
-from .util import run_wrapper
-
-
-class Consumer(object):  # pylint:disable=too-many-public-methods
+from .delivery import Heartbeat, MessageLog, PendingAcks
+from .metrics import health_from_env, serve_metrics, Counter, Gauge, Histogram
+from .notify import Notifier
+from .shards import ShardConfig
+from .status import is_final_status
+from .storage import StageWriterPool, WriterQueue
+from .util import env_float, env_int, run_wrapper
+
+
+MESSAGES = Counter(
+    'logserve_consumer_messages_total', 'Messages consumed.', ['kind'],
+)
+MESSAGE_BYTES = Counter(
+    'logserve_consumer_bytes_total', 'Bytes of log content consumed.',
+)
+WRITE_SECONDS = Histogram(
+    'logserve_consumer_write_seconds',
+    'Time to append a message to its stage log.',
+)
+ACK_DELAY_SECONDS = Histogram(
+    'logserve_consumer_ack_delay_seconds',
+    'Time from receiving a message to acknowledging it.',
+)
+COMMIT_SECONDS = Histogram(
+    'logserve_consumer_commit_seconds',
+    'Time to apply the durability policy, and acknowledge a group of '
+    'messages.',
+)
+QUEUE_MESSAGES = Gauge(
+    'logserve_consumer_queue_messages', 'Messages waiting in the queue.',
+)
+MESSAGE_AGE = Gauge(
+    'logserve_consumer_message_age_seconds',
+    'Age of the last message consumed, from its timestamp property.',
+)
+OPEN_WRITERS = Gauge(
+    'logserve_consumer_open_writers', 'Stage logs open for writing.',
+)
+
+
+class Consumer(object):
+    # pylint:disable=too-many-public-methods,too-many-instance-attributes
     """This is an example consumer that will handle unexpected interactions
     with RabbitMQ such as channel and connection closures.
 
@@ -24,31 +66,90 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
     EXCHANGE_TYPE = 'topic'
     QUEUE = 'dockci.logserve'
     ROUTING_KEY = r'dockci.*.*.*.content'
-
-    def __init__(self, connect_params, logger):
+    STAGE_STATUS_KEY = r'dockci.*.*.*.status'
+    JOB_STATUS_KEY = r'dockci.*.*.status'
+
+    def __init__(self,  # pylint:disable=too-many-arguments
+                 connect_params, logger, writers=None,
+                 prefetch_count=0, commit_size=1, commit_interval=0.1,
+                 connection_class=pika.SelectConnection,
+                 shard=None, shard_expires=300,
+                 heartbeat_interval=5, log_interval=10, run_sync=None):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
+        Deliveries are acknowledged in groups: once ``commit_size`` messages
+        are pending, a stage's buffer is full, or ``commit_interval`` seconds
+        have passed, the writers durability policy is applied and the whole
+        group is acknowledged with a single Basic.Ack. Buffered data that
+        hasn't been acknowledged is dropped if the connection closes. A
+        delivery that can't be written is never acknowledged; the channel
+        is closed instead, so that it's redelivered.
+
+        Everything the consumer does with its writers goes through a
+        ``WriterQueue``, one call at a time. If ``run_sync`` is given, the
+        queue runs them with it, so that writes, commits, and finalizing
+        stages don't hold up the IOLoop.
+
+        If ``shard`` is given, messages come through a consistent hash
+        exchange instead (see ``ShardConfig``).
+
+        Stage, and job status messages are consumed too. When one says that
+        a stage, or every stage of a job, has finished, the stage is flushed
+        and marked final with its size, and line count. When sharded, only
+        the shard writing a stage does this, after all of its content.
+
+        Every ``heartbeat_interval`` seconds, the consumer checks how many
+        messages are waiting in its queue, and publishes a ``consumer``
+        event with its state to the writers' notifier, so that the HTTP
+        server can report its liveness, and lag. Messages are logged in a
+        summary every ``log_interval`` seconds.
+
+        :param writers: Pool of stage log writers to append message bodies to
+        :type writers: dockci.logserve.storage.StageWriterPool
+        :param int prefetch_count: Max unacknowledged deliveries (0 for none)
+        :param int commit_size: Number of deliveries to group per commit
+        :param float commit_interval: Max seconds to hold pending deliveries
+        :param connection_class: pika connection adapter to connect with
+        :param int shard: Number of the shard to consume, if sharded
+        :param int shard_expires: Seconds unused before shard queues expire
+        :param float heartbeat_interval: Seconds between consumer events
+        :param float log_interval: Seconds between message log summaries
+        :param run_sync: Called with a function to run away from the IOLoop,
+          and a callback to call on the IOLoop afterwards, with the exception
+          it raised, or None. Writer calls run on the IOLoop without one
+
         """
         self._connect_params = connect_params
+        self._connection_class = connection_class
         self._connection = None
         self._channel = None
         self._closing = False
         self._consumer_tag = None
         self._logger = logger
+        self._writers = (
+            StageWriterPool(py.path.local('data')) if writers is None
+            else writers
+        )
+        self._acks = PendingAcks(prefetch_count, commit_size, commit_interval)
+        self._shard = ShardConfig(self.QUEUE, shard, shard_expires)
+        self._heartbeat = Heartbeat(heartbeat_interval)
+        self._messages = MessageLog(logger, log_interval)
+        self._io = WriterQueue(run_sync)
+        OPEN_WRITERS.set_function(functools.partial(len, self._writers))
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
         When the connection is established, the on_connection_open method
         will be invoked by pika.
 
-        :rtype: pika.SelectConnection
+        :rtype: pika.adapters.base_connection.BaseConnection
 
         """
         self._logger.info('Connecting to %s', self._connect_params)
-        return pika.SelectConnection(self._connect_params,
-                                     self.on_connection_open,
-                                     stop_ioloop_on_close=False)
+        return self._connection_class(self._connect_params,
+                                      self.on_connection_open,
+                                      stop_ioloop_on_close=False)
 
     def on_connection_open(
         self,
@@ -63,6 +164,7 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         """
         self._logger.info('Connection opened')
         self._connection.add_on_close_callback(self.on_connection_closed)
+        self.schedule_flush()
         self.open_channel()
 
     def on_connection_closed(
@@ -81,6 +183,12 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
 
         """
         self._channel = None
+        self._consumer_tag = None
+        self._heartbeat.queue_messages = None
+        # Unacknowledged deliveries will be redelivered on a new channel, so
+        # writing out what's buffered of them would duplicate it
+        self._io.call(self._writers.discard_unacked, self.on_discarded)
+        self._acks.clear()
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -89,6 +197,19 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
                                  reply_code, reply_text)
             self._connection.add_timeout(5, self.reconnect)
 
+    def on_discarded(self, dropped, error):
+        """Invoked once unacknowledged data has been dropped from the writers
+        after the connection closed.
+
+        :param int dropped: The number of bytes dropped
+        :param Exception error: The exception dropping them raised, or None
+
+        """
+        if error is not None:
+            self._logger.error('Failed to drop unacknowledged data: %s', error)
+        elif dropped:
+            self._logger.info('Dropped %s unacknowledged bytes', dropped)
+
     def reconnect(self):
         """Will be invoked by the IOLoop timer if the connection is
         closed. See the on_connection_closed method.
@@ -118,7 +239,8 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         """This method is invoked by pika when the channel has been opened.
         The channel object is passed in so we can make use of it.
 
-        Since the channel is now open, we'll declare the exchange to use.
+        Since the channel is now open, we'll declare the queue to use, or
+        if sharded, the shard exchange.
 
         :param pika.channel.Channel channel: The channel object
 
@@ -126,7 +248,57 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         self._logger.info('Channel opened')
         self._channel = channel
         self._channel.add_on_close_callback(self.on_channel_closed)
-        self.setup_queue(self.QUEUE)
+        if self._shard.sharded:
+            self.setup_shard_exchange()
+        else:
+            self.setup_queue(self._shard.queue)
+
+    def setup_shard_exchange(self):
+        """Setup the consistent hash exchange that shares stages between
+        shards by invoking the Exchange.Declare RPC command. When it is
+        complete, the on_shard_exchange_declareok method will be invoked by
+        pika.
+
+        """
+        self._logger.info('Declaring exchange %s', self._shard.EXCHANGE)
+        self._channel.exchange_declare(
+            self.on_shard_exchange_declareok,
+            self._shard.EXCHANGE,
+            self._shard.EXCHANGE_TYPE,
+            durable=True,
+        )
+
+    def on_shard_exchange_declareok(
+        self,
+        unused_frame,  # pylint:disable=unused-argument
+    ):
+        """Invoked by pika when the Exchange.Declare RPC call made in
+        setup_shard_exchange has completed. We bind the shard exchange to
+        the job exchange with the content routing key by issuing the
+        Exchange.Bind RPC command, so that it receives every log message.
+
+        :param pika.frame.Method unused_frame: Exchange.DeclareOk frame
+
+        """
+        self._logger.info('Binding %s to %s with %s',
+                          self.EXCHANGE, self._shard.EXCHANGE,
+                          self.ROUTING_KEY)
+        self._channel.exchange_bind(self.on_shard_exchange_bindok,
+                                    self._shard.EXCHANGE, self.EXCHANGE,
+                                    self.ROUTING_KEY)
+
+    def on_shard_exchange_bindok(
+        self,
+        unused_frame,  # pylint:disable=unused-argument
+    ):
+        """Invoked by pika when the Exchange.Bind method has completed. The
+        shard's queue is declared next.
+
+        :param pika.frame.Method unused_frame: The Exchange.BindOk frame
+
+        """
+        self._logger.info('Shard exchange bound')
+        self.setup_queue(self._shard.queue)
 
     def on_channel_closed(self, channel, reply_code, reply_text):
         """Invoked by pika when RabbitMQ unexpectedly closes the channel.
@@ -156,7 +328,7 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         self._channel.queue_declare(
             self.on_queue_declareok,
             queue_name,
-            exclusive=True,
+            **self._shard.queue_arguments()
         )
 
     def on_queue_declareok(
@@ -164,44 +336,99 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         method_frame,  # pylint:disable=unused-argument
     ):
         """Method invoked by pika when the Queue.Declare RPC call made in
-        setup_queue has completed. In this method we will bind the queue
-        and exchange together with the routing key by issuing the Queue.Bind
-        RPC command. When this command is complete, the on_bindok method will
-        be invoked by pika.
+        setup_queue has completed. In this method we will start binding the
+        queue to its exchanges.
 
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
+        self.bind_next(self.bindings())
+
+    def bindings(self):
+        """The exchange, and routing key pairs to bind the queue with. Log
+        content comes through the shard exchange if sharded. Status messages
+        come straight from the job exchange, if this consumer gets them.
+
+        :rtype: list
+
+        """
+        if self._shard.sharded:
+            bindings = [(self._shard.EXCHANGE, self._shard.WEIGHT)]
+        else:
+            bindings = [(self.EXCHANGE, self.ROUTING_KEY)]
+        if self._shard.gets_status:
+            bindings.extend([
+                (self.EXCHANGE, self.STAGE_STATUS_KEY),
+                (self.EXCHANGE, self.JOB_STATUS_KEY),
+            ])
+        return bindings
+
+    def bind_next(self, unbound):
+        """Bind the queue with the next of its bindings by issuing the
+        Queue.Bind RPC command. When this command is complete, the on_bindok
+        method will be invoked by pika with the rest of them.
+
+        :param list unbound: The exchange, and routing key pairs left to bind
+
+        """
+        exchange, routing_key = unbound[0]
+        queue = self._shard.queue
         self._logger.info('Binding %s to %s with %s',
-                          self.EXCHANGE, self.QUEUE, self.ROUTING_KEY)
-        self._channel.queue_bind(self.on_bindok, self.QUEUE,
-                                 self.EXCHANGE, self.ROUTING_KEY)
+                          exchange, queue, routing_key)
+        self._channel.queue_bind(
+            functools.partial(self.on_bindok, unbound[1:]),
+            queue, exchange, routing_key,
+        )
 
-    def on_bindok(self, unused_frame):  # pylint:disable=unused-argument
-        """Invoked by pika when the Queue.Bind method has completed. At this
-        point we will start consuming messages by calling start_consuming
-        which will invoke the needed RPC commands to start the process.
+    def on_bindok(
+        self,
+        unbound,
+        unused_frame,  # pylint:disable=unused-argument
+    ):
+        """Invoked by pika when the Queue.Bind method has completed. Once
+        every binding is done, we will start consuming messages by calling
+        start_consuming which will invoke the needed RPC commands to start
+        the process.
 
+        :param list unbound: The exchange, and routing key pairs left to bind
         :param pika.frame.Method unused_frame: The Queue.BindOk response frame
 
         """
         self._logger.info('Queue bound')
-        self.start_consuming()
+        if unbound:
+            self.bind_next(unbound)
+        else:
+            self.start_consuming()
 
     def start_consuming(self):
-        """This method sets up the consumer by first calling
-        add_on_cancel_callback so that the object is notified if RabbitMQ
-        cancels the consumer. It then issues the Basic.Consume RPC command
-        which returns the consumer tag that is used to uniquely identify the
-        consumer with RabbitMQ. We keep the value to use it when we want to
-        cancel consuming. The on_message method is passed in as a callback pika
-        will invoke when a message is fully received.
+        """This method limits the number of unacknowledged deliveries RabbitMQ
+        will send us by issuing the Basic.Qos RPC command. When it is
+        complete, the on_basic_qos_ok method will be invoked by pika.
+
+        """
+        self._logger.info('Setting prefetch count to %s',
+                          self._acks.prefetch_count)
+        self._channel.basic_qos(self.on_basic_qos_ok,
+                                prefetch_count=self._acks.prefetch_count)
+
+    def on_basic_qos_ok(self, unused_frame):  # pylint:disable=unused-argument
+        """Invoked by pika when the Basic.Qos method has completed. This
+        method sets up the consumer by first calling add_on_cancel_callback
+        so that the object is notified if RabbitMQ cancels the consumer. It
+        then issues the Basic.Consume RPC command which returns the consumer
+        tag that is used to uniquely identify the consumer with RabbitMQ. We
+        keep the value to use it when we want to cancel consuming. The
+        on_message method is passed in as a callback pika will invoke when a
+        message is fully received.
+
+        :param pika.frame.Method unused_frame: The Basic.QosOk response frame
 
         """
         self._logger.info('Issuing consumer related RPC commands')
         self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
         self._consumer_tag = self._channel.basic_consume(self.on_message,
-                                                         self.QUEUE)
+                                                         self._shard.queue,
+                                                         exclusive=True)
 
     def on_consumer_cancelled(self, method_frame):
         """Invoked by pika when RabbitMQ sends a Basic.Cancel for a consumer
@@ -217,9 +444,9 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
 
     def on_message(
         self,
-        channel,  # pylint:disable=unused-argument
+        channel,
         basic_deliver,
-        properties,  # pylint:disable=unused-argument
+        properties,
         body,
     ):
         """Invoked by pika when a message is delivered from RabbitMQ. The
@@ -229,34 +456,296 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         instance of BasicProperties with the message properties and the body
         is the message that was sent.
 
-        :param pika.channel.Channel unused_channel: The channel object
+        :param pika.channel.Channel channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
         :param pika.Spec.BasicProperties: properties
         :param str|unicode body: The message body
 
         """
-        project_slug, job_slug, stage_slug = (
-            basic_deliver.routing_key.split('.')[1:-1])
-        self._logger.info('Received message for %s/%s/%s: %s',
-                          project_slug, job_slug, stage_slug, body)
+        now = time.monotonic()
+        self._heartbeat.last_message = time.time()
+        if properties.timestamp:
+            MESSAGE_AGE.set(
+                self._heartbeat.last_message - properties.timestamp
+            )
+
+        slugs = basic_deliver.routing_key.split('.')[1:-1]
+        ready = self._acks.add(basic_deliver.delivery_tag, now)
+        on_done = functools.partial(self.on_written, channel, slugs)
+        if basic_deliver.routing_key.endswith('.status'):
+            MESSAGES.labels('status').inc()
+            self.on_status(channel, slugs, body)
+        elif (
+                self._shard.sharded and
+                properties.type == self._shard.FINALIZE_TYPE
+        ):
+            MESSAGES.labels('finalize').inc()
+            self._io.call(functools.partial(
+                self._writers.finalize, *slugs
+            ), on_done)
+        else:
+            MESSAGES.labels('content').inc()
+            MESSAGE_BYTES.inc(len(body))
+            self._messages.record(tuple(slugs), body, now)
+            self._io.call(functools.partial(self.write, slugs, body), on_done)
+
+        if ready:
+            self.commit()
+
+    def write(self, slugs, body):
+        """Append a message body to its stage. Runs on the writer queue.
+
+        :param list slugs: Project, job, and stage slugs
+        :param bytes body: The message body
+        :return: Whether the stage's buffer is full, so should be committed
+        :rtype: bool
+
+        """
+        with WRITE_SECONDS.time():
+            return self._writers.write(*(slugs + [body]))
+
+    def on_written(self, channel, slugs, full, error):
+        """Invoked once a delivery has been written. A full buffer is
+        committed straight away.
+
+        If it couldn't be written, such as when the writer evicted to make
+        room for its stage failed to flush, nothing more is acknowledged on
+        its channel: the pending deliveries are forgotten, and the channel
+        is closed, so that the broker redelivers them, and this one, in
+        order. Their data that's still buffered is dropped when the
+        connection closes. A channel that has been replaced already has.
+
+        :param pika.channel.Channel channel: The delivery's channel
+        :param list slugs: Project, job, and (for stages) stage slugs
+        :param full: Whether to commit straight away, because the stage's
+          buffer is full, or it was finalized
+        :param Exception error: The exception the write raised, or None
+
+        """
+        if channel is not self._channel:
+            return
+        if error is None:
+            if full:
+                self.commit()
+            return
+
+        self._logger.error('Failed to write %s, closing the channel: %s',
+                           '/'.join(slugs), error)
+        self._acks.clear()
+        if channel.is_open:
+            channel.close()
+
+    def on_status(self, channel, slugs, body):
+        """Finalize a stage, or every stage of a job, if its status message
+        says that it has finished. When sharded, each stage is passed on to
+        the shard that writes it instead, which finalizes it once all of
+        its content is written. A job's stages are those with logs, or
+        written to by this consumer.
+
+        :param pika.channel.Channel channel: The delivery's channel
+        :param list slugs: Project, job, and (for stages) stage slugs
+        :param bytes body: The status message body
+
+        """
+        if not is_final_status(body):
+            return
+
+        self._logger.info('Finalizing %s', '/'.join(slugs))
+        self._io.call(
+            functools.partial(self.finish_stages, slugs),
+            functools.partial(self.on_stages_finished, channel, slugs, body),
+        )
+
+    def finish_stages(self, slugs):
+        """Keys of the stages a status message is about, which are finalized
+        here unless sharded. Runs on the writer queue.
+
+        :param list slugs: Project, job, and (for stages) stage slugs
+        :rtype: list
+
+        """
+        if len(slugs) == 3:
+            keys = [tuple(slugs)]
+        else:
+            keys = [
+                tuple(slugs) + (stage_slug,)
+                for stage_slug in self._writers.job_stages(*slugs)
+            ]
+        if not self._shard.sharded:
+            for key in keys:
+                self._writers.finalize(*key)
+        return keys
+
+    def on_stages_finished(  # pylint:disable=too-many-arguments
+        self, channel, slugs, body, keys, error,
+    ):
+        """Invoked once the stages a status message is about are found, and
+        finalized if unsharded. When sharded, each is passed on to its shard
+        through the shard exchange.
+
+        :param pika.channel.Channel channel: The delivery's channel
+        :param list slugs: Project, job, and (for stages) stage slugs
+        :param bytes body: The status message body
+        :param list keys: Project, job, and stage slugs of each stage
+        :param Exception error: The exception finishing them raised, or None
+
+        """
+        if error is not None or not self._shard.sharded:
+            self.on_written(channel, slugs, None, error)
+            return
+        if channel is not self._channel:
+            return
+
+        for key in keys:
+            channel.basic_publish(
+                self._shard.EXCHANGE, self._shard.content_key(key), body,
+                pika.BasicProperties(type=self._shard.FINALIZE_TYPE),
+            )
+
+    def commit(self):
+        """Apply the writers durability policy to every stage written since
+        the last commit, then acknowledge all pending deliveries at once, in
+        on_committed. Only one group is committed at a time.
+
+        """
+        if not self._acks.count or self._acks.committing is not None:
+            return
+
+        committing = self._acks.start_commit()
+        self._io.call(
+            functools.partial(self.commit_writers, committing),
+            functools.partial(self.on_committed, committing),
+        )
+
+    def commit_writers(self, committing):
+        """Apply the writers durability policy, unless the group has been
+        forgotten since the commit was queued. Runs on the writer queue.
+
+        :param tuple committing: The group of deliveries being committed
+
+        """
+        if committing is not self._acks.committing:
+            return
+        with COMMIT_SECONDS.time():
+            self._writers.commit()
+
+    def on_committed(self, committing, _, error):
+        """Invoked once the writers have been committed. If they succeeded,
+        the group is acknowledged, otherwise it's pending again, for the
+        flush timer to retry. A group from a channel that has since failed,
+        or closed is dropped, because it will be redelivered.
+
+        :param tuple committing: The group of deliveries being committed
+        :param Exception error: The exception the commit raised, or None
+
+        """
+        if not self._acks.finish_commit(committing, failed=bool(error)):
+            return
+        if error is not None:
+            self._logger.error('Failed to commit stage writers: %s', error)
+            if self._closing and self._consumer_tag is None:
+                # Closing without the group, which will be redelivered
+                self.close_channel()
+            return
+
+        _, tag, since = committing
+        self.acknowledge_message(tag, multiple=True)
+        # Deliveries in a group wait for the first of them at most
+        ACK_DELAY_SECONDS.observe(time.monotonic() - since)
+        if self._closing and self._consumer_tag is None:
+            self.close_channel_when_committed()
+        elif self._acks.count >= self._acks.size:
+            self.commit()
+
+    def schedule_flush(self):
+        """Add an IOLoop timer to commit pending deliveries, and flush stage
+        writers that have held data longer than the pool's buffer age, so
+        that quiet stages still make it to disk promptly.
+
+        """
+        self._connection.add_timeout(
+            min(self._acks.interval, self._writers.buffer_age),
+            self.on_flush_timeout,
+        )
 
-        job_path = py.path.local('data').join(project_slug, job_slug)
-        job_path.ensure(dir=True)
-        stage_path = job_path.join(stage_slug)
-        with stage_path.open('ab') as handle:
-            handle.write(body)
+    def on_flush_timeout(self):
+        """Invoked by the IOLoop timer added in schedule_flush. Commits any
+        pending deliveries, flushes stage writers that are due, and schedules
+        the next check. Writers aren't checked while the writer queue is
+        busy, since they'll be checked again soon.
 
-        self.acknowledge_message(basic_deliver.delivery_tag)
+        """
+        if self._channel:
+            self.commit()
+        if self._io.idle:
+            self._io.call(self._writers.flush_due, self.on_flushed)
+        self._messages.tick()
+        self.heartbeat()
+        if not self._closing:
+            self.schedule_flush()
+
+    def on_flushed(self, _, error):
+        """Invoked once stage writers that are due have been flushed.
+
+        :param Exception error: The exception flushing them raised, or None
+
+        """
+        if error is not None:
+            self._logger.error('Failed to flush stage writers: %s', error)
 
-    def acknowledge_message(self, delivery_tag):
+    def heartbeat(self):
+        """Every heartbeat interval, publish the consumer's state, and ask
+        RabbitMQ how many messages are waiting in the queue by issuing a
+        passive Queue.Declare RPC command. When it is complete, the
+        on_queue_depth method will be invoked by pika.
+
+        """
+        if not self._heartbeat.due(time.monotonic()):
+            return
+
+        if self._writers.notifier is not None:
+            self._writers.notifier.publish(self.status())
+        if self._channel:
+            self._channel.queue_declare(self.on_queue_depth,
+                                        self._shard.queue, passive=True)
+
+    def on_queue_depth(self, method_frame):
+        """Invoked by pika when the passive Queue.Declare RPC call made in
+        heartbeat has completed, with the number of messages waiting.
+
+        :param pika.frame.Method method_frame: The Queue.DeclareOk frame
+
+        """
+        self._heartbeat.queue_messages = method_frame.method.message_count
+        QUEUE_MESSAGES.set(self._heartbeat.queue_messages)
+
+    def status(self):
+        """The state of the consumer, as a ``consumer`` event.
+
+        :rtype: dict
+
+        """
+        return {
+            'event': 'consumer',
+            'name': self.name,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'consuming': bool(self._channel and self._consumer_tag),
+            'queue_messages': self._heartbeat.queue_messages,
+            'last_message': self._heartbeat.last_message,
+        }
+
+    def acknowledge_message(self, delivery_tag, multiple=False):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool multiple: Also acknowledge all prior unacknowledged tags
 
         """
-        self._logger.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        self._logger.debug('Acknowledging message %s (multiple=%s)',
+                           delivery_tag, multiple)
+        self._channel.basic_ack(delivery_tag, multiple=multiple)
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -278,7 +767,18 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         """
         self._logger.info('RabbitMQ acknowledged the cancellation of the '
                           'consumer')
-        self.close_channel()
+        self._consumer_tag = None
+        self.close_channel_when_committed()
+
+    def close_channel_when_committed(self):
+        """Commit pending deliveries, then close the channel. While a group
+        is being committed, on_committed calls this again when it's done.
+
+        """
+        if self._acks.count:
+            self.commit()
+        elif self._acks.committing is None:
+            self.close_channel()
 
     def close_channel(self):
         """Call to close the channel with RabbitMQ cleanly by issuing the
@@ -306,12 +806,55 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         communicate with RabbitMQ. All of the commands issued prior to starting
         the IOLoop will be buffered but not processed.
 
+        """
+        self.start_stopping()
+        self._connection.ioloop.start()
+        self.finish_stopping()
+
+    def start_stopping(self):
+        """Begin a clean shutdown without running the IOLoop. The connection
+        stops its IOLoop once it has closed, at which point finish_stopping
+        should be called.
+
         """
         self._logger.info('Stopping')
         self._closing = True
         self.stop_consuming()
-        self._connection.ioloop.start()
+
+    def finish_stopping(self, callback=None):
+        """Flush, and close the stage writers once the connection has
+        closed. They're closed after everything else queued for them.
+
+        :param callback: Called once they're closed, with the exception
+          closing them raised, or None
+
+        """
+        self._io.call(self._writers.close_all, functools.partial(
+            self.on_stopped, callback,
+        ))
+
+    def on_stopped(self, callback, _, error):
+        """Invoked once the stage writers have been closed.
+
+        :param callback: Called with ``error``, if not None
+        :param Exception error: The exception closing them raised, or None
+
+        """
+        if error is not None:
+            self._logger.error('Failed to close stage writers: %s', error)
         self._logger.info('Stopped')
+        if callback is not None:
+            callback(error)
+
+    @property
+    def name(self):
+        """The name of the consumer in its events."""
+        return self._shard.name
+
+    @property
+    def ioloop(self):
+        """The IOLoop of the current connection, if there is one."""
+        return self._connection.ioloop if self._connection else None
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
@@ -319,14 +862,14 @@ class Consumer(object):  # pylint:disable=too-many-public-methods
         self._connection.close()
 
 
-@run_wrapper('consumer')
-def run(logger, add_stop_handler):
-    """ Run the log consumer """
+def from_env(logger, notifier, **kwargs):
+    """ Consumer configured from the environment, publishing stage events to
+    ``notifier``. Extra args are passed to ``Consumer`` """
     rabbit_user = os.environ.get('RABBITMQ_ENV_BACKEND_USER', 'guest')
     rabbit_pass = os.environ.get('RABBITMQ_ENV_BACKEND_PASSWORD', 'guest')
     rabbit_host = os.environ.get('RABBITMQ_PORT_5672_TCP_ADDR', '127.0.0.1')
     rabbit_port = os.environ.get('RABBITMQ_PORT_5672_TCP_PORT', 5672)
-    consumer = Consumer(
+    return Consumer(
         pika.ConnectionParameters(
             host=rabbit_host,
             port=int(rabbit_port),
@@ -335,14 +878,103 @@ def run(logger, add_stop_handler):
             ),
         ),
         logger,
+        StageWriterPool(
+            py.path.local('data'),
+            max_handles=env_int('LOGSERVE_MAX_HANDLES', 64),
+            buffer_size=env_int('LOGSERVE_BUFFER_SIZE', 64 * 1024),
+            buffer_age=env_float('LOGSERVE_BUFFER_AGE', 0.5),
+            durability=os.environ.get('LOGSERVE_DURABILITY', 'flush'),
+            notifier=notifier,
+        ),
+        prefetch_count=env_int('LOGSERVE_PREFETCH', 256),
+        commit_size=env_int('LOGSERVE_COMMIT_SIZE', 128),
+        commit_interval=env_float('LOGSERVE_COMMIT_INTERVAL', 0.1),
+        heartbeat_interval=env_float('LOGSERVE_HEARTBEAT_INTERVAL', 5),
+        log_interval=env_float('LOGSERVE_LOG_INTERVAL', 10),
+        **kwargs
     )
 
+
+def _serve_metrics(consumer, port):
+    """ Serve metrics, and the health of a consumer on ``port``, unless
+    it's 0 """
+    if not port:
+        return
+    health = health_from_env()
+
+    def check():
+        """ Health of the consumer, and a JSON report """
+        health.on_event(consumer.status(), b'')
+        healthy, consumers = health.check()
+        return healthy, json.dumps({
+            'status': 'ok' if healthy else 'unhealthy',
+            'consumers': consumers,
+        }, sort_keys=True)
+
+    serve_metrics(port, health=check)
+
+
+def _run_consumer(logger, add_stop_handler, metrics_port=0, **kwargs):
+    """ Run a log consumer until it's stopped """
+    consumer = from_env(logger, Notifier(), **kwargs)
     add_stop_handler(consumer.stop)
+    _serve_metrics(consumer, metrics_port)
 
     for _ in range(30):
         try:
             consumer.run()
         except pika.exceptions.AMQPConnectionError:
             logger.exception('Connection issue')
-            import time
             time.sleep(1)
+
+
+def run_shard(shard):
+    """ Run the log consumer for a shard, in a worker process """
+    metrics_port = env_int('LOGSERVE_METRICS_PORT', 9102)
+    run_wrapper('consumer.%s' % shard)(functools.partial(
+        _run_consumer,
+        shard=shard,
+        shard_expires=env_float('LOGSERVE_SHARD_EXPIRES', 300),
+        metrics_port=metrics_port and metrics_port + 1 + shard,
+    ))()
+
+
+@run_wrapper('consumer')
+def run(logger, add_stop_handler):
+    """
+    Run the log consumer. If ``LOGSERVE_CONSUMER_SHARDS`` is more than 1, a
+    worker process is started for each shard, and stages are shared between
+    them by the broker's consistent hash exchange plugin.
+
+    Metrics, and health are served on ``LOGSERVE_METRICS_PORT`` (0 to turn
+    them off), or by each shard on the ports after it
+    """
+    shards = env_int('LOGSERVE_CONSUMER_SHARDS', 1)
+    if shards <= 1:
+        _run_consumer(
+            logger, add_stop_handler,
+            metrics_port=env_int('LOGSERVE_METRICS_PORT', 9102),
+        )
+        return
+
+    workers = [
+        multiprocessing.Process(
+            target=run_shard, args=(shard,), name='consumer.%s' % shard,
+        )
+        for shard in range(shards)
+    ]
+
+    def stop_workers():
+        """ Stop all workers, and wait for them to finish """
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+
+    add_stop_handler(stop_workers)
+    logger.info('Starting %s consumer shards', shards)
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,193 @@
+"""
+What the consumer keeps track of about its deliveries: which are waiting
+to be acknowledged, summaries of what's been received, and the state it
+publishes in heartbeats
+"""
+import time
+
+
+class PendingAcks(object):
+    """
+    Deliveries that haven't been acknowledged yet. The broker sends at most
+    ``prefetch_count`` of them (0 for no limit). They're acknowledged in
+    groups: once ``size`` are pending, or ``interval`` seconds have passed
+
+    Examples:
+
+    >>> acks = PendingAcks(size=2)
+    >>> acks.add(1, now=10)
+    False
+    >>> acks.add(2, now=11)
+    True
+    >>> acks.count, acks.tag, acks.since
+    (2, 2, 10)
+    >>> acks.clear()
+    >>> acks.count, acks.tag, acks.since
+    (0, None, None)
+
+    A group can be committed away from the event loop. If that fails, its
+    deliveries are pending again
+
+    >>> acks.add(3, now=12)
+    False
+    >>> committing = acks.start_commit()
+    >>> committing, acks.count
+    ((1, 3, 12), 0)
+    >>> acks.add(4, now=13)
+    False
+    >>> acks.finish_commit(committing, failed=True)
+    True
+    >>> acks.count, acks.tag, acks.since
+    (2, 4, 12)
+    >>> acks.finish_commit(committing)
+    False
+    """
+    def __init__(self, prefetch_count=0, size=1, interval=0.1):
+        self.prefetch_count = prefetch_count
+        self.size = size
+        self.interval = interval
+        self.count = 0
+        self.tag = None
+        self.since = None
+        self.committing = None
+
+    def add(self, delivery_tag, now):
+        """ Add a delivery. Returns whether the group is ready to commit """
+        if self.since is None:
+            self.since = now
+        self.count += 1
+        self.tag = delivery_tag
+        return self.count >= self.size
+
+    def clear(self):
+        """ Forget the pending deliveries, and any being committed, once
+        they're acknowledged, or will be redelivered """
+        self.count = 0
+        self.tag = None
+        self.since = None
+        self.committing = None
+
+    def start_commit(self):
+        """ Move the pending deliveries to ``committing`` while they're made
+        durable. Returns them as a ``(count, tag, since)`` tuple """
+        committing = (self.count, self.tag, self.since)
+        self.clear()
+        self.committing = committing
+        return committing
+
+    def finish_commit(self, committing, failed=False):
+        """ Finish a commit started by ``start_commit``. If it ``failed``,
+        its deliveries are pending again. Returns ``False`` if they've been
+        cleared since, so the commit is stale """
+        if committing is not self.committing:
+            return False
+
+        self.committing = None
+        if failed:
+            count, tag, since = committing
+            self.count += count
+            if self.tag is None:
+                self.tag = tag
+            self.since = since
+        return True
+
+
+class MessagePeriod(object):
+    """ Summary of the messages a ``MessageLog`` received in a period that
+    started at ``since``, and the first of them, as a sample """
+    def __init__(self, since=None):
+        self.since = since
+        self.count = 0
+        self.bytes = 0
+        self.stages = set()
+        self.sample = None
+
+
+class MessageLog(object):
+    """
+    Aggregated logging of consumed messages. Rather than a line for every
+    message, a summary is logged at most every ``interval`` seconds. The
+    first message of each period is logged at debug level as a sample, cut
+    to ``sample_size`` bytes
+
+    Examples:
+
+    >>> import logging, sys
+    >>> logger = logging.getLogger('test.messages')
+    >>> logger.addHandler(logging.StreamHandler(sys.stdout))
+    >>> logger.setLevel(logging.DEBUG)
+
+    >>> messages = MessageLog(logger, interval=10, sample_size=3)
+    >>> messages.record(('p', 'j', 'a'), b'abcdef', now=0)
+    >>> messages.record(('p', 'j', 'b'), b'gh', now=1)
+    >>> messages.tick(now=5)
+    >>> messages.tick(now=10)
+    Received 2 messages (8 bytes) for 2 stages in 10.0s
+    Sample message for p/j/a: b'abc'
+    >>> messages.tick(now=30)
+    """
+    def __init__(self, logger, interval=10, sample_size=200):
+        self._logger = logger
+        self.interval = interval
+        self.sample_size = sample_size
+        self._period = MessagePeriod()
+
+    def record(self, key, body, now=None):
+        """ Count a message for a stage """
+        if now is None:
+            now = time.monotonic()
+        period = self._period
+        if period.since is None:
+            period.since = now
+
+        period.count += 1
+        period.bytes += len(body)
+        period.stages.add(key)
+        if period.sample is None:
+            period.sample = (key, body[:self.sample_size])
+
+    def tick(self, now=None):
+        """ Log the summary of the period, if it's over """
+        if now is None:
+            now = time.monotonic()
+        period = self._period
+        if period.since is None or now - period.since < self.interval:
+            return
+
+        if period.count:
+            self._logger.info(
+                'Received %d messages (%d bytes) for %d stages in %.1fs',
+                period.count, period.bytes, len(period.stages),
+                now - period.since,
+            )
+            key, body = period.sample
+            self._logger.debug(
+                'Sample message for %s: %r', '/'.join(key), body,
+            )
+        self._period = MessagePeriod(now if period.count else None)
+
+
+class Heartbeat(object):
+    """
+    What a consumer publishes about its state every ``interval`` seconds:
+    how many messages are waiting in its queue, and when it last got one
+
+    Examples:
+
+    >>> heartbeat = Heartbeat(interval=5)
+    >>> heartbeat.due(now=100), heartbeat.due(now=103), heartbeat.due(now=105)
+    (True, False, True)
+    """
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.sent_at = None
+        self.queue_messages = None
+        self.last_message = None
+
+    def due(self, now):
+        """ Whether the state should be published now. If so, it's assumed
+        that it will be """
+        if self.sent_at is not None and now - self.sent_at < self.interval:
+            return False
+        self.sent_at = now
+        return True
@@ -0,0 +1,272 @@
+""" Content encoding of log responses """
+import asyncio
+import collections
+import gzip
+import os
+import zlib
+
+import py
+
+from aiohttp import web
+
+from .archive import open_log
+
+
+GZIP_CHUNK_SIZE = 64 * 1024
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Whether an ``Accept-Encoding`` header value allows a gzip response
+
+    Examples:
+
+    >>> accepts_gzip('gzip, deflate')
+    True
+    >>> accepts_gzip('deflate, GZIP;q=0.5')
+    True
+    >>> accepts_gzip('gzip;q=0, deflate')
+    False
+    >>> accepts_gzip('*')
+    True
+    >>> accepts_gzip('identity')
+    False
+    >>> accepts_gzip(None)
+    False
+    """
+    if not accept_encoding:
+        return False
+
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qualities:
+            return qualities[name] > 0
+    return False
+
+
+class GzipStreamResponse(web.StreamResponse):
+    """
+    Stream response that gzips data as it's written. Each write is flushed
+    out of the compressor, so data that's followed reaches the client as
+    soon as it's written, at the cost of some compression
+    """
+    def __init__(self, *args, compresslevel=6, **kwargs):
+        super(GzipStreamResponse, self).__init__(*args, **kwargs)
+        self.headers['content-encoding'] = 'gzip'
+        self._compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS,
+        )
+
+    def write(self, data):
+        """ Compress data, and write it along with everything the
+        compressor has buffered """
+        return super(GzipStreamResponse, self).write(
+            self._compressor.compress(data) +
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        )
+
+    @asyncio.coroutine
+    def write_eof(self):
+        """ Write the end of the gzip stream, then end the response """
+        if self._compressor is not None:
+            super(GzipStreamResponse, self).write(self._compressor.flush())
+            self._compressor = None
+        yield from super(GzipStreamResponse, self).write_eof()
+
+
+def variant_path(log_path, stage_slug):
+    """
+    Path to the gzipped copy of a stage log. It's the same for plain, legacy,
+    and archived logs, since it's only used once a log is final
+
+    Examples:
+
+    >>> log_path = py.path.local('/data/proj/job/stage.zlog')
+    >>> variant_path(log_path, 'stage').strpath
+    '/data/proj/job/.stage.gz'
+    """
+    return log_path.dirpath().join('.%s.gz' % stage_slug)
+
+
+def open_variant(path, mtime_ns):
+    """
+    Open a gzipped copy of a log, if there is one for the log modified at
+    ``mtime_ns``. Returns the handle, and its size, or ``None``
+    """
+    try:
+        handle = path.open('rb')
+    except py.error.ENOENT:
+        return None
+
+    stat = os.fstat(handle.fileno())
+    if stat.st_mtime_ns != mtime_ns:
+        handle.close()
+        return None
+    return handle, stat.st_size
+
+
+def write_variant(log_path, path, mtime_ns, compresslevel=6):
+    """
+    Write a gzipped copy of a log to ``path``, with the log's modification
+    time. Returns its size
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage')
+    >>> log_path.write('abc\\n' * 100)
+    >>> path = variant_path(log_path, 'stage')
+    >>> size = write_variant(log_path, path, 1234)
+    >>> size < 400
+    True
+    >>> handle, size = open_variant(path, 1234)
+    >>> gzip.decompress(handle.read()) == log_path.read_binary()
+    True
+    >>> handle.close()
+    >>> open_variant(path, 5678)
+    """
+    tmp_path = path.dirpath().join('.%s.%s.tmp' % (
+        path.basename, os.getpid(),
+    ))
+    try:
+        with open_log(log_path) as src, tmp_path.open('wb') as dest:
+            with gzip.GzipFile(
+                filename='', mode='wb', fileobj=dest,
+                compresslevel=compresslevel, mtime=mtime_ns // 10 ** 9,
+            ) as gzip_file:
+                while True:
+                    data = src.read(GZIP_CHUNK_SIZE)
+                    if not data:
+                        break
+                    gzip_file.write(data)
+
+        os.utime(tmp_path.strpath, ns=(mtime_ns, mtime_ns))
+        os.rename(tmp_path.strpath, path.strpath)
+
+    finally:
+        if tmp_path.check():
+            tmp_path.remove()
+
+    return path.size()
+
+
+class GzipCache(object):
+    """
+    Tracks gzipped copies of final logs, so they can be sent as they are.
+    Copies are written in the background, the first time a log is requested
+    with gzip. Only logs of at least ``min_size``, and at most ``max_size``
+    bytes are copied. When the copies add up to more than ``max_size``
+    bytes, the least recently used are removed.
+
+    Copies left by an earlier process are only counted once they're used.
+    When HTTP workers share the copies, each publishes a ``variant`` event
+    for the copies it writes, so that every worker counts them. Only the
+    worker that wrote a copy removes others to make room for it
+
+    Examples:
+
+    >>> cache = GzipCache(max_size=10, min_size=2)
+    >>> cache.wanted(1), cache.wanted(2), cache.wanted(11)
+    (False, True, False)
+    >>> cache.add('a', 4)
+    []
+    >>> cache.add('b', 4)
+    []
+    >>> cache.add('a', 4)
+    []
+    >>> cache.add('c', 4)
+    ['b']
+    >>> cache.size
+    8
+    >>> cache.on_event({'event': 'variant', 'path': 'd', 'size': 4}, b'')
+    >>> cache.size
+    8
+    """
+    def __init__(self, max_size=1024 * 1024 * 1024, min_size=4096,
+                 compresslevel=6):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.compresslevel = compresslevel
+        self.size = 0
+        self._sizes = collections.OrderedDict()
+        self._pending = set()
+
+    def wanted(self, size):
+        """ Whether a log of ``size`` bytes should have a copy """
+        return self.min_size <= size <= self.max_size
+
+    def add(self, path, size):
+        """
+        Record that a copy was used, or written. Returns the copies that
+        must be removed to stay under ``max_size``
+        """
+        self.size -= self._sizes.pop(path, 0)
+        self._sizes[path] = size
+        self.size += size
+
+        evicted = []
+        while self.size > self.max_size and len(self._sizes) > 1:
+            evicted_path, evicted_size = self._sizes.popitem(last=False)
+            self.size -= evicted_size
+            evicted.append(evicted_path)
+        return evicted
+
+    def on_event(self, event, _):
+        """ ``Listener`` callback to count copies written by other workers.
+        Their writer makes room for them """
+        if event.get('event') == 'variant':
+            self.add(event['path'], event['size'])
+
+    @asyncio.coroutine
+    def record(self, app, path, size):
+        """ Record that a copy was used, or written, and remove the copies
+        that no longer fit """
+        for evicted in self.add(path.strpath, size):
+            yield from app.loop.run_in_executor(
+                app.executor, _remove, py.path.local(evicted),
+            )
+
+    @asyncio.coroutine
+    def _write(self, app, log_path, path, mtime_ns):
+        """ Write a copy on the executor, and make room for it """
+        try:
+            size = yield from app.loop.run_in_executor(
+                app.executor, write_variant,
+                log_path, path, mtime_ns, self.compresslevel,
+            )
+            yield from self.record(app, path, size)
+            if app.notifier is not None:
+                app.notifier.publish({
+                    'event': 'variant', 'path': path.strpath, 'size': size,
+                })
+        except (OSError, ValueError):
+            app.logger.exception('Failed to write %s', path)
+        finally:
+            self._pending.discard(path.strpath)
+
+    def start_write(self, app, log_path, path, mtime_ns):
+        """ Start writing a copy of a log, unless it's being written """
+        if path.strpath in self._pending:
+            return
+        self._pending.add(path.strpath)
+        app.loop.create_task(self._write(app, log_path, path, mtime_ns))
+
+
+def _remove(path):
+    """ Remove a file, if it's there """
+    try:
+        path.remove()
+    except py.error.ENOENT:
+        pass
@@ -0,0 +1,232 @@
+"""
+Flow control for streaming logs to HTTP clients. Each response reads the log
+in chunks sized to how fast its client takes them, the data written to
+clients, but not yet drained is capped across the server, and clients that
+stop reading are disconnected, so that they don't hold on to memory, and
+file handles
+"""
+import asyncio
+import collections
+
+from .aiofile import sendfile
+from .metrics import Counter, Histogram
+
+
+STALLED_CLIENTS = Counter(
+    'logserve_http_stalled_clients_total',
+    'Clients disconnected for not reading their responses.',
+)
+BUDGET_WAIT_SECONDS = Histogram(
+    'logserve_http_budget_wait_seconds',
+    'Time writers waited for the server to have bytes in flight to spare.',
+)
+
+
+class ChunkSizer(object):
+    """
+    Size of the chunks to read for a response, adapted to how fast the
+    client takes them. Chunks start at ``min_size``. While they're drained
+    in less than ``target`` seconds, the size doubles, up to ``max_size``;
+    when one takes longer, the size is cut to what the client took in
+    ``target`` seconds
+
+    Examples:
+
+    >>> sizer = ChunkSizer(16, 128, target=0.1)
+    >>> sizer.size
+    16
+    >>> for _ in range(4):
+    ...     sizer.record(sizer.size, 0.01)
+    ...     print(sizer.size)
+    32
+    64
+    128
+    128
+    >>> sizer.record(128, 0.2)
+    >>> sizer.size
+    64
+    >>> sizer.record(64, 10)
+    >>> sizer.size
+    16
+    """
+    def __init__(self, min_size, max_size, target=0.1):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.target = target
+        self.size = min_size
+
+    def record(self, sent, seconds):
+        """ Adapt to a chunk of ``sent`` bytes taking ``seconds`` to drain """
+        if seconds < self.target:
+            size = self.size * 2
+        else:
+            size = int(sent * self.target / seconds)
+        self.size = max(self.min_size, min(size, self.max_size))
+
+
+class ByteBudget(object):
+    """
+    Cap on the bytes in flight across all of a server's responses. Writers
+    wait, in turn, until there's room for their chunk. A chunk bigger than
+    the whole budget is let through once nothing else is in flight
+
+    Examples:
+
+    >>> loop = asyncio.new_event_loop()
+    >>> budget = ByteBudget(10, loop)
+    >>> loop.run_until_complete(budget.acquire(6))
+    >>> waiting = loop.create_task(budget.acquire(6))
+    >>> loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    >>> budget.in_flight, waiting.done()
+    (6, False)
+    >>> budget.release(6)
+    >>> loop.run_until_complete(waiting)
+    >>> budget.in_flight
+    6
+    >>> budget.release(6)
+    >>> loop.run_until_complete(budget.acquire(20))
+    >>> budget.in_flight
+    20
+    >>> loop.close()
+    """
+    def __init__(self, max_bytes, loop):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._loop = loop
+        self._waiters = collections.deque()
+
+    def _fits(self, count):
+        """ Whether ``count`` more bytes can be in flight now """
+        return (
+            not self.in_flight or
+            self.in_flight + count <= self.max_bytes
+        )
+
+    @asyncio.coroutine
+    def acquire(self, count):
+        """ Wait until ``count`` bytes can be in flight, and take them """
+        if self._waiters or not self._fits(count):
+            waiter = asyncio.Future(loop=self._loop)
+            self._waiters.append((waiter, count))
+            try:
+                with BUDGET_WAIT_SECONDS.time():
+                    yield from waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Given the bytes just as it was cancelled
+                    self.release(count)
+                else:
+                    self._waiters.remove((waiter, count))
+                    self._wake()
+                raise
+            return
+
+        self.in_flight += count
+
+    def release(self, count):
+        """ Return bytes that are no longer in flight """
+        self.in_flight -= count
+        self._wake()
+
+    def _wake(self):
+        """ Hand bytes to waiting writers, in turn, while they fit """
+        while self._waiters:
+            waiter, count = self._waiters[0]
+            if not self._fits(count):
+                return
+            self._waiters.popleft()
+            self.in_flight += count
+            waiter.set_result(None)
+
+
+class ResponseFlow(object):
+    """
+    Writes log data to a response within the flow limits. Chunks are read at
+    the ``sizer``'s size, and each waits for room in the ``budget`` before
+    it's written. Writes then wait until the transport's buffer is below
+    its ``high_water`` mark. If that takes more than ``stall_timeout``
+    seconds, the client is disconnected, and its request is cancelled. Limits
+    that are ``None`` aren't applied
+
+    Examples:
+
+    >>> class Response(object):
+    ...     def write(self, data):
+    ...         print(data)
+    ...     @asyncio.coroutine
+    ...     def drain(self):
+    ...         pass
+    >>> loop = asyncio.new_event_loop()
+    >>> budget = ByteBudget(10, loop)
+    >>> flow = ResponseFlow(loop, ChunkSizer(4, 8), budget)
+    >>> loop.run_until_complete(flow.write(Response(), b'abc'))
+    b'abc'
+    >>> flow.chunk_size(), budget.in_flight
+    (8, 0)
+    >>> loop.close()
+    """
+    def __init__(self,  # pylint:disable=too-many-arguments
+                 loop, sizer, budget=None, transport=None, high_water=None,
+                 stall_timeout=None):
+        self.sizer = sizer
+        self.budget = budget
+        self.transport = transport
+        self.stall_timeout = stall_timeout
+        self._loop = loop
+        self._stalled = False
+        if transport is not None and high_water is not None:
+            transport.set_write_buffer_limits(high=high_water)
+
+    def chunk_size(self):
+        """ Size of the next chunk to read. Called from the I/O executor """
+        return self.sizer.size
+
+    @asyncio.coroutine
+    def write(self, response, data):
+        """ Write data to the response, and wait until it's drained """
+        if self.budget is not None:
+            yield from self.budget.acquire(len(data))
+        try:
+            start = self._loop.time()
+            response.write(data)
+            yield from self._drain(response)
+            self.sizer.record(len(data), self._loop.time() - start)
+        finally:
+            if self.budget is not None:
+                self.budget.release(len(data))
+
+    @asyncio.coroutine
+    def _drain(self, response):
+        """ Wait for the response to drain, disconnecting the client if it
+        stalls """
+        if self.transport is None or self.stall_timeout is None:
+            yield from response.drain()
+            return
+
+        timer = self._loop.call_later(self.stall_timeout, self._stall)
+        try:
+            yield from response.drain()
+        finally:
+            timer.cancel()
+        if self._stalled:
+            raise asyncio.CancelledError()
+
+    @asyncio.coroutine
+    def sendfile(self, request, response, handle, start, end):
+        """ ``aiofile.sendfile``, disconnecting the client if it stalls """
+        try:
+            return (yield from sendfile(
+                request, response, handle, start, end, self.stall_timeout,
+            ))
+        except asyncio.TimeoutError:
+            self._stall()
+            raise asyncio.CancelledError()
+
+    def _stall(self):
+        """ Disconnect a client that stopped reading. Losing the connection
+        cancels its request """
+        if self._stalled:
+            return
+        self._stalled = True
+        STALLED_CLIENTS.inc()
+        self.transport.abort()
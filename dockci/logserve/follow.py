@@ -0,0 +1,203 @@
+""" Following stage logs as they're written """
+import asyncio
+
+from .logs import stream_file, write_data, READ_CHUNK_SIZE
+from .notify import StageWaiter
+from .storage import load_final
+
+
+class StageSubscription(object):
+    """
+    A follower's view of a ``StageBroadcaster``. Chunks are queued as
+    ``(offset, data)`` up to ``maxsize``; when the queue is full, chunks are
+    dropped, and the follower reads the gap from disk instead. ``None`` is
+    queued when the broadcaster ends
+
+    Examples:
+
+    >>> loop = asyncio.new_event_loop()
+    >>> subscription = StageSubscription(None, 2, loop)
+    >>> subscription.feed(0, b'abc')
+    >>> subscription.feed(3, b'def')
+    >>> subscription.feed(6, b'ghi')
+    >>> subscription.end()
+    >>> subscription.queue.get_nowait()
+    (3, b'def')
+    >>> subscription.queue.get_nowait()
+    >>> loop.close()
+    """
+    def __init__(self, broadcaster, maxsize, loop):
+        self.broadcaster = broadcaster
+        self.queue = asyncio.Queue(maxsize, loop=loop)
+
+    def feed(self, offset, data):
+        """ Queue a chunk, unless the follower is too far behind """
+        try:
+            self.queue.put_nowait((offset, data))
+        except asyncio.QueueFull:
+            pass
+
+    def end(self):
+        """ Queue the end marker, making room for it if needed """
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+
+class StageBroadcaster(object):
+    """
+    Single reader of new data for a followed stage. The reader wakes on
+    append notifications, reads new data once, and fans it out to every
+    subscription. When the events carry all of the new data, it's sent
+    without reading the log at all. It never waits on subscribers, so slow
+    followers can't hold back fast ones. When no data has arrived for the
+    follow timeout, all subscriptions are ended. When the last subscription
+    leaves, the reader is stopped
+    """
+    def __init__(self, app, key, log_path):
+        self.app = app
+        self.key = key
+        self.log_path = log_path
+        self.offset = None
+        self._subscriptions = set()
+        self._waiter = StageWaiter(app.notify, key, app.loop)
+        self._task = app.loop.create_task(self._pump())
+
+    @classmethod
+    def for_stage(cls, app, key, log_path):
+        """ Get the running broadcaster for a stage, or start one """
+        try:
+            return app.broadcasters[key]
+        except KeyError:
+            broadcaster = app.broadcasters[key] = cls(app, key, log_path)
+            return broadcaster
+
+    def subscribe(self):
+        """ Add a new subscription """
+        subscription = StageSubscription(
+            self, self.app.follow_queue_size, self.app.loop,
+        )
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Remove a subscription, stopping if it was the last one """
+        self._subscriptions.discard(subscription)
+        if not self._subscriptions:
+            self._task.cancel()
+
+    def _feed(self, data):
+        """ Send data at the current offset to all subscriptions """
+        for subscription in self._subscriptions:
+            subscription.feed(self.offset, data)
+        self.offset += len(data)
+
+    def _feed_events(self, events):
+        """
+        Send new data carried by append events. Returns ``False`` if some
+        new data wasn't carried, and must be read from the log, or if the
+        stage was finalized
+        """
+        for event, payload in events:
+            size = event.get('size')
+            if size is None or size <= self.offset:
+                continue
+            start = size - len(payload)
+            if start > self.offset:
+                return False
+            self._feed(payload[self.offset - start:])
+        return not any(event.get('event') == 'finalize' for event, _ in events)
+
+    def _read_chunk(self, handle):
+        """ Read the next chunk of new data """
+        handle.seek(self.offset)
+        return handle.read(READ_CHUNK_SIZE)
+
+    @asyncio.coroutine
+    def _pump(self):
+        """
+        Read new data as it's appended, and send it to subscribers. Once the
+        stage is finalized, the rest of the log is read, and subscriptions
+        are ended. If anything fails, even opening the log, subscriptions
+        are ended too, and the broadcaster is removed so that new followers
+        start another
+        """
+        loop = self.app.loop
+        executor = self.app.executor
+        handle = None
+        try:
+            handle = yield from loop.run_in_executor(
+                executor, self.log_path.open, 'rb',
+            )
+            self.offset = yield from loop.run_in_executor(
+                executor, handle.seek, 0, 2,
+            )
+            final = yield from loop.run_in_executor(
+                executor, load_final, self.log_path,
+            )
+            finalized = final is not None and final.get('size') == self.offset
+            while not finalized and (
+                    (yield from self._waiter.wait(self.app.follow_timeout))
+            ):
+                events = self._waiter.pop_events()
+                finalized = any(
+                    event.get('event') == 'finalize' for event, _ in events
+                )
+                if self._feed_events(events):
+                    continue
+
+                while True:
+                    data = yield from loop.run_in_executor(
+                        executor, self._read_chunk, handle,
+                    )
+                    if not data:
+                        break
+                    self._feed(data)
+
+        finally:
+            if self.app.broadcasters.get(self.key) is self:
+                del self.app.broadcasters[self.key]
+            self._waiter.close()
+            for subscription in self._subscriptions:
+                subscription.end()
+            if handle is not None:
+                yield from loop.run_in_executor(executor, handle.close)
+
+
+@asyncio.coroutine
+def follow_log(  # pylint:disable=too-many-arguments
+        request, response, flow, log_path, subscription, offset,
+):
+    """
+    Stream data appended to the log after ``offset`` from the stage's
+    broadcaster. Gaps left by chunks dropped while this client was slow are
+    read from disk. When the broadcaster ends, the log is read to EOF
+    """
+    # Data the broadcaster read before this client caught up to it
+    caught_up = subscription.broadcaster.offset
+    if caught_up is not None and caught_up > offset:
+        yield from stream_file(
+            request, response, flow, log_path, offset, caught_up,
+        )
+        offset = caught_up
+
+    while True:
+        item = yield from subscription.queue.get()
+        if item is None:
+            yield from stream_file(request, response, flow, log_path, offset)
+            return
+
+        chunk_offset, data = item
+        if chunk_offset > offset:
+            yield from stream_file(
+                request, response, flow, log_path, offset, chunk_offset,
+            )
+            offset = chunk_offset
+
+        data = data[offset - chunk_offset:]
+        if data:
+            offset += len(data)
+            yield from write_data(response, flow, data)
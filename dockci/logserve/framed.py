@@ -0,0 +1,168 @@
+"""
+Framed log responses: the log is sent in records with JSON headers, which
+carry cursors that clients resume the log from
+"""
+import asyncio
+import base64
+import json
+import struct
+import zlib
+
+from .index import LineIndex
+from .logs import log_range
+from .scan import count_newlines
+
+
+# Length of the JSON header before each record of a framed log response
+FRAME_HEADER = struct.Struct('>I')
+# Checksum of the stage key, offset, and line number in a resume cursor
+CURSOR = struct.Struct('>IQQ')
+
+
+def _key_checksum(key):
+    """ Checksum of a stage key, so that cursors only resume their stage """
+    return zlib.crc32('/'.join(key).encode())
+
+
+def encode_cursor(key, offset, line):
+    """
+    Opaque token that resumes a stage log at ``offset``, which is in line
+    number ``line``
+
+    Examples:
+
+    >>> encode_cursor(('p', 'j', 's'), 1234, 56)
+    'WfH-pwAAAAAAAATSAAAAAAAAADg'
+    """
+    return base64.urlsafe_b64encode(
+        CURSOR.pack(_key_checksum(key), offset, line)
+    ).decode().rstrip('=')
+
+
+def decode_cursor(key, cursor):
+    """
+    ``(offset, line)`` of a cursor for a stage. Raises ``ValueError`` if
+    the cursor isn't valid, or is for another stage
+
+    Examples:
+
+    >>> cursor = encode_cursor(('p', 'j', 's'), 1234, 56)
+    >>> decode_cursor(('p', 'j', 's'), cursor)
+    (1234, 56)
+    >>> decode_cursor(('p', 'j', 'other'), cursor)
+    Traceback (most recent call last):
+      ...
+    ValueError: Cursor is for another stage
+    >>> decode_cursor(('p', 'j', 's'), 'abc')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid cursor
+    """
+    try:
+        checksum, offset, line = CURSOR.unpack(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)
+        ))
+    except (ValueError, struct.error):
+        raise ValueError("Invalid cursor")
+    if checksum != _key_checksum(key):
+        raise ValueError("Cursor is for another stage")
+    return offset, line
+
+
+class FramedStream(object):
+    """
+    Stands in for the response when a log is sent in records, so that
+    clients can resume it where they left off. Each record is a
+    ``FRAME_HEADER`` with the length of a JSON header, the header, then
+    ``length`` bytes of the log. Headers have the ``offset`` of the data in
+    the log, the number of the ``line`` it starts in, and a ``cursor`` that
+    resumes the log after it. The last record has no data, and ``end`` set
+
+    Examples:
+
+    >>> class Response(object):
+    ...     def write(self, data):
+    ...         size = FRAME_HEADER.unpack(data[:FRAME_HEADER.size])[0]
+    ...         data = data[FRAME_HEADER.size:]
+    ...         header = json.loads(data[:size].decode())
+    ...         print(header['offset'], header['line'], header['length'],
+    ...               header.get('end', False), data[size:])
+    >>> stream = FramedStream(Response(), ('p', 'j', 's'), 10, 2)
+    >>> stream.write(b'a\\nb')
+    10 2 3 False b'a\\nb'
+    >>> stream.write(b'c\\n')
+    13 3 2 False b'c\\n'
+    >>> stream.end()
+    15 4 0 True b''
+    >>> decode_cursor(('p', 'j', 's'), stream.cursor)
+    (15, 4)
+    """
+    def __init__(self, response, key, offset, line):
+        self.response = response
+        self.key = key
+        self.offset = offset
+        self.line = line
+
+    @property
+    def cursor(self):
+        """ Cursor that resumes the log after the data sent so far """
+        return encode_cursor(self.key, self.offset, self.line)
+
+    def _send(self, header, data=b''):
+        """ Send a record """
+        header = json.dumps(header, sort_keys=True).encode()
+        self.response.write(FRAME_HEADER.pack(len(header)) + header + data)
+
+    def write(self, data):
+        """ Send a record of log data """
+        offset, line = self.offset, self.line
+        self.offset += len(data)
+        self.line += data.count(b'\n')
+        self._send({
+            'offset': offset, 'line': line, 'length': len(data),
+            'cursor': self.cursor,
+        }, data)
+
+    @asyncio.coroutine
+    def drain(self):
+        """ Wait until the response is drained """
+        yield from self.response.drain()
+
+    def end(self):
+        """ Send the last record """
+        self._send({
+            'offset': self.offset, 'line': self.line, 'length': 0,
+            'cursor': self.cursor, 'end': True,
+        })
+
+
+def line_range(log_path, handle,  # pylint:disable=too-many-arguments
+               byte_seek, line_seek, bytes_count, lines_count, line=None):
+    """
+    Resolve seek and count params to a byte range like ``log_range``, and
+    the number of the line it starts in, as ``(start, end, line)``. When
+    ``line`` is given, it's the line at ``byte_seek``, from a cursor, so
+    nothing is read to find it
+
+    Examples:
+
+    >>> tmp_file = getfixture('tmpdir').join('stage')
+    >>> tmp_file.write('abc\\ndef\\nghi\\n')
+    >>> handle = tmp_file.open('rb')
+    >>> line_range(tmp_file, handle, None, -2, None, None)
+    (8, 12, 2)
+    >>> line_range(tmp_file, handle, 5, None, 2, None)
+    (5, 7, 1)
+    >>> line_range(tmp_file, handle, 5, None, None, None, line=7)
+    (5, 12, 7)
+    """
+    start, end = log_range(
+        log_path, handle, byte_seek, line_seek, bytes_count, lines_count,
+    )
+    if line is None:
+        index = LineIndex.for_log(log_path, handle)
+        if index is None:
+            line = count_newlines(handle, 0, start)
+        else:
+            line = index.line_at(handle, start)
+    return start, end, line
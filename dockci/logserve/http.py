@@ -1,391 +1,765 @@
 """ Setup and run the DockCI log server API server """
 import asyncio
+import collections
 import concurrent
+import functools
+import multiprocessing
+import os
+import signal
+import time
 
 import py
 
 from aiohttp import web
 
-from .util import run_wrapper
+from .aiofile import run_io
+from .api import instrumented, json_response, qs_ranges, try_qs_int
+from .archive import fstat_log, open_log
+from .batch import handle_log_batch
+from .encoding import (
+    accepts_gzip, open_variant, variant_path, GzipCache, GzipStreamResponse,
+)
+from .flow import ByteBudget
+from .follow import follow_log, StageBroadcaster
+from .framed import decode_cursor, line_range, FramedStream
+from .index import LineIndex
+from .logs import (
+    find_log, job_stage_slugs, log_range, resolve_log, response_flow,
+    send_range, write_data,
+)
+from .meta import MetaIndex, PathCache, StageMeta
+from .metrics import (
+    health_from_env, serve_metrics, Gauge, REGISTRY, CONTENT_TYPE,
+)
+from .notify import Listener, Notifier
+from .search import DEFAULT_SEGMENT_SIZE
+from .search_http import handle_search
+from .tail import TailCache
+from .util import env_float, env_int, run_wrapper
+from .validators import (
+    byte_range, entity_tag, if_range, not_modified, set_validators,
+)
+from .ws import handle_log_ws
 
 
 APP = web.Application()
+APP.broadcasters = {}
+APP.notifier = None
+LOG_FORMATS = ('raw', 'framed')
+
+# Seek, and count params of a ``log_init`` request, whether it's sent in
+# framed records, the line number at the seek if it's known, and whether
+# it's followed
+LogQuery = collections.namedtuple(
+    'LogQuery', ['ranges', 'framed', 'line', 'follow'],
+)
 
+FOLLOWED_STAGES = Gauge(
+    'logserve_http_followed_stages', 'Stages being read for followers.',
+)
+FOLLOWED_STAGES.set_function(lambda: len(APP.broadcasters))
+BYTES_IN_FLIGHT = Gauge(
+    'logserve_http_bytes_in_flight',
+    'Log data written to clients, and not yet drained.',
+)
+BYTES_IN_FLIGHT.set_function(lambda: APP.flow_budget.in_flight)
 
-@run_wrapper('http')
-def run(logger, *_):
-    """ Run the HTTP API server """
-    APP.logger = logger
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        APP.executor = executor
-        web.run_app(APP)
+def _share(total, workers):
+    """
+    Each worker's share of a budget, rounded up
 
+    Examples:
 
-@asyncio.coroutine
-def handle_health(_):
-    """ API health check """
-    return web.Response(body='{"message": "Not Implemented"}'.encode())
+    >>> _share(10, 1), _share(10, 4), _share(2, 4)
+    (10, 3, 1)
+    """
+    return max(-(-total // workers), 1)
 
 
-APP.router.add_route('GET', '/_healthz', handle_health)
+def setup(logger, workers=1):
+    """ Configure the app from the environment, and start listening for
+    stage events. The file I/O, and search executors are shared out between
+    ``workers`` processes. With more than one, events about cached gzipped
+    copies are published, so that every worker counts them """
+    APP.logger = logger
+    APP.host = os.environ.get('LOGSERVE_HTTP_HOST', '0.0.0.0')
+    APP.port = env_int('LOGSERVE_HTTP_PORT', 8080)
+    APP.stop_timeout = env_float('LOGSERVE_STOP_TIMEOUT', 10)
+    APP.io_workers = _share(env_int('LOGSERVE_IO_WORKERS', 10), workers)
+    APP.follow_timeout = env_float('LOGSERVE_FOLLOW_TIMEOUT', 60)
+    APP.follow_queue_size = env_int('LOGSERVE_FOLLOW_QUEUE', 16)
+    APP.chunk_min = env_int('LOGSERVE_CHUNK_MIN', 16 * 1024)
+    APP.chunk_max = env_int('LOGSERVE_CHUNK_MAX', 1024 * 1024)
+    APP.chunk_target = env_float('LOGSERVE_CHUNK_TARGET', 0.1)
+    APP.write_buffer_high = env_int('LOGSERVE_WRITE_BUFFER', 256 * 1024)
+    APP.stall_timeout = env_float('LOGSERVE_STALL_TIMEOUT', 60) or None
+    APP.flow_budget = ByteBudget(_share(env_int(
+        'LOGSERVE_MAX_IN_FLIGHT', 256 * 1024 * 1024,
+    ), workers), APP.loop)
+    APP.tail_cache = TailCache(
+        stage_size=env_int('LOGSERVE_TAIL_SIZE', 64 * 1024),
+        max_size=env_int('LOGSERVE_TAIL_CACHE_SIZE', 64 * 1024 * 1024),
+    )
+    APP.gzip_cache = GzipCache(
+        max_size=env_int('LOGSERVE_GZIP_CACHE_SIZE', 1024 * 1024 * 1024),
+        min_size=env_int('LOGSERVE_GZIP_MIN_SIZE', 4096),
+        compresslevel=env_int('LOGSERVE_GZIP_LEVEL', 6),
+    )
+    APP.meta = MetaIndex(
+        ttl=env_float('LOGSERVE_META_TTL', 30),
+        max_stages=env_int('LOGSERVE_META_STAGES', 100000),
+    )
+    APP.path_cache = PathCache(
+        ttl=env_float('LOGSERVE_PATH_TTL', 1),
+        negative_ttl=env_float('LOGSERVE_PATH_NEGATIVE_TTL', 1),
+        final_ttl=env_float('LOGSERVE_PATH_FINAL_TTL', 300),
+        max_entries=env_int('LOGSERVE_PATH_CACHE_SIZE', 100000),
+    )
+    APP.ws_credit = env_int('LOGSERVE_WS_CREDIT', 256 * 1024)
+    APP.ws_max_streams = env_int('LOGSERVE_WS_STREAMS', 64)
+    APP.batch_max_stages = env_int('LOGSERVE_BATCH_STAGES', 100)
+    APP.search_workers = _share(env_int(
+        'LOGSERVE_SEARCH_WORKERS', os.cpu_count() or 1,
+    ), workers)
+    APP.search_max_results = env_int('LOGSERVE_SEARCH_MAX_RESULTS', 1000)
+    APP.search_max_context = env_int('LOGSERVE_SEARCH_MAX_CONTEXT', 10)
+    APP.search_max_jobs = env_int('LOGSERVE_SEARCH_MAX_JOBS', 50)
+    APP.search_timeout = env_float('LOGSERVE_SEARCH_TIMEOUT', 30)
+    APP.search_segment_size = env_int(
+        'LOGSERVE_SEARCH_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE,
+    )
+    APP.consumer_health = health_from_env()
+    APP.require_consumer = bool(env_int('LOGSERVE_HEALTH_CONSUMER', 1))
+    APP.notify = Listener(APP.loop)
+    APP.notify.subscribe(None, APP.consumer_health.on_event)
+    APP.notify.subscribe(None, APP.path_cache.on_event)
+    APP.notify.subscribe(None, APP.tail_cache.on_event)
+    APP.notify.subscribe(None, APP.meta.on_event)
+    APP.notify.subscribe(None, APP.gzip_cache.on_event)
+    APP.notify.start()
+    if workers > 1:
+        APP.notifier = Notifier()
+
+
+def serve(reuse_port=False):
+    """
+    Serve the app until it's stopped. With ``reuse_port``, other processes
+    can listen on the same port, and the kernel shares connections between
+    them. When stopping, open requests get ``LOGSERVE_STOP_TIMEOUT`` seconds
+    to finish
+    """
+    loop = APP.loop
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=APP.io_workers,
+        ) as executor, concurrent.futures.ProcessPoolExecutor(
+            max_workers=APP.search_workers,
+        ) as search_executor:
+            APP.executor = executor
+            APP.search_executor = search_executor
+
+            handler = APP.make_handler()
+            server = loop.run_until_complete(loop.create_server(
+                handler, APP.host, APP.port, reuse_port=reuse_port,
+            ))
+            APP.logger.info('Listening on %s:%s', APP.host, APP.port)
+            try:
+                loop.run_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+                loop.run_until_complete(APP.shutdown())
+                loop.run_until_complete(
+                    handler.finish_connections(APP.stop_timeout),
+                )
+                loop.run_until_complete(APP.cleanup())
+
+    finally:
+        APP.notify.stop()
+        if APP.notifier is not None:
+            APP.notifier.close()
+
+
+def _run_worker(logger, _, workers=1, worker=None):
+    """ Run the HTTP API server in this process. Workers also serve their
+    own metrics on the ports from ``LOGSERVE_HTTP_METRICS_PORT`` (0 to turn
+    them off), since a request to the shared port reaches any of them """
+    setup(logger, workers)
+    if worker is not None:
+        metrics_port = env_int('LOGSERVE_HTTP_METRICS_PORT', 9200)
+        if metrics_port:
+            serve_metrics(metrics_port + worker)
+    serve(reuse_port=workers > 1)
+
+
+def run_worker(worker, workers):
+    """ Run an HTTP API server worker process """
+    run_wrapper('http.%s' % worker)(functools.partial(
+        _run_worker, workers=workers, worker=worker,
+    ))()
 
 
-def _reader_bytes(handle, count=None, chunk_size=1024):
+@run_wrapper('http')
+def run(logger, add_stop_handler):
     """
-    Read a given number of bytes
+    Run the HTTP API server. If ``LOGSERVE_HTTP_WORKERS`` is more than 1,
+    that many worker processes are started, each with its own event loop,
+    listening on the same port with ``SO_REUSEPORT``. Each worker has its
+    own caches, kept current by stage events to its own listener socket
+    """
+    workers = env_int('LOGSERVE_HTTP_WORKERS', 1)
+    if workers <= 1:
+        _run_worker(logger, add_stop_handler)
+        return
+
+    # Spawned, not forked, so that workers don't share the event loop's
+    # selector, and wake up socket that were made when this was imported
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(
+            target=run_worker, args=(worker, workers),
+            name='http.%s' % worker,
+        )
+        for worker in range(workers)
+    ]
+
+    def stop_workers():
+        """ Stop all workers, giving them time to finish open requests,
+        and wait for them to exit """
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + env_float('LOGSERVE_STOP_TIMEOUT', 10)
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0) + 5)
+            if process.is_alive():
+                logger.warning('Killing %s', process.name)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+    add_stop_handler(stop_workers)
+    logger.info('Starting %s HTTP workers', workers)
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
-    Examples:
 
-    >>> tmp_dir = getfixture('tmpdir')
-    >>> tmp_file = tmp_dir.join('test')
-    >>> tmp_file.write('abcdefghi')
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(4)
-    4
-    >>> list(_reader_bytes(handle, 2))
-    ['ef']
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(4)
-    4
-    >>> list(_reader_bytes(handle, chunk_size=3))
-    ['efg', 'hi']
+@asyncio.coroutine
+def handle_health(request):
     """
-    remain = count
-    while remain is None or remain > 0:
-        if remain is not None:
-            chunk_size = min(chunk_size, remain)
+    API health check. The server is healthy if the consumers that have
+    published events recently are consuming, and keeping up with their
+    queues. Unless ``LOGSERVE_HEALTH_CONSUMER`` is 0, at least one consumer
+    must have been heard from
+    """
+    healthy, consumers = request.app.consumer_health.check()
+    if not consumers and not request.app.require_consumer:
+        healthy = True
+    return json_response({
+        'status': 'ok' if healthy else 'unhealthy',
+        'consumers': consumers,
+    }, 200 if healthy else 503)
+
+
+APP.router.add_route('GET', '/_healthz', handle_health)
 
-        data = handle.read(chunk_size)
 
-        if remain is not None:
-            remain -= len(data)
+@asyncio.coroutine
+def handle_metrics(_):
+    """ Metrics of this process, in the Prometheus text format """
+    return web.Response(
+        body=REGISTRY.render().encode(),
+        headers={'content-type': CONTENT_TYPE},
+    )
 
-        if len(data) == 0:
-            return
 
-        yield data
+APP.router.add_route('GET', '/_metrics', handle_metrics)
 
 
-def _reader_lines(handle, count=None):
+@asyncio.coroutine
+def _send_tail(request, response, flow,  # pylint:disable=too-many-arguments
+               key, size, fixed_length, ranges):
+    """
+    Send the requested range from the tail cache, if the seek is from the end
+    of the log, and the range is in the cached window. Returns the offset
+    that was sent up to, or ``None`` if nothing was sent
     """
-    Read a given number of lines
+    byte_seek, line_seek = ranges[:2]
+    if (byte_seek or 0) >= 0 and (line_seek or 0) >= 0:
+        return None
 
-    Examples:
+    tail = request.app.tail_cache.get(key, size)
+    if tail is None:
+        return None
 
-    >>> tmp_dir = getfixture('tmpdir')
-    >>> tmp_file = tmp_dir.join('test')
-    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(4)
-    4
-    >>> list(_reader_lines(handle, 2))
-    ['def\\n', 'ghi\\n']
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(8)
-    8
-    >>> list(_reader_lines(handle))
-    ['ghi\\n', 'jkl\\n', 'mno']
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(5)
-    5
-    >>> list(_reader_lines(handle, 1))
-    ['ef\\n']
-
-    >>> tmp_file.write('abc\\n\\ndef\\n')
-    >>> handle = tmp_file.open()
-    >>> list(_reader_lines(handle))
-    ['abc\\n', '\\n', 'def\\n', '']
-
-    >>> handle = tmp_file.open('rb')
-    >>> list(_reader_lines(handle))
-    [b'abc\\n', b'\\n', b'def\\n', b'']
-    """
-    remain = count
-    while remain is None or remain > 0:
-        data = handle.readline()
+    cached = tail.log_range(*ranges)
+    if cached is None:
+        return None
 
-        if remain is not None:
-            remain -= 1
+    start, end = cached
+    data = tail.read(start, end)
+    if fixed_length:
+        response.content_length = end - start
+    yield from response.prepare(request)
+    yield from write_data(response, flow, data)
+    return end
 
-        yield data
 
-        search_char = b'\n' if isinstance(data, bytes) else '\n'
-        if search_char not in data:
-            return
+@asyncio.coroutine
+def _send_log(request, response, flow,  # pylint:disable=too-many-arguments
+              key, log_path, handle, size, ranges, subscription):
+    """
+    Prepare the response, send the requested range of the first ``size``
+    bytes of the log from ``handle``, closing it, then any data followed
+    with ``subscription``. Unless the response is encoded, or followed, it
+    has a content length, and can be sent with ``sendfile``
+    """
+    fixed_length = (
+        subscription is None and
+        not isinstance(response, GzipStreamResponse)
+    )
+    try:
+        end = yield from _send_tail(
+            request, response, flow, key, size, fixed_length, ranges,
+        )
+        if end is None:
+            start, end = yield from run_io(
+                request, log_range, log_path, handle, *(ranges + (size,))
+            )
+            if fixed_length:
+                response.content_length = end - start
+            yield from response.prepare(request)
+            yield from send_range(
+                request, response, flow, handle, start, end, fixed_length,
+            )
+
+    finally:
+        yield from run_io(request, handle.close)
+
+    if subscription is not None:
+        yield from follow_log(
+            request, response, flow, log_path, subscription, end,
+        )
 
 
-def _seeker_bytes(handle, seek):
+@asyncio.coroutine
+def _send_framed(request, response, flow,  # pylint:disable=too-many-arguments
+                 key, log_path, handle, ranges, line, subscription):
     """
-    Seek ahead in handle by the given number of bytes. If ``seek`` is
-    negative, seeks that number of bytes from the end of the file
+    Prepare the response, and send the requested range of the log from
+    ``handle`` in ``FramedStream`` records, closing it, then any data
+    followed, then the last record with the cursor to resume from
+    """
+    try:
+        start, end, line = yield from run_io(
+            request, line_range, log_path, handle, *(ranges + (line,))
+        )
+        yield from response.prepare(request)
+        stream = FramedStream(response, key, start, line)
+        yield from send_range(
+            request, stream, flow, handle, start, end, sendfile=False,
+        )
 
-    Examples:
+    finally:
+        yield from run_io(request, handle.close)
 
-    >>> tmp_dir = getfixture('tmpdir')
-    >>> tmp_file = tmp_dir.join('test')
-    >>> tmp_file.write('abcdefghi')
+    if subscription is not None:
+        yield from follow_log(
+            request, stream, flow, log_path, subscription, end,
+        )
+    stream.end()
 
-    >>> handle = tmp_file.open()
-    >>> _seeker_bytes(handle, 3)
-    >>> handle.read(1)
-    'd'
 
-    >>> handle = tmp_file.open()
-    >>> _seeker_bytes(handle, -3)
-    >>> handle.read(1)
-    'g'
+def _log_query(request, key):
     """
-    if seek >= 0:
-        handle.seek(seek)
-    else:
-        handle.seek(0, 2)
-        file_size = handle.tell()
-        handle.seek(file_size + seek)  # seek is negative
+    ``LogQuery`` of a ``log_init`` request. When it resumes from a cursor,
+    the seek is the cursor's offset, and the line number at it is known.
+    Raises ``ValueError`` if the params aren't valid
+    """
+    ranges = qs_ranges(request)
+    log_format = request.GET.get('format', 'raw')
+    if log_format not in LOG_FORMATS:
+        raise ValueError("Unknown format: %s" % log_format)
+    framed = log_format == 'framed'
+
+    # Follow only makes sense when reading to the end of the log
+    follow = bool(
+        try_qs_int(request, 'follow') and
+        ranges[2] is None and ranges[3] is None
+    )
 
+    cursor = request.GET.get('cursor')
+    if cursor is None:
+        return LogQuery(ranges, framed, None, follow)
+    if ranges[0] is not None or ranges[1] is not None:
+        raise ValueError("cursor can't be combined with seeks")
+    offset, line = decode_cursor(key, cursor)
+    return LogQuery((offset,) + ranges[1:], framed, line, follow)
 
-def _seeker_lines(handle, seek):
+
+def _log_mode(request):
     """
-    Seek ahead in handle by the given number of lines
+    How a ``log_init`` request selects data, for metrics: ``follow``,
+    ``cursor`` to resume, ``range`` for a ``Range`` header, ``tail`` for
+    seeks from the end, ``lines``, or ``bytes`` for other seeks, and counts,
+    or ``whole``
 
     Examples:
 
-    >>> tmp_dir = getfixture('tmpdir')
-    >>> tmp_file = tmp_dir.join('test')
-    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
-
-    >>> handle = tmp_file.open()
-    >>> _seeker_lines(handle, 3)
-    >>> handle.read(1)
-    'j'
-
-    >>> handle = tmp_file.open()
-    >>> _seeker_lines(handle, -1)
-    >>> handle.read(3)
-    'mno'
-
-    >>> handle = tmp_file.open()
-    >>> _seeker_lines(handle, -3)
-    >>> handle.read(1)
-    'g'
-
-    >>> handle = tmp_file.open()
-    >>> _seeker_lines(handle, -20)
-    >>> handle.read(3)
-    'abc'
-
-    >>> handle = tmp_file.open('rb')
-    >>> _seeker_lines(handle, -20)
-    >>> handle.read(3)
-    b'abc'
+    >>> class Request(object):
+    ...     def __init__(self, query, headers=None):
+    ...         self.GET = query
+    ...         self.headers = headers or {}
+    >>> _log_mode(Request({'follow': '1', 'seek_lines': '-10'}))
+    'follow'
+    >>> _log_mode(Request({'follow': '0', 'seek_lines': '-10'}))
+    'tail'
+    >>> _log_mode(Request({'cursor': 'abc', 'count_lines': '10'}))
+    'cursor'
+    >>> _log_mode(Request({'seek_lines': '10', 'count': '5'}))
+    'lines'
+    >>> _log_mode(Request({'count': '5'}))
+    'bytes'
+    >>> _log_mode(Request({}, {'Range': 'bytes=0-1'}))
+    'range'
+    >>> _log_mode(Request({'seek': 'null'}))
+    'whole'
     """
-    if seek >= 0:
-        for _ in range(seek):
-            _seeker_lines_one_ahead(handle)
-    else:
-        handle.seek(0, 2)
-        seek = seek * -1
-        for idx in range(seek):
-            current_pos = _seeker_lines_one_back(handle)
-
-            if current_pos == 0:
-                return
+    def given(key):
+        """ Whether a query arg has a value """
+        return request.GET.get(key) not in (None, 'None', 'null', '')
+
+    if given('follow') and request.GET['follow'] != '0':
+        return 'follow'
+    if given('cursor'):
+        return 'cursor'
+    for key in ('seek', 'seek_lines'):
+        if given(key) and request.GET[key].startswith('-'):
+            return 'tail'
+    if given('seek_lines') or given('count_lines'):
+        return 'lines'
+    if given('seek') or given('count'):
+        return 'bytes'
+    if request.headers.get('Range') is not None:
+        return 'range'
+    return 'whole'
+
+
+def _log_response(request, framed, partial):
+    """
+    Response for a log, and its content coding: gzip if the client accepts
+    it, or ``None``. Byte ranges are of the log itself, so they're always
+    sent unencoded
+    """
+    headers = {
+        'content-type': 'application/octet-stream' if framed else 'text/plain',
+        'accept-ranges': 'none' if framed else 'bytes',
+        'vary': 'Accept-Encoding',
+    }
+    if (
+        accepts_gzip(request.headers.get('Accept-Encoding')) and
+        (partial or request.headers.get('Range') is None)
+    ):
+        return GzipStreamResponse(
+            status=200, headers=headers,
+            compresslevel=request.app.gzip_cache.compresslevel,
+        ), 'gzip'
+    return web.StreamResponse(status=200, headers=headers), None
+
+
+def _negotiate(request, response,  # pylint:disable=too-many-arguments
+               stat, final, encoding, partial):
+    """
+    Add cache validators to the response, and apply a ``Range`` header to
+    it, unless the request is ``partial`` already. Returns a response to
+    send instead, if the client's copy is current, or the range can't be
+    satisfied, and the ``(start, end)`` of the range to send, or ``None``
+    """
+    etag = entity_tag(stat, encoding, weak=encoding is not None)
+    if not_modified(request, etag, stat.mtime):
+        unchanged = web.Response(status=304, headers={
+            'vary': 'Accept-Encoding',
+        })
+        set_validators(unchanged, etag, stat.mtime, final)
+        return unchanged, None
+    set_validators(response, etag, stat.mtime, final)
+
+    range_header = request.headers.get('Range')
+    if (
+        range_header is None or partial or
+        not if_range(request, etag, stat.mtime)
+    ):
+        return None, None
 
-            # unless last iter, seek back 1 for the new line
-            if idx + 1 < seek:
-                handle.seek(current_pos - 1)
+    try:
+        requested = byte_range(range_header, stat.size)
+    except ValueError:
+        return web.Response(status=416, headers={
+            'content-range': 'bytes */%d' % stat.size,
+        }), None
+
+    if requested is not None:
+        start, end = requested
+        response.set_status(206)
+        response.headers['content-range'] = 'bytes %d-%d/%d' % (
+            start, end - 1, stat.size,
+        )
+    return None, requested
 
 
-def _seeker_lines_one_ahead(handle):
+@asyncio.coroutine
+def _send_cached_variant(request, response, key, log_path, stat):
+    """
+    Send a whole final log from its gzipped copy, if there is one, or start
+    writing the copy if there isn't. Returns the response that was sent, or
+    ``None``
     """
-    Seek ahead in handle by 1 line
+    gzip_cache = request.app.gzip_cache
+    if not gzip_cache.wanted(stat.size):
+        return None
 
-    Examples:
+    path = variant_path(log_path, key[2])
+    variant = yield from run_io(request, open_variant, path, stat.mtime_ns)
+    if variant is None:
+        gzip_cache.start_write(request.app, log_path, path, stat.mtime_ns)
+        return None
 
-    >>> tmp_dir = getfixture('tmpdir')
-    >>> tmp_file = tmp_dir.join('test')
-    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(10)
-    10
-    >>> _seeker_lines_one_ahead(handle)
-    >>> handle.read(3)
-    'jkl'
-    >>>
-    """
-    while handle.read(1) not in ('\n', b'\n', None, '', b''):
-        pass
+    # The copy is the same bytes every time, so it has a strong tag
+    response = web.StreamResponse(status=200, headers=response.headers)
+    response.headers['etag'] = entity_tag(stat, 'gzip')
+    handle, size = variant
+    try:
+        response.content_length = size
+        yield from response.prepare(request)
+        flow = response_flow(request, response)
+        yield from send_range(request, response, flow, handle, 0, size)
 
+    finally:
+        yield from run_io(request, handle.close)
 
-def _seeker_lines_one_back(handle):
-    """
-    Seek back in handle by 1 line
+    yield from gzip_cache.record(request.app, path, size)
+    return response
 
-    Examples:
 
-    >>> tmp_dir = getfixture('tmpdir')
-    >>> tmp_file = tmp_dir.join('test')
-    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
-
-    >>> handle = tmp_file.open()
-    >>> handle.seek(10)
-    10
-    >>> _seeker_lines_one_back(handle)
-    8
-    >>> handle.read(3)
-    'ghi'
-
-    >>> handle = tmp_file.open()
-    >>> _seeker_lines_one_back(handle)
-    0
-    >>> handle.read(3)
-    'abc'
+@asyncio.coroutine
+def _stream_log(request, response,  # pylint:disable=too-many-arguments
+                key, log_path, handle, size, query, follow):
+    """
+    Send the requested range of the log from ``handle``, as it is, or in
+    framed records, then data appended after it, if it's followed
     """
-    first = True
-    current_pos = handle.tell()
-    while first or handle.read(1) not in ('\n', b'\n', None, '', b''):
-        first = False
-        current_pos -= 1
+    subscription = None
+    if follow:
+        # Subscribe before the range is resolved, so no appends are missed
+        broadcaster = StageBroadcaster.for_stage(request.app, key, log_path)
+        subscription = broadcaster.subscribe()
 
-        if current_pos < 0:
-            handle.seek(0)
-            return 0
+    flow = response_flow(request, response)
+    try:
+        if query.framed:
+            yield from _send_framed(
+                request, response, flow, key, log_path, handle,
+                query.ranges, query.line, subscription,
+            )
+        else:
+            yield from _send_log(
+                request, response, flow, key, log_path, handle, size,
+                query.ranges, subscription,
+            )
 
-        handle.seek(current_pos)
+    finally:
+        if subscription is not None:
+            subscription.broadcaster.unsubscribe(subscription)
 
-    return current_pos + 1  # add 1 for the read
 
+@instrumented('log', _log_mode)
+@asyncio.coroutine
+def handle_log(request):
+    """ Handle streaming logs to a client """
+    params = request.match_info
+    key = (params['project_slug'], params['job_slug'], params['stage_slug'])
 
-def try_qs_int(request, key):
-    """
-    Try to get a query string arg, and parse it as an ``int``. Returns
-    ``None`` if the key doesn't exist, or if the value resolves to ``'None'``
+    found = yield from resolve_log(request, key)
+    if found is None:
+        return web.Response(status=404)
+    log_path, _, final = found
 
-    Examples:
+    try:
+        query = _log_query(request, key)
+    except ValueError as ex:
+        return web.Response(body=str(ex).encode(), status=400)
 
-    >>> from aiohttp import MultiDict
-    >>> class TestClass(object):
-    ...     pass
-    >>> request = TestClass()
+    # The path cache only says which file the log is in. Validators, and
+    # ranges are from the handle that's read, so they always match the body
+    try:
+        handle = yield from run_io(request, open_log, log_path)
+    except py.error.ENOENT:
+        return web.Response(status=404)
+    try:
+        stat = yield from run_io(request, fstat_log, handle)
+        if final is not None and final.get('size') != stat.size:
+            final = None
+
+        # Logs that are still being written can be followed
+        follow = query.follow and final is None
+        partial = any(value is not None for value in query.ranges)
+        response, encoding = _log_response(request, query.framed, partial)
+
+        # Followed responses keep changing, so they can't be validated, or
+        # cached. Framed responses are resumed with cursors instead
+        if not follow and not query.framed:
+            replacement, requested = _negotiate(
+                request, response, stat, final is not None, encoding, partial,
+            )
+            if replacement is not None:
+                return replacement
+            if requested is not None:
+                start, end = requested
+                query = query._replace(ranges=(start, None, end - start, None))
+
+        # Whole final logs are sent from a gzipped copy, once there is one
+        if (
+            encoding is not None and final is not None and
+            not partial and not query.framed
+        ):
+            sent = yield from _send_cached_variant(
+                request, response, key, log_path, stat,
+            )
+            if sent is not None:
+                return sent
+
+        yield from _stream_log(
+            request, response, key, log_path, handle, stat.size, query, follow,
+        )
+        return response
 
-    >>> request.GET = MultiDict([
-    ...     ('a', '1'),
-    ...     ('b', '2'),
-    ...     ('b', '3'),
-    ...     ('c', b'4'),
-    ...     ('d', 'None'),
-    ...     ('e', b'None'),
-    ...     ('f', 'null'),
-    ...     ('g', b'null'),
-    ... ])
+    finally:
+        if not handle.closed:
+            yield from run_io(request, handle.close)
 
-    >>> try_qs_int(request, 'a')
-    1
 
-    >>> try_qs_int(request, 'b')
-    2
+APP.router.add_route(
+    'GET',
+    '/projects/{project_slug}/jobs/{job_slug}/log_init/{stage_slug}',
+    handle_log,
+)
 
-    >>> try_qs_int(request, 'c')
-    4
 
-    >>> type(try_qs_int(request, 'no'))
-    <class 'NoneType'>
+def _load_meta(project_slug, job_slug, stage_slug):
+    """ Metadata for a stage from its log, or ``None`` if there isn't one """
+    found = find_log(project_slug, job_slug, stage_slug)
+    if found is None:
+        return None
 
-    >>> type(try_qs_int(request, 'd'))
-    <class 'NoneType'>
+    log_path, stat, final = found
+    if final is not None:
+        return StageMeta(stat.size, final['lines'], stat.mtime, True)
 
-    >>> type(try_qs_int(request, 'e'))
-    <class 'NoneType'>
+    with open_log(log_path) as handle:
+        index = LineIndex.for_log(log_path, handle)
+        if index is None:
+            index = LineIndex()
+            index.catch_up(handle, stat.size)
+    return StageMeta(index.size, index.lines, stat.mtime, False)
 
-    >>> type(try_qs_int(request, 'f'))
-    <class 'NoneType'>
 
-    >>> type(try_qs_int(request, 'g'))
-    <class 'NoneType'>
-    """
-    try:
-        value = request.GET[key]
-    except KeyError:
-        return None
-    else:
-        return (
-            None if value in ('None', b'None', 'null', b'null')
-            else int(value)
-        )
+def _load_job_meta(project_slug, job_slug, stage_slugs):
+    """ Metadata for some stages of a job from their logs """
+    return {
+        stage_slug: _load_meta(project_slug, job_slug, stage_slug)
+        for stage_slug in stage_slugs
+    }
 
 
+@instrumented('stage_meta')
 @asyncio.coroutine
-def handle_log(request):
-    """ Handle streaming logs to a client """
+def handle_stage_meta(request):
+    """ Size, line count, modification time, and final state of a stage """
     params = request.match_info
+    key = (params['project_slug'], params['job_slug'], params['stage_slug'])
 
-    log_dir = py.path.local('data').join(
-        params['project_slug'],
-        params['job_slug'],
-    )
-
-    # Handle .log ext for DockCI legacy data
-    log_path_bare = log_dir.join(params['stage_slug'])
-    log_path_ext = log_dir.join('%s.log' % params['stage_slug'])
+    meta = request.app.meta.get(key)
+    if meta is None:
+        meta = yield from run_io(request, _load_meta, *key)
+        if meta is None:
+            return json_response({'message': 'Stage not found'}, 404)
+        meta = request.app.meta.put(key, meta)
 
-    log_path = None
-    if log_path_bare.check():
-        log_path = log_path_bare
-    elif log_path_ext.check():
-        log_path = log_path_ext
+    # pylint:disable=protected-access
+    return json_response(meta._asdict())
 
-    if log_path is None:
-        return web.Response(status=404)
 
-    byte_seek = try_qs_int(request, 'seek')
-    line_seek = try_qs_int(request, 'seek_lines')
-    bytes_count = try_qs_int(request, 'count')
-    lines_count = try_qs_int(request, 'count_lines')
+@instrumented('job_meta')
+@asyncio.coroutine
+def handle_job_meta(request):
+    """ Metadata of every stage of a job, by stage slug """
+    params = request.match_info
+    project_slug, job_slug = params['project_slug'], params['job_slug']
+    meta_index = request.app.meta
 
-    if byte_seek and line_seek:
-        return web.Response(
-            body="byte_seek and line_seek are mutually exclusive".encode(),
-            status=400,
+    stage_slugs = meta_index.job_stages(project_slug, job_slug)
+    if stage_slugs is None:
+        stage_slugs = yield from run_io(
+            request, job_stage_slugs, project_slug, job_slug,
         )
-    if bytes_count and lines_count:
-        return web.Response(
-            body="bytes_count and lines_count are mutually exclusive".encode(),
-            status=400,
+        if stage_slugs is None:
+            return json_response({'message': 'Job not found'}, 404)
+        meta_index.put_job(project_slug, job_slug, stage_slugs)
+
+    stages = {
+        stage_slug: meta_index.get((project_slug, job_slug, stage_slug))
+        for stage_slug in stage_slugs
+    }
+    missing = [
+        stage_slug for stage_slug, meta in stages.items() if meta is None
+    ]
+    if missing:
+        loaded = yield from run_io(
+            request, _load_job_meta, project_slug, job_slug, missing,
         )
+        for stage_slug, meta in loaded.items():
+            if meta is None:
+                del stages[stage_slug]
+            else:
+                stages[stage_slug] = meta_index.put(
+                    (project_slug, job_slug, stage_slug), meta,
+                )
 
-    response = web.StreamResponse(status=200, headers={
-        'content-type': 'text/plain',
-    })
-    yield from response.prepare(request)
-
-    with log_path.open('rb') as handle:
-        if byte_seek is not None:
-            _seeker_bytes(handle, byte_seek)
-        if line_seek is not None:
-            _seeker_lines(handle, line_seek)
+    # pylint:disable=protected-access
+    return json_response({'stages': {
+        stage_slug: meta._asdict() for stage_slug, meta in stages.items()
+    }})
 
-        if bytes_count is not None:
-            gen = _reader_bytes(handle, bytes_count)
-        elif lines_count is not None:
-            gen = _reader_lines(handle, lines_count)
-        else:
-            gen = _reader_bytes(handle)
 
-        for data in gen:
-            response.write(data)
-            yield from response.drain()
-
-    return response
+APP.router.add_route(
+    'GET',
+    '/projects/{project_slug}/jobs/{job_slug}/stage/{stage_slug}/meta',
+    handle_stage_meta,
+)
+APP.router.add_route(
+    'GET', '/projects/{project_slug}/jobs/{job_slug}/meta', handle_job_meta,
+)
 
 
+APP.router.add_route('GET', '/log_ws', handle_log_ws)
+APP.router.add_route(
+    'GET', '/projects/{project_slug}/jobs/{job_slug}/log_batch',
+    handle_log_batch,
+)
+APP.router.add_route(
+    'POST', '/projects/{project_slug}/jobs/{job_slug}/log_batch',
+    handle_log_batch,
+)
 APP.router.add_route(
     'GET',
-    '/projects/{project_slug}/jobs/{job_slug}/log_init/{stage_slug}',
-    handle_log,
+    '/projects/{project_slug}/jobs/{job_slug}/stage/{stage_slug}/search',
+    handle_search,
+)
+APP.router.add_route(
+    'GET', '/projects/{project_slug}/jobs/{job_slug}/search', handle_search,
 )
+APP.router.add_route('GET', '/projects/{project_slug}/search', handle_search)
@@ -0,0 +1,370 @@
+""" Sidecar index of line offsets for stage logs """
+import array
+import bisect
+import os
+import struct
+import sys
+
+import py
+
+from .archive import is_archive
+from .scan import BLOCK_SIZE, count_newlines, skip_lines
+from .util import run_wrapper
+
+
+DEFAULT_STRIDE = 1024
+
+HEADER = struct.Struct('<4sIQQ')
+MAGIC = b'DCLI'
+
+
+def index_path(log_path):
+    """
+    Path to the sidecar index for a log
+
+    Examples:
+
+    >>> index_path(py.path.local('/data/proj/job/stage')).strpath
+    '/data/proj/job/.stage.idx'
+
+    >>> index_path(py.path.local('/data/proj/job/stage.log')).strpath
+    '/data/proj/job/.stage.log.idx'
+    """
+    return log_path.dirpath().join('.%s.idx' % log_path.basename)
+
+
+class LineIndex(object):
+    """
+    Offsets of every ``stride``th line in a log. Finding any line needs a
+    bisect of the checkpoints, and a scan of at most ``stride`` lines.
+
+    ``seek_lines`` splits on new lines, so a file ending with a new line ends
+    with an empty line, matching how seeks without an index have always
+    behaved. ``lines`` doesn't count that empty line. Whether the data ends
+    part way through a line isn't saved in the index file, so ``for_log``
+    reads it from the log.
+
+    Examples:
+
+    >>> tmp_file = getfixture('tmpdir').join('test')
+    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
+    >>> handle = tmp_file.open('rb')
+
+    >>> index = LineIndex(stride=2)
+    >>> index.feed(b'abc\\ndef\\ngh')
+    >>> index.feed(b'i\\njkl\\nmno')
+    >>> index.checkpoints.tolist()
+    [8, 16]
+    >>> index.size, index.lines
+    (19, 5)
+
+    >>> index.line_offset(handle, 3)
+    12
+    >>> index.line_offset(handle, 4)
+    16
+    >>> index.line_offset(handle, 20)
+    19
+
+    >>> index.seek_lines(handle, -1)
+    16
+    >>> index.seek_lines(handle, -3)
+    8
+    >>> index.seek_lines(handle, -20)
+    0
+    >>> index.seek_lines(handle, 1, offset=5)
+    8
+
+    >>> index.line_at(handle, 5)
+    1
+    >>> index.line_at(handle, 17)
+    4
+
+    >>> built = LineIndex(stride=2)
+    >>> built.catch_up(handle, 19, block_size=4)
+    >>> built.checkpoints.tolist()
+    [8, 16]
+
+    A final new line ends the last line, rather than starting another
+
+    >>> index = LineIndex()
+    >>> index.feed(b'a\\nb\\nc\\n')
+    >>> index.lines
+    3
+    >>> index.feed(b'd')
+    >>> index.lines
+    4
+    >>> LineIndex().lines
+    0
+    """
+    def __init__(self, stride=DEFAULT_STRIDE):
+        self.stride = stride
+        self.size = 0
+        self.newlines = 0
+        self.partial = False
+        self.checkpoints = array.array('Q')
+        self._synced = 0
+
+    @property
+    def lines(self):
+        """ Number of lines in the indexed data """
+        return self.newlines + (1 if self.partial else 0)
+
+    def feed(self, data):
+        """ Index data that has been appended to the log """
+        found = data.count(b'\n')
+        until_checkpoint = self.stride - self.newlines % self.stride
+
+        if found >= until_checkpoint:
+            idx = -1
+            remain = found
+            while remain >= until_checkpoint:
+                for _ in range(until_checkpoint):
+                    idx = data.find(b'\n', idx + 1)
+                self.checkpoints.append(self.size + idx + 1)
+                remain -= until_checkpoint
+                until_checkpoint = self.stride
+
+        self.newlines += found
+        self.size += len(data)
+        if data:
+            self.partial = not data.endswith(b'\n')
+
+    def catch_up(self, handle, size, block_size=BLOCK_SIZE):
+        """ Index data in the handle from the end of the index up to size """
+        handle.seek(self.size)
+        while self.size < size:
+            block = handle.read(min(block_size, size - self.size))
+            if not block:
+                break
+            self.feed(block)
+
+    def line_offset(self, handle, line):
+        """ Offset of the start of the given line number """
+        if line <= 0:
+            return 0
+        if line > self.newlines:
+            return self.size
+
+        checkpoint = line // self.stride
+        base = self.checkpoints[checkpoint - 1] if checkpoint else 0
+        remain = line - checkpoint * self.stride
+        if not remain:
+            return base
+
+        handle.seek(base)
+        return skip_lines(handle, remain)
+
+    def seek_lines(self, handle, seek, offset=0):
+        """
+        Offset after seeking ``seek`` lines ahead from ``offset``, or if
+        ``seek`` is negative, back from the end
+        """
+        if seek < 0:
+            return self.line_offset(handle, max(self.newlines + 1 + seek, 0))
+        if seek == 0:
+            return offset
+        return self.line_offset(handle, self.line_at(handle, offset) + seek)
+
+    def line_at(self, handle, offset):
+        """ Line number that contains the given offset """
+        offset = min(offset, self.size)
+        checkpoint = bisect.bisect_right(self.checkpoints, offset)
+        base = self.checkpoints[checkpoint - 1] if checkpoint else 0
+        return (
+            checkpoint * self.stride +
+            count_newlines(handle, base, offset)
+        )
+
+    def _header(self):
+        """ Packed header for the index file """
+        return HEADER.pack(MAGIC, self.stride, self.size, self.newlines)
+
+    @staticmethod
+    def _pack(checkpoints):
+        """ Checkpoints as little endian bytes """
+        if sys.byteorder != 'little':
+            checkpoints = array.array('Q', checkpoints)
+            checkpoints.byteswap()
+        return checkpoints.tobytes()
+
+    def save(self, path, exclusive=False):
+        """
+        Write the whole index to ``path``. If ``exclusive``, an existing index
+        is never replaced, and ``False`` is returned if one exists
+
+        Examples:
+
+        >>> tmp_dir = getfixture('tmpdir')
+        >>> index = LineIndex(stride=2)
+        >>> index.feed(b'a\\nb\\nc\\nd\\ne')
+        >>> index.save(tmp_dir.join('.test.idx'))
+        True
+        >>> LineIndex().save(tmp_dir.join('.test.idx'), exclusive=True)
+        False
+
+        >>> loaded = LineIndex.load(tmp_dir.join('.test.idx'))
+        >>> loaded.stride, loaded.size, loaded.newlines
+        (2, 9, 4)
+        >>> loaded.checkpoints.tolist()
+        [4, 8]
+        """
+        tmp_path = path.dirpath().join('.%s.%s.tmp' % (
+            path.basename, os.getpid(),
+        ))
+        with tmp_path.open('wb') as handle:
+            handle.write(self._header())
+            handle.write(self._pack(self.checkpoints))
+
+        try:
+            if exclusive:
+                os.link(tmp_path.strpath, path.strpath)
+            else:
+                os.rename(tmp_path.strpath, path.strpath)
+        except FileExistsError:
+            return False
+        finally:
+            if tmp_path.check():
+                tmp_path.remove()
+
+        self._synced = len(self.checkpoints)
+        return True
+
+    def sync(self, handle):
+        """
+        Write checkpoints added since the last save or sync to an index file
+        handle, then update its header. Checkpoints are written first, so
+        that readers never see a header that they don't have offsets for
+        """
+        if self._synced < len(self.checkpoints):
+            handle.seek(HEADER.size + self._synced * 8)
+            handle.write(self._pack(self.checkpoints[self._synced:]))
+            self._synced = len(self.checkpoints)
+        handle.seek(0)
+        handle.write(self._header())
+
+    @classmethod
+    def load(cls, path):
+        """ Load an index file, or ``None`` if it's missing or invalid """
+        try:
+            with path.open('rb') as handle:
+                data = handle.read()
+        except py.error.ENOENT:
+            return None
+
+        if len(data) < HEADER.size:
+            return None
+        magic, stride, size, newlines = HEADER.unpack_from(data)
+        if magic != MAGIC or stride < 1:
+            return None
+
+        count = newlines // stride
+        end = HEADER.size + count * 8
+        if len(data) < end:
+            return None
+
+        index = cls(stride=stride)
+        index.size = size
+        index.newlines = newlines
+        index.checkpoints.frombytes(data[HEADER.size:end])
+        if sys.byteorder != 'little':
+            index.checkpoints.byteswap()
+        index._synced = count  # pylint:disable=protected-access
+        return index
+
+    @classmethod
+    def for_log(cls, log_path, handle):
+        """
+        Load the index for a log, and bring it up to date with the data in
+        ``handle``. Returns ``None`` if there is no valid index, so that the
+        caller can fall back to scanning the log
+        """
+        index = cls.load(index_path(log_path))
+        if index is None:
+            return None
+
+        handle.seek(0, 2)
+        size = handle.tell()
+        if index.size > size:
+            return None
+
+        index.catch_up(handle, size)
+        if size:
+            handle.seek(size - 1)
+            index.partial = handle.read(1) != b'\n'
+        return index
+
+
+def build_index(log_path, exclusive=True):
+    """
+    Build an index for a log, and save it. Returns the index
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage.log')
+    >>> log_path.write('abc\\ndef\\nghi\\njkl\\nmno')
+
+    >>> build_index(log_path).lines
+    5
+    >>> index_path(log_path).check()
+    True
+
+    >>> with log_path.open('rb') as handle:
+    ...     LineIndex.for_log(log_path, handle).size
+    19
+
+    >>> log_path.write('abc\\ndef\\n')
+    >>> build_index(log_path, exclusive=False).lines
+    2
+    >>> with log_path.open('rb') as handle:
+    ...     LineIndex.for_log(log_path, handle).lines
+    2
+    """
+    index = LineIndex()
+    with log_path.open('rb') as handle:
+        handle.seek(0, 2)
+        size = handle.tell()
+        index.catch_up(handle, size)
+
+    index.save(index_path(log_path), exclusive=exclusive)
+    return index
+
+
+def _log_paths(data_path):
+    """
+    All stage logs in the data directory
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> tmp_dir.join('proj', 'job', 'stage').write('abc', ensure=True)
+    >>> tmp_dir.join('proj', 'job', '.stage.idx').write('abc')
+    >>> tmp_dir.join('.notify', 'job', 'http.sock').write('', ensure=True)
+    >>> [path.basename for path in _log_paths(tmp_dir)]
+    ['stage']
+    """
+    def is_dir(path):
+        """ Filter for directories that aren't hidden """
+        return path.check(dir=True) and not path.basename.startswith('.')
+
+    for project_path in data_path.listdir(is_dir):
+        for job_path in project_path.listdir(is_dir):
+            for log_path in job_path.listdir(
+                lambda path: (
+                    path.check(file=True) and
+                    not path.basename.startswith('.')
+                )
+            ):
+                yield log_path
+
+
+@run_wrapper('index')
+def run(logger, *_):
+    """ Build indexes for all stage logs, including legacy logs. Archives
+    are indexed when they're written """
+    for log_path in _log_paths(py.path.local('data')):
+        if is_archive(log_path) or index_path(log_path).check():
+            continue
+
+        logger.info('Building index for %s', log_path)
+        build_index(log_path)
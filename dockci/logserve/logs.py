@@ -0,0 +1,329 @@
+""" Finding stage logs, and streaming them to clients """
+import asyncio
+
+import py
+
+from .aiofile import ReadAhead, run_io
+from .archive import open_log, stat_log, ARCHIVE_EXT
+from .encoding import GzipStreamResponse, GZIP_CHUNK_SIZE
+from .flow import ChunkSizer, ResponseFlow
+from .index import LineIndex
+from .metrics import Counter
+from .scan import skip_lines, skip_lines_back
+from .storage import load_final
+
+
+READ_CHUNK_SIZE = 64 * 1024
+
+SENT_BYTES = Counter(
+    'logserve_http_log_bytes_total',
+    'Log data sent to clients, before encoding.',
+)
+
+
+def reader_bytes(handle, count=None, chunk_size=1024):
+    """
+    Read a given number of bytes, in chunks of ``chunk_size``, or of the size
+    returned by calling it before each chunk
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> tmp_file = tmp_dir.join('test')
+    >>> tmp_file.write('abcdefghi')
+
+    >>> handle = tmp_file.open()
+    >>> handle.seek(4)
+    4
+    >>> list(reader_bytes(handle, 2))
+    ['ef']
+
+    >>> handle = tmp_file.open()
+    >>> handle.seek(4)
+    4
+    >>> list(reader_bytes(handle, chunk_size=3))
+    ['efg', 'hi']
+
+    >>> handle = tmp_file.open()
+    >>> sizes = iter([1, 4])
+    >>> list(reader_bytes(handle, 7, lambda: next(sizes, 3)))
+    ['a', 'bcde', 'fg']
+    """
+    remain = count
+    while remain is None or remain > 0:
+        size = chunk_size() if callable(chunk_size) else chunk_size
+        if remain is not None:
+            size = min(size, remain)
+
+        data = handle.read(size)
+
+        if remain is not None:
+            remain -= len(data)
+
+        if len(data) == 0:
+            return
+
+        yield data
+
+
+def seeker_bytes(handle, seek):
+    """
+    Seek ahead in handle by the given number of bytes. If ``seek`` is
+    negative, seeks that number of bytes from the end of the file
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> tmp_file = tmp_dir.join('test')
+    >>> tmp_file.write('abcdefghi')
+
+    >>> handle = tmp_file.open()
+    >>> seeker_bytes(handle, 3)
+    >>> handle.read(1)
+    'd'
+
+    >>> handle = tmp_file.open()
+    >>> seeker_bytes(handle, -3)
+    >>> handle.read(1)
+    'g'
+    """
+    if seek >= 0:
+        handle.seek(seek)
+    else:
+        handle.seek(0, 2)
+        file_size = handle.tell()
+        handle.seek(file_size + seek)  # seek is negative
+
+
+def seeker_lines(handle, seek):
+    """
+    Seek ahead in handle by the given number of lines. If ``seek`` is
+    negative, seeks to that number of lines from the end of the file
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> tmp_file = tmp_dir.join('test')
+    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
+
+    >>> handle = tmp_file.open()
+    >>> seeker_lines(handle, 3)
+    >>> handle.read(1)
+    'j'
+
+    >>> handle = tmp_file.open()
+    >>> seeker_lines(handle, -1)
+    >>> handle.read(3)
+    'mno'
+
+    >>> handle = tmp_file.open()
+    >>> seeker_lines(handle, -3)
+    >>> handle.read(1)
+    'g'
+
+    >>> handle = tmp_file.open()
+    >>> seeker_lines(handle, -20)
+    >>> handle.read(3)
+    'abc'
+
+    >>> handle = tmp_file.open('rb')
+    >>> seeker_lines(handle, -20)
+    >>> handle.read(3)
+    b'abc'
+    """
+    if seek >= 0:
+        skip_lines(handle, seek)
+    else:
+        skip_lines_back(handle, -seek)
+
+
+def find_log(project_slug, job_slug, stage_slug):
+    """
+    Find, and stat the log file for a stage. Returns the path, stat, and
+    final marker (or ``None`` if it's still being written), or ``None`` if
+    there isn't a log. A marker that doesn't match the log is ignored
+    """
+    log_dir = py.path.local('data').join(project_slug, job_slug)
+
+    # Handle .log ext for DockCI legacy data, and compacted logs
+    for log_path in (
+        log_dir.join(stage_slug),
+        log_dir.join('%s.log' % stage_slug),
+        log_dir.join(stage_slug + ARCHIVE_EXT),
+    ):
+        try:
+            stat = stat_log(log_path)
+        except py.error.ENOENT:
+            continue
+
+        final = load_final(log_path)
+        if final is not None and final.get('size') != stat.size:
+            final = None
+        return log_path, stat, final
+
+    return None
+
+
+@asyncio.coroutine
+def resolve_log(request, key):
+    """ ``find_log`` for a stage key, through the app's path cache """
+    cache = request.app.path_cache
+    try:
+        return cache.get(key)
+    except KeyError:
+        pass
+
+    version = cache.version(key)
+    found = yield from run_io(request, find_log, *key)
+    cache.put(key, found, version)
+    return found
+
+
+def log_range(log_path, handle,  # pylint:disable=too-many-arguments
+              byte_seek, line_seek, bytes_count, lines_count, size=None):
+    """ Resolve seek and count params to a ``(start, end)`` byte range, in
+    the first ``size`` bytes of the log, or all of it """
+    if size is None:
+        size = handle.seek(0, 2)
+    handle.seek(0)
+
+    index = None
+    if line_seek is not None or lines_count is not None:
+        index = LineIndex.for_log(log_path, handle)
+        handle.seek(0)
+
+    if byte_seek is not None:
+        seeker_bytes(handle, byte_seek)
+    if line_seek is not None:
+        if index is None:
+            seeker_lines(handle, line_seek)
+        else:
+            handle.seek(index.seek_lines(handle, line_seek, handle.tell()))
+
+    start = handle.tell()
+    if bytes_count is not None:
+        end = start + bytes_count
+    elif lines_count is not None:
+        if index is None:
+            end = skip_lines(handle, lines_count)
+        else:
+            end = index.line_offset(
+                handle, index.line_at(handle, start) + lines_count,
+            )
+    else:
+        end = size
+
+    return start, max(min(end, size), start)
+
+
+def job_stage_slugs(project_slug, job_slug):
+    """
+    Slugs of all stages of a job that have logs, or ``None`` if the job has
+    no log directory
+
+    Examples:
+
+    >>> monkeypatch = getfixture('monkeypatch')
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> monkeypatch.chdir(tmp_dir)
+    >>> for name in ('a', 'b.log', 'c.zlog', '.a.idx'):
+    ...     tmp_dir.join('data', 'p', 'j', name).write('', ensure=True)
+    >>> job_stage_slugs('p', 'j')
+    ['a', 'b', 'c']
+    >>> job_stage_slugs('p', 'other')
+    """
+    try:
+        log_paths = py.path.local('data').join(project_slug, job_slug).listdir(
+            lambda path: (
+                path.check(file=True) and not path.basename.startswith('.')
+            )
+        )
+    except py.error.ENOENT:
+        return None
+
+    stage_slugs = set()
+    for log_path in log_paths:
+        stage_slug = log_path.basename
+        for ext in ('.log', ARCHIVE_EXT):
+            if stage_slug.endswith(ext):
+                stage_slug = stage_slug[:-len(ext)]
+        stage_slugs.add(stage_slug)
+    return sorted(stage_slugs)
+
+
+def response_flow(request, response):
+    """ Flow control for streaming logs in ``response`` to ``request``.
+    Gzipped responses are compressed a chunk at a time, so they're read in
+    chunks of a fixed size, for the same log to always compress to the same
+    bytes """
+    app = request.app
+    if isinstance(response, GzipStreamResponse):
+        sizer = ChunkSizer(GZIP_CHUNK_SIZE, GZIP_CHUNK_SIZE)
+    else:
+        sizer = ChunkSizer(app.chunk_min, app.chunk_max, app.chunk_target)
+    return ResponseFlow(
+        app.loop, sizer, app.flow_budget, request.transport,
+        app.write_buffer_high, app.stall_timeout,
+    )
+
+
+@asyncio.coroutine
+def write_data(response, flow, data):
+    """ Write data to the response within the flow limits """
+    yield from flow.write(response, data)
+    SENT_BYTES.inc(len(data))
+
+
+@asyncio.coroutine
+def stream_chunks(request, response, flow, gen):
+    """ Write chunks from a blocking generator to the response """
+    reader = ReadAhead(gen, request.app.executor, request.app.loop)
+    try:
+        while True:
+            data = yield from reader.read()
+            if data is None:
+                break
+            yield from write_data(response, flow, data)
+
+    finally:
+        yield from reader.close()
+
+
+@asyncio.coroutine
+def stream_file(  # pylint:disable=too-many-arguments
+        request, response, flow, log_path, start, end=None,
+):
+    """ Open the log, and stream from ``start`` to ``end``, or to EOF """
+    handle = yield from run_io(request, open_log, log_path)
+    try:
+        yield from run_io(request, handle.seek, start)
+        yield from stream_chunks(
+            request, response, flow,
+            reader_bytes(
+                handle,
+                None if end is None else end - start,
+                flow.chunk_size,
+            ),
+        )
+
+    finally:
+        yield from run_io(request, handle.close)
+
+
+@asyncio.coroutine
+def send_range(request, response, flow,  # pylint:disable=too-many-arguments
+               handle, start, end, sendfile=True):
+    """ Send bytes ``start`` to ``end`` of an open log. If ``sendfile`` is
+    allowed, and possible, it's used; otherwise the bytes are streamed """
+    sent = False
+    if sendfile:
+        sent = yield from flow.sendfile(request, response, handle, start, end)
+    if sent:
+        SENT_BYTES.inc(end - start)
+        return
+
+    yield from run_io(request, handle.seek, start)
+    yield from stream_chunks(
+        request, response, flow,
+        reader_bytes(handle, end - start, flow.chunk_size),
+    )
@@ -0,0 +1,228 @@
+""" In memory indexes of stage metadata, and log paths, kept current by
+stage events """
+import collections
+import time
+
+from .notify import stage_key
+
+
+StageMeta = collections.namedtuple(
+    'StageMeta', ['size', 'lines', 'mtime', 'final'],
+)
+
+
+class MetaIndex(object):
+    """
+    Metadata of recently used stages, and the stages in recently used jobs.
+    Stage events update entries as logs are written, so they only need to
+    be loaded from disk once. Entries expire after ``ttl`` seconds without
+    an update, in case an event was missed. Newer metadata (a bigger log)
+    always wins, so a slow load from disk never undoes an event.
+
+    At most ``max_stages`` stages, and ``max_jobs`` jobs are kept; the least
+    recently used are dropped
+
+    Examples:
+
+    >>> index = MetaIndex(ttl=60, max_stages=2)
+    >>> index.get(('p', 'j', 'a'))
+    >>> index.put(('p', 'j', 'a'), StageMeta(3, 1, 10.0, False))
+    StageMeta(size=3, lines=1, mtime=10.0, final=False)
+
+    >>> index.on_event({
+    ...     'event': 'append', 'project': 'p', 'job': 'j', 'stage': 'a',
+    ...     'size': 6, 'lines': 2, 'mtime': 11.0,
+    ... }, b'')
+    >>> index.put(('p', 'j', 'a'), StageMeta(3, 1, 10.0, False))
+    StageMeta(size=6, lines=2, mtime=11.0, final=False)
+    >>> index.on_event({
+    ...     'event': 'finalize', 'project': 'p', 'job': 'j', 'stage': 'a',
+    ...     'size': 6, 'lines': 2, 'mtime': 12.0,
+    ... }, b'')
+    >>> index.get(('p', 'j', 'a')).final
+    True
+
+    >>> index.put_job('p', 'j', ['a'])
+    >>> index.on_event({
+    ...     'event': 'append', 'project': 'p', 'job': 'j', 'stage': 'b',
+    ...     'size': 1, 'lines': 1, 'mtime': 13.0,
+    ... }, b'')
+    >>> index.job_stages('p', 'j')
+    ['a', 'b']
+    >>> index.job_stages('p', 'other')
+
+    >>> _ = index.put(('p', 'j', 'c'), StageMeta(1, 1, 14.0, False))
+    >>> index.get(('p', 'j', 'a'))
+    """
+    def __init__(self, ttl=30, max_stages=100000, max_jobs=10000):
+        self.ttl = ttl
+        self.max_stages = max_stages
+        self.max_jobs = max_jobs
+        self._stages = collections.OrderedDict()
+        self._jobs = collections.OrderedDict()
+
+    def _fresh(self, entries, key):
+        """ The value for a key, if it hasn't expired """
+        try:
+            value, updated = entries[key]
+        except KeyError:
+            return None
+        if time.monotonic() - updated > self.ttl:
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return value
+
+    @staticmethod
+    def _store(entries, key, value, max_entries):
+        """ Store a value, dropping the least recently used if needed """
+        entries[key] = (value, time.monotonic())
+        entries.move_to_end(key)
+        while len(entries) > max_entries:
+            entries.popitem(last=False)
+
+    def get(self, key):
+        """ Metadata for a stage, or ``None`` if it's not known """
+        return self._fresh(self._stages, key)
+
+    def put(self, key, meta):
+        """ Store metadata for a stage, unless newer is already known.
+        Returns the newest metadata """
+        current = self._fresh(self._stages, key)
+        if current is not None and (
+            current.size > meta.size or
+            (current.size == meta.size and current.final >= meta.final)
+        ):
+            return current
+
+        self._store(self._stages, key, meta, self.max_stages)
+        return meta
+
+    def job_stages(self, project_slug, job_slug):
+        """ Slugs of the stages of a job, or ``None`` if they're not known """
+        stages = self._fresh(self._jobs, (project_slug, job_slug))
+        return None if stages is None else sorted(stages)
+
+    def put_job(self, project_slug, job_slug, stage_slugs):
+        """ Store the slugs of the stages of a job """
+        self._store(
+            self._jobs, (project_slug, job_slug), set(stage_slugs),
+            self.max_jobs,
+        )
+
+    def on_event(self, event, _):
+        """ ``Listener`` callback to keep metadata up to date """
+        kind = event.get('event')
+        if kind not in ('append', 'finalize') or 'size' not in event:
+            return
+
+        key = stage_key(event)
+        self.put(key, StageMeta(
+            event['size'], event.get('lines'),
+            event.get('mtime', time.time()), kind == 'finalize',
+        ))
+
+        job = self._jobs.get(key[:2])
+        if job is not None:
+            job[0].add(key[2])
+
+
+class PathCache(object):
+    """
+    Resolved log paths, with their stats, and final markers, by stage, so
+    that requests don't hit storage each time. ``None`` is cached for stages
+    without a log.
+
+    Entries are dropped when an event says a stage's log changed. They also
+    expire, in case an event was missed: entries for stages without a log
+    after ``negative_ttl`` seconds, for final logs after ``final_ttl``, and
+    for others after ``ttl``. Each stage has a version that's bumped when
+    it's invalidated, so that a result that was looked up before a change
+    isn't stored after it.
+
+    At most ``max_entries`` stages are kept; the least recently used are
+    dropped
+
+    Examples:
+
+    >>> cache = PathCache(ttl=60, negative_ttl=60, final_ttl=60)
+    >>> key = ('p', 'j', 's')
+    >>> cache.get(key)
+    Traceback (most recent call last):
+      ...
+    KeyError: ('p', 'j', 's')
+
+    >>> version = cache.version(key)
+    >>> cache.put(key, None, version)
+    >>> cache.get(key)
+
+    >>> version = cache.version(key)
+    >>> cache.on_event({
+    ...     'event': 'append', 'project': 'p', 'job': 'j', 'stage': 's',
+    ... }, b'')
+    >>> cache.put(key, ('path', 'stat', None), version)
+    >>> key in cache
+    False
+    >>> cache.put(key, ('path', 'stat', None), cache.version(key))
+    >>> cache.get(key)
+    ('path', 'stat', None)
+    """
+    def __init__(self, ttl=1, negative_ttl=1, final_ttl=300,
+                 max_entries=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.final_ttl = final_ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._versions = collections.OrderedDict()
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key):
+        """ The cached log for a stage. Raises ``KeyError`` if there isn't
+        one """
+        value, expires = self._entries[key]
+        if time.monotonic() > expires:
+            del self._entries[key]
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        return value
+
+    def version(self, key):
+        """ Version of a stage, to pass to ``put`` once it's looked up """
+        return self._versions.get(key, 0)
+
+    def put(self, key, value, version):
+        """ Cache the log for a stage, unless it's been invalidated since
+        ``version`` was taken """
+        if self.version(key) != version:
+            return
+
+        if value is None:
+            ttl = self.negative_ttl
+        elif value[2] is not None:
+            ttl = self.final_ttl
+        else:
+            ttl = self.ttl
+
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """ Drop the cached log for a stage """
+        self._entries.pop(key, None)
+        self._versions[key] = self._versions.pop(key, 0) + 1
+        while len(self._versions) > self.max_entries:
+            self._versions.popitem(last=False)
+
+    def on_event(self, event, _):
+        """ ``Listener`` callback to drop logs that have changed """
+        if event.get('stage') is not None:
+            self.invalidate(stage_key(event))
@@ -0,0 +1,454 @@
+"""
+In process metrics, rendered in the Prometheus text format. Metrics are
+registered with ``REGISTRY`` when they're created, at import time, so each
+process exposes the metrics of the parts of the log server it runs
+"""
+import bisect
+import http.server
+import os
+import socketserver
+import threading
+import time
+
+from .util import env_float, env_int
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60,
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    """
+    A sample value in the text format
+
+    Examples:
+
+    >>> _format_value(3), _format_value(0.25), _format_value(float('inf'))
+    ('3', '0.25', '+Inf')
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def _format_labels(names, values):
+    """
+    Label set of a sample, with values escaped
+
+    Examples:
+
+    >>> _format_labels(('a', 'b'), ('x', 'say "hi"\\n'))
+    '{a="x",b="say \\\\"hi\\\\"\\\\n"}'
+    >>> _format_labels((), ())
+    ''
+    """
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+
+
+class Registry(object):
+    """ The metrics a process exposes """
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """ Add a metric """
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """ Every metric in the text format """
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """
+    Base for metrics, which are a family of values, one for each set of
+    label values. Metrics without labels have a single value, and can be
+    used directly
+    """
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        """ A new value for a set of label values """
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """ The value for a set of label values """
+        try:
+            return self._children[values]
+        except KeyError:
+            pass
+        if len(values) != len(self.label_names):
+            raise ValueError("Expected labels %s" % (self.label_names,))
+        with self._lock:
+            return self._children.setdefault(values, self._new_child())
+
+    def samples(self):
+        """ ``(suffix, label names, label values, value)`` of each sample """
+        with self._lock:
+            children = sorted(self._children.items())
+        if not children and not self.label_names:
+            children = [((), self.labels())]
+
+        for values, child in children:
+            for suffix, names, extra, value in child.samples():
+                yield suffix, self.label_names + names, values + extra, value
+
+    def render(self):
+        """ The metric in the text format """
+        lines = [
+            '# HELP %s %s\n' % (self.name, self.help_text),
+            '# TYPE %s %s\n' % (self.name, self.kind),
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s\n' % (
+                self.name, suffix, _format_labels(names, values),
+                _format_value(value),
+            ))
+        return ''.join(lines)
+
+
+class CounterValue(object):
+    """ A value that only goes up """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """ Add to the value """
+        self.value += amount
+
+    def samples(self):
+        """ The single sample of the value """
+        yield '', (), (), self.value
+
+
+class Counter(Metric):
+    """
+    Metric that counts events
+
+    Examples:
+
+    >>> counter = Counter('test_total', 'Things.', ['kind'], registry=None)
+    >>> counter.labels('a').inc()
+    >>> counter.labels('a').inc(2)
+    >>> print(counter.render(), end='')
+    # HELP test_total Things.
+    # TYPE test_total counter
+    test_total{kind="a"} 3
+    """
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        """ Add to the value of a metric without labels """
+        self.labels().inc(amount)
+
+
+class GaugeValue(CounterValue):
+    """ A value that can go up, and down, or that's read from a function
+    when it's rendered """
+    def __init__(self):
+        super(GaugeValue, self).__init__()
+        self.function = None
+
+    def set(self, value):
+        """ Set the value """
+        self.value = value
+
+    def dec(self, amount=1):
+        """ Take from the value """
+        self.value -= amount
+
+    def samples(self):
+        """ The single sample of the value, or of the function """
+        value = self.value if self.function is None else self.function()
+        yield '', (), (), value
+
+
+class Gauge(Metric):
+    """
+    Metric that's a current value
+
+    Examples:
+
+    >>> gauge = Gauge('test_open', 'Open things.', registry=None)
+    >>> gauge.inc(3)
+    >>> gauge.dec()
+    >>> gauge.labels().value
+    2
+    >>> gauge.set_function(lambda: 7)
+    >>> print(gauge.render(), end='')
+    # HELP test_open Open things.
+    # TYPE test_open gauge
+    test_open 7
+    """
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        """ Add to the value of a metric without labels """
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        """ Take from the value of a metric without labels """
+        self.labels().dec(amount)
+
+    def set(self, value):
+        """ Set the value of a metric without labels """
+        self.labels().set(value)
+
+    def set_function(self, function):
+        """ Read the value of a metric without labels from ``function`` """
+        self.labels().function = function
+
+
+class HistogramValue(object):
+    """ Counts of observations in buckets, and their sum """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """ Record an observation """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """ Context manager that observes the seconds taken in it """
+        return _Timer(self)
+
+    def samples(self):
+        """ Cumulative count of each bucket, then the sum, and count """
+        total = 0
+        for bound, count in zip(
+                self.buckets + (float('inf'),), self.counts,
+        ):
+            total += count
+            yield '_bucket', ('le',), (_format_value(bound),), total
+        yield '_sum', (), (), self.sum
+        yield '_count', (), (), total
+
+
+class _Timer(object):
+    """ Observes the time taken in a ``with`` block """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class Histogram(Metric):
+    """
+    Metric that's a distribution of observations, like latencies
+
+    Examples:
+
+    >>> histogram = Histogram(
+    ...     'test_seconds', 'Time taken.', ['mode'], buckets=(0.1, 1),
+    ...     registry=None,
+    ... )
+    >>> histogram.labels('a').observe(0.05)
+    >>> histogram.labels('a').observe(0.5)
+    >>> histogram.labels('a').observe(5)
+    >>> print(histogram.render(), end='')
+    # HELP test_seconds Time taken.
+    # TYPE test_seconds histogram
+    test_seconds_bucket{mode="a",le="0.1"} 1
+    test_seconds_bucket{mode="a",le="1"} 2
+    test_seconds_bucket{mode="a",le="+Inf"} 3
+    test_seconds_sum{mode="a"} 5.55
+    test_seconds_count{mode="a"} 3
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, help_text, labels, registry)
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        """ Record an observation of a metric without labels """
+        self.labels().observe(value)
+
+    def time(self):
+        """ Time a ``with`` block for a metric without labels """
+        return self.labels().time()
+
+
+def _open_fds():
+    """ Number of open file descriptors of this process """
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return float('nan')
+
+
+OPEN_FDS = Gauge('logserve_open_fds', 'Open file descriptors.')
+OPEN_FDS.set_function(_open_fds)
+
+
+class ConsumerHealth(object):
+    """
+    Liveness of the consumers that write logs, from the ``consumer`` events
+    they publish every few seconds. A consumer that was heard from in the
+    last ``forget_after`` seconds is expected to be healthy: its last event
+    must be less than ``timeout`` seconds old, it must be consuming, and it
+    must have at most ``max_lag`` messages waiting in its queue
+
+    Examples:
+
+    >>> health = ConsumerHealth(timeout=10, max_lag=100)
+    >>> health.check(now=0)
+    (False, {})
+
+    >>> health.on_event({
+    ...     'event': 'consumer', 'name': 'consumer', 'time': 100,
+    ...     'consuming': True, 'queue_messages': 5, 'last_message': 95,
+    ... }, b'')
+    >>> healthy, consumers = health.check(now=102)
+    >>> healthy, consumers['consumer']['age']
+    (True, 2)
+    >>> consumers['consumer']['last_message_age']
+    7
+
+    >>> health.check(now=120)[0]
+    False
+    """
+    def __init__(self, timeout=30, max_lag=10000, forget_after=600):
+        self.timeout = timeout
+        self.max_lag = max_lag
+        self.forget_after = forget_after
+        self._consumers = {}
+
+    def on_event(self, event, _):
+        """ ``Listener`` callback to record consumer events """
+        if event.get('event') == 'consumer' and 'name' in event:
+            self._consumers[event['name']] = event
+
+    def check(self, now=None):
+        """ Whether the consumers are healthy, and the state of each """
+        if now is None:
+            now = time.time()
+
+        consumers = {}
+        healthy = True
+        for name, event in list(self._consumers.items()):
+            age = now - event.get('time', 0)
+            if age > self.forget_after:
+                del self._consumers[name]
+                continue
+
+            last_message = event.get('last_message')
+            lag = event.get('queue_messages')
+            consumers[name] = {
+                'age': age,
+                'consuming': bool(event.get('consuming')),
+                'queue_messages': lag,
+                'last_message_age': (
+                    None if last_message is None else now - last_message
+                ),
+            }
+            healthy = healthy and (
+                age <= self.timeout and bool(event.get('consuming')) and
+                (lag is None or lag <= self.max_lag)
+            )
+
+        return healthy and bool(consumers), consumers
+
+
+def health_from_env():
+    """ ``ConsumerHealth`` configured from the environment """
+    return ConsumerHealth(
+        timeout=env_float('LOGSERVE_HEALTH_TIMEOUT', 30),
+        max_lag=env_int('LOGSERVE_HEALTH_MAX_LAG', 10000),
+    )
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves ``/_metrics``, and ``/_healthz`` for ``serve_metrics`` """
+    def do_GET(self):  # pylint:disable=invalid-name
+        """ Handle a request """
+        if self.path == '/_metrics':
+            status, content_type = 200, CONTENT_TYPE
+            body = self.server.registry.render()
+        elif self.path == '/_healthz' and self.server.health is not None:
+            content_type = 'application/json'
+            healthy, body = self.server.health()
+            status = 200 if healthy else 503
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        """ Scrapes are too frequent to log """
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ HTTP server for metrics, with a thread per request """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry, health=None):
+        super(_MetricsServer, self).__init__(address, _MetricsHandler)
+        self.registry = registry
+        self.health = health
+
+
+def serve_metrics(port, registry=REGISTRY, health=None, host=''):
+    """
+    Serve ``/_metrics`` on ``port`` from a background thread, for processes
+    that don't run the HTTP API. If ``health`` is given, it's called to
+    serve ``/_healthz``, and must return whether the process is healthy,
+    and a JSON body. Returns the server
+    """
+    server = _MetricsServer((host, port), registry, health)
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True,
+    )
+    thread.start()
+    return server
@@ -0,0 +1,327 @@
+"""
+Notifications of stage log changes, sent from the consumer to the HTTP
+server over unix datagram sockets.
+
+Every listening process binds its own socket in the notify directory, and
+notifiers send each event to all of them. Delivery is best effort: a
+listener that has gone away, or isn't keeping up, just misses events
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+
+import py
+
+
+NOTIFY_PATH = 'data/.notify'
+RCVBUF_SIZE = 4 * 1024 * 1024
+# Most data sent with an event. Appends send the end of their data, since
+# that's what readers of the tail of a log want
+MAX_PAYLOAD = 64 * 1024
+
+
+def encode_event(event, payload=b''):
+    """
+    Datagram for an event dict, and an optional binary payload
+
+    Examples:
+
+    >>> encode_event({'event': 'append'}, b'abc')
+    b'{"event": "append"}\\nabc'
+    """
+    return json.dumps(event, sort_keys=True).encode() + b'\n' + payload
+
+
+def decode_event(datagram):
+    """
+    Event dict, and payload from a datagram
+
+    Examples:
+
+    >>> decode_event(b'{"event": "append"}\\nabc\\ndef')
+    ({'event': 'append'}, b'abc\\ndef')
+    """
+    header, _, payload = datagram.partition(b'\n')
+    return json.loads(header.decode()), payload
+
+
+def stage_key(event):
+    """
+    The ``(project, job, stage)`` slugs an event is about
+
+    Examples:
+
+    >>> stage_key({'project': 'p', 'job': 'j', 'stage': 's'})
+    ('p', 'j', 's')
+    """
+    return event.get('project'), event.get('job'), event.get('stage')
+
+
+class Notifier(object):
+    """
+    Sends events to every listener socket in ``path``. The list of sockets
+    is refreshed at most every ``refresh`` seconds, and sockets that refuse
+    connections are assumed stale, and removed
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> notifier = Notifier(tmp_dir.strpath)
+    >>> notifier.publish({'event': 'append'})
+    0
+    """
+    def __init__(self, path=NOTIFY_PATH, refresh=1.0):
+        self.path = py.path.local(path)
+        self.refresh = refresh
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._targets = []
+        self._targets_at = None
+
+    def _listeners(self):
+        """ Socket paths of all listeners """
+        now = time.monotonic()
+        if self._targets_at is None or now - self._targets_at > self.refresh:
+            self._targets_at = now
+            try:
+                self._targets = [
+                    sock_path.strpath
+                    for sock_path in self.path.listdir('*.sock')
+                ]
+            except py.error.ENOENT:
+                self._targets = []
+        return self._targets
+
+    def publish(self, event, payload=b''):
+        """ Send an event to all listeners. Returns the number reached """
+        datagram = encode_event(event, payload)
+        sent = 0
+        for target in self._listeners():
+            try:
+                self._socket.sendto(datagram, target)
+                sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._remove(target)
+            except BlockingIOError:
+                pass  # listener isn't keeping up; it misses this one
+            except OSError:
+                if payload:  # too big for a datagram; send without it
+                    sent += self.publish(event)
+                    return sent
+        return sent
+
+    def _remove(self, target):
+        """ Forget a stale listener socket """
+        self._targets = [path for path in self._targets if path != target]
+        try:
+            os.unlink(target)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """ Close the sending socket """
+        self._socket.close()
+
+
+class LocalNotifier(object):
+    """
+    Delivers events straight to a ``Listener`` in the same process, for when
+    the consumer, and HTTP server share an event loop. If the ``loop`` is
+    given, events are dispatched on it, so that they can be published from
+    other threads
+
+    Examples:
+
+    >>> listener = Listener(None)
+    >>> listener.subscribe(None, lambda *args: print(args))
+    >>> LocalNotifier(listener).publish({'event': 'append'}, b'ab')
+    ({'event': 'append'}, b'ab')
+    1
+
+    >>> import asyncio
+    >>> loop = asyncio.new_event_loop()
+    >>> LocalNotifier(listener, loop).publish({'event': 'finalize'})
+    1
+    >>> loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    ({'event': 'finalize'}, b'')
+    >>> loop.close()
+    """
+    def __init__(self, listener, loop=None):
+        self.listener = listener
+        self.loop = loop
+
+    def publish(self, event, payload=b''):
+        """ Dispatch an event to the listener. Returns the number reached """
+        if self.loop is None:
+            self.listener.dispatch(event, payload)
+        else:
+            self.loop.call_soon_threadsafe(
+                self.listener.dispatch, event, payload,
+            )
+        return 1
+
+    def close(self):
+        """ Nothing to close """
+
+
+class Listener(object):
+    """
+    Receives events on a socket in ``path``, and calls callbacks subscribed
+    to the stage they're about. Callbacks subscribed with ``None`` as the
+    key receive every event
+
+    Examples:
+
+    >>> import asyncio
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> loop = asyncio.new_event_loop()
+
+    >>> listener = Listener(loop, tmp_dir.strpath)
+    >>> listener.start()
+    >>> received = []
+    >>> def callback(*args):
+    ...     received.append(args)
+    >>> listener.subscribe(('p', 'j', 's'), callback)
+
+    >>> notifier = Notifier(tmp_dir.strpath)
+    >>> notifier.publish({'project': 'p', 'job': 'j', 'stage': 's'}, b'ab')
+    1
+    >>> notifier.publish({'project': 'p', 'job': 'j', 'stage': 'x'})
+    1
+    >>> loop.run_until_complete(asyncio.sleep(0.01))
+    >>> [(event['stage'], payload) for event, payload in received]
+    [('s', b'ab')]
+
+    >>> listener.stop()
+    >>> notifier.publish({'project': 'p', 'job': 'j', 'stage': 's'})
+    0
+    >>> loop.close()
+    """
+    def __init__(self, loop, path=NOTIFY_PATH, name='http'):
+        self.path = py.path.local(path)
+        self.sock_path = self.path.join('%s-%s.sock' % (name, os.getpid()))
+        self._loop = loop
+        self._socket = None
+        self._callbacks = {}
+
+    def start(self):
+        """ Bind the socket, and start reading events """
+        self.path.ensure(dir=True)
+        if self.sock_path.check():
+            self.sock_path.remove()
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE,
+        )
+        self._socket.bind(self.sock_path.strpath)
+        self._socket.setblocking(False)
+        self._loop.add_reader(self._socket.fileno(), self._on_readable)
+
+    def stop(self):
+        """ Stop reading events, and remove the socket """
+        if self._socket is None:
+            return
+        self._loop.remove_reader(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        if self.sock_path.check():
+            self.sock_path.remove()
+
+    def subscribe(self, key, callback):
+        """ Call ``callback(event, payload)`` for events about a stage """
+        self._callbacks.setdefault(key, []).append(callback)
+
+    def unsubscribe(self, key, callback):
+        """ Remove a callback added with ``subscribe`` """
+        callbacks = self._callbacks.get(key, [])
+        callbacks.remove(callback)
+        if not callbacks:
+            self._callbacks.pop(key, None)
+
+    def dispatch(self, event, payload=b''):
+        """ Call the callbacks for an event """
+        for key in (None, stage_key(event)):
+            for callback in list(self._callbacks.get(key, ())):
+                callback(event, payload)
+
+    def _on_readable(self):
+        """ Read all waiting datagrams, and dispatch their events """
+        while True:
+            try:
+                datagram = self._socket.recv(RCVBUF_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            try:
+                event, payload = decode_event(datagram)
+            except ValueError:
+                continue
+            self.dispatch(event, payload)
+
+
+class StageWaiter(object):
+    """
+    Lets a coroutine wait for events about a stage from a ``Listener``.
+    Events that arrive while nobody is waiting are remembered, so none are
+    missed between waits. They're kept with their payloads until taken with
+    ``pop_events``
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> loop = asyncio.new_event_loop()
+    >>> listener = Listener(loop, tmp_dir.strpath)
+
+    >>> waiter = StageWaiter(listener, ('p', 'j', 's'), loop)
+    >>> listener.dispatch({'project': 'p', 'job': 'j', 'stage': 's'})
+    >>> loop.run_until_complete(waiter.wait(1))
+    True
+    >>> loop.run_until_complete(waiter.wait(0.01))
+    False
+    >>> [(stage_key(event), payload) for event, payload in waiter.pop_events()]
+    [(('p', 'j', 's'), b'')]
+    >>> waiter.pop_events()
+    []
+    >>> waiter.close()
+    >>> loop.close()
+    """
+    def __init__(self, listener, key, loop):
+        self.listener = listener
+        self.key = key
+        self.events = []
+        self._loop = loop
+        self._event = asyncio.Event(loop=loop)
+        if listener is not None:
+            listener.subscribe(key, self._on_event)
+
+    def _on_event(self, event, payload):
+        """ Remember the event, and wake the waiting coroutine """
+        self.events.append((event, payload))
+        self._event.set()
+
+    def pop_events(self):
+        """ Take the ``(event, payload)`` pairs received so far """
+        events, self.events = self.events, []
+        return events
+
+    @asyncio.coroutine
+    def wait(self, timeout):
+        """ Wait for an event. Returns ``False`` if none came in time """
+        try:
+            yield from asyncio.wait_for(
+                self._event.wait(), timeout, loop=self._loop,
+            )
+        except asyncio.TimeoutError:
+            return False
+
+        self._event.clear()
+        return True
+
+    def close(self):
+        """ Stop receiving events """
+        if self.listener is not None:
+            self.listener.unsubscribe(self.key, self._on_event)
+            self.listener = None
@@ -0,0 +1,194 @@
+"""
+Block based new line scanning for log handles. Work is done on large blocks
+using ``bytes.count``/``find``/``rfind``, rather than a byte at a time.
+
+Text handles are scanned through their underlying binary buffer, and then
+moved to the resulting byte offset. This relies on the same assumption the
+line seekers always have: that ``tell`` cookies at line starts are offsets
+"""
+import io
+
+
+BLOCK_SIZE = 64 * 1024
+
+
+def _binary(handle):
+    """ Binary handle, at the same position as ``handle`` """
+    if isinstance(handle, io.TextIOBase):
+        offset = handle.tell()
+        handle = handle.buffer
+        handle.seek(offset)
+    return handle
+
+
+def find_nth(block, char, count):
+    """
+    Index of the ``count``th ``char`` in ``block``, which must contain at
+    least that many. ``block`` can be ``bytes``, a ``bytearray``, or ``str``
+
+    Examples:
+
+    >>> find_nth(b'a\\nb\\nc\\n', b'\\n', 1)
+    1
+    >>> find_nth(b'a\\nb\\nc\\n', b'\\n', 2)
+    3
+    >>> find_nth(bytearray(b'a\\nb\\nc\\n'), b'\\n', 3)
+    5
+    >>> find_nth('a\\nb\\nc\\n', '\\n', 2)
+    3
+    """
+    idx = -1
+    for _ in range(count):
+        idx = block.find(char, idx + 1)
+    return idx
+
+
+def rfind_nth(block, char, count):
+    """
+    Index of the ``count``th ``char`` from the end of ``block``, which must
+    contain at least that many. ``block`` can be ``bytes``, a
+    ``bytearray``, or ``str``
+
+    Examples:
+
+    >>> rfind_nth(b'a\\nb\\nc\\n', b'\\n', 1)
+    5
+    >>> rfind_nth(b'a\\nb\\nc\\n', b'\\n', 2)
+    3
+    >>> rfind_nth(bytearray(b'a\\nb\\nc\\n'), b'\\n', 3)
+    1
+    """
+    idx = len(block)
+    for _ in range(count):
+        idx = block.rfind(char, 0, idx)
+    return idx
+
+
+def skip_lines(handle, count, block_size=BLOCK_SIZE):
+    """
+    Move ahead past ``count`` new lines, or to the end of the file. Returns
+    the new offset
+
+    Examples:
+
+    >>> tmp_file = getfixture('tmpdir').join('test')
+    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
+
+    >>> handle = tmp_file.open()
+    >>> skip_lines(handle, 3, block_size=5)
+    12
+    >>> handle.read(1)
+    'j'
+
+    >>> handle = tmp_file.open()
+    >>> handle.seek(10)
+    10
+    >>> skip_lines(handle, 1)
+    12
+    >>> handle.read(3)
+    'jkl'
+
+    >>> handle = tmp_file.open('rb')
+    >>> skip_lines(handle, 20, block_size=5)
+    19
+    >>> handle.read(1)
+    b''
+    """
+    raw = _binary(handle)
+    offset = raw.tell()
+    while count > 0:
+        block = raw.read(block_size)
+        if not block:
+            break
+
+        found = block.count(b'\n')
+        if found < count:
+            count -= found
+            offset += len(block)
+        else:
+            offset += find_nth(block, b'\n', count) + 1
+            count = 0
+
+    handle.seek(offset)
+    return offset
+
+
+def skip_lines_back(handle, count, block_size=BLOCK_SIZE):
+    """
+    Move to the start of the ``count``th line from the end of the file, or
+    the start of the file if there aren't that many lines. A file ending in a
+    new line ends with an empty line. Returns the new offset
+
+    Examples:
+
+    >>> tmp_file = getfixture('tmpdir').join('test')
+    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
+
+    >>> handle = tmp_file.open()
+    >>> skip_lines_back(handle, 1)
+    16
+    >>> handle.read(3)
+    'mno'
+
+    >>> handle = tmp_file.open('rb')
+    >>> skip_lines_back(handle, 3, block_size=5)
+    8
+    >>> handle.read(1)
+    b'g'
+
+    >>> handle = tmp_file.open('rb')
+    >>> skip_lines_back(handle, 20, block_size=5)
+    0
+
+    >>> tmp_file.write('abc\\n')
+    >>> handle = tmp_file.open('rb')
+    >>> skip_lines_back(handle, 1)
+    4
+    >>> skip_lines_back(handle, 2)
+    0
+    """
+    raw = _binary(handle)
+    offset = raw.seek(0, 2)
+    result = 0
+    while count > 0 and offset > 0:
+        size = min(block_size, offset)
+        offset -= size
+        raw.seek(offset)
+        block = raw.read(size)
+
+        found = block.count(b'\n')
+        if found < count:
+            count -= found
+        else:
+            result = offset + rfind_nth(block, b'\n', count) + 1
+            count = 0
+
+    handle.seek(result)
+    return result
+
+
+def count_newlines(handle, start, end, block_size=BLOCK_SIZE):
+    """
+    Count the new lines in a binary handle between ``start`` and ``end``
+
+    Examples:
+
+    >>> tmp_file = getfixture('tmpdir').join('test')
+    >>> tmp_file.write('abc\\ndef\\nghi\\njkl\\nmno')
+    >>> handle = tmp_file.open('rb')
+
+    >>> count_newlines(handle, 0, 19, block_size=5)
+    4
+    >>> count_newlines(handle, 4, 8, block_size=5)
+    1
+    """
+    handle.seek(start)
+    count = 0
+    remain = end - start
+    while remain > 0:
+        block = handle.read(min(block_size, remain))
+        if not block:
+            break
+        count += block.count(b'\n')
+        remain -= len(block)
+    return count
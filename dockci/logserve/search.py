@@ -0,0 +1,333 @@
+"""
+Server side search of stage logs. Logs are split into segments at line
+starts, and each segment is scanned in large blocks in a worker process, so
+big logs are searched on every core. Segments are cut at the checkpoints of
+a log's line index when it has one, so finding them reads nothing
+"""
+import collections
+import re
+import time
+
+import py
+
+from .archive import open_log
+from .index import LineIndex
+
+
+SEARCH_BLOCK_SIZE = 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+# Most of a log read back to find context lines before a segment
+CONTEXT_WINDOW = 64 * 1024
+
+SegmentResult = collections.namedtuple('SegmentResult', [
+    'matches', 'newlines', 'complete',
+])
+
+
+def compile_pattern(pattern, literal=False, ignore_case=False):
+    """
+    Pattern, and flags to search logs for ``pattern``, as a ``(bytes,
+    int)`` pair that can be sent to worker processes. Raises ``ValueError``
+    if the pattern isn't a valid regular expression
+
+    Examples:
+
+    >>> pattern, flags = compile_pattern('a.c', literal=True)
+    >>> pattern, flags == re.MULTILINE
+    (b'a\\\\.c', True)
+    >>> compile_pattern('(')
+    Traceback (most recent call last):
+      ...
+    ValueError: Invalid pattern: missing ), unterminated subpattern...
+    """
+    pattern = pattern.encode()
+    if literal:
+        pattern = re.escape(pattern)
+    flags = re.MULTILINE
+    if ignore_case:
+        flags |= re.IGNORECASE
+
+    try:
+        re.compile(pattern, flags)
+    except re.error as ex:
+        raise ValueError("Invalid pattern: %s" % ex)
+    return pattern, flags
+
+
+def plan_segments(log_path, segment_size=DEFAULT_SEGMENT_SIZE):
+    """
+    Split a log into ``(start, end)`` segments of about ``segment_size``
+    bytes that start at line starts
+
+    Examples:
+
+    >>> from .index import index_path
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage')
+    >>> log_path.write('abc\\ndefgh\\nij\\nklm')
+    >>> plan_segments(log_path, 4)
+    [(0, 4), (4, 10), (10, 16)]
+    >>> plan_segments(log_path)
+    [(0, 16)]
+
+    >>> index = LineIndex(stride=1)
+    >>> index.feed(log_path.read_binary())
+    >>> index.save(index_path(log_path))
+    True
+    >>> plan_segments(log_path, 4)
+    [(0, 4), (4, 10), (10, 16)]
+    """
+    with open_log(log_path) as handle:
+        size = handle.seek(0, 2)
+        index = LineIndex.for_log(log_path, handle)
+
+        if index is None:
+            starts = _probe_starts(handle, size, segment_size)
+        else:
+            starts = _index_starts(index, segment_size)
+
+    segments = []
+    start = 0
+    for cut in starts:
+        if start < cut < size:
+            segments.append((start, cut))
+            start = cut
+    segments.append((start, size))
+    return segments
+
+
+def _index_starts(index, segment_size):
+    """ Line starts from index checkpoints, about ``segment_size`` apart """
+    starts = []
+    last = 0
+    for offset in index.checkpoints:
+        if offset - last >= segment_size:
+            starts.append(offset)
+            last = offset
+    return starts
+
+
+def _probe_starts(handle, size, segment_size):
+    """ Line starts about ``segment_size`` apart, found by reading ahead
+    from each cut for the next new line """
+    starts = []
+    offset = segment_size
+    while offset < size:
+        handle.seek(offset - 1)
+        while True:
+            block = handle.read(CONTEXT_WINDOW)
+            if not block:
+                return starts
+            idx = block.find(b'\n')
+            if idx >= 0:
+                break
+        offset = handle.tell() - len(block) + idx + 1
+        starts.append(offset)
+        offset += segment_size
+    return starts
+
+
+def _lines_before(block, pos, count, previous=()):
+    """
+    Up to ``count`` lines before the line starting at ``pos`` in
+    ``block``, continuing into ``previous`` lines if the block runs out
+
+    Examples:
+
+    >>> _lines_before(b'a\\nb\\nc\\n', 4, 5, [b'z'])
+    [b'z', b'a', b'b']
+    >>> _lines_before(b'a\\nb\\nc\\n', 4, 1, [b'z'])
+    [b'b']
+    """
+    lines = []
+    end = pos
+    while len(lines) < count and end > 0:
+        start = block.rfind(b'\n', 0, end - 1) + 1
+        lines.append(block[start:end - 1])
+        end = start
+    lines.reverse()
+
+    missing = count - len(lines)
+    if missing > 0:
+        lines = list(previous)[-missing:] + lines
+    return lines
+
+
+def _lines_after(block, pos, count):
+    """
+    Up to ``count`` lines starting at ``pos`` in ``block``, and the offset
+    after them
+
+    Examples:
+
+    >>> _lines_after(b'a\\nb\\nc', 2, 5)
+    ([b'b', b'c'], 6)
+    """
+    lines = []
+    while len(lines) < count and pos < len(block):
+        end = block.find(b'\n', pos)
+        if end < 0:
+            end = len(block)
+        lines.append(block[pos:end])
+        pos = end + 1
+    return lines, pos
+
+
+def _decode(line):
+    """ Text of a line from a log """
+    return line.decode('utf-8', 'replace')
+
+
+def _context_before(handle, start, context):
+    """ The ``context`` lines before offset ``start``, which is a line
+    start, read back from the handle """
+    if not context or not start:
+        return []
+    window_start = max(start - CONTEXT_WINDOW, 0)
+    handle.seek(window_start)
+    block = handle.read(start - window_start)
+    lines = _lines_before(block, len(block), context)
+    # A line cut by the window isn't a whole line
+    if window_start and len(lines) == block.count(b'\n'):
+        lines = lines[1:]
+    return lines
+
+
+def search_segment(  # pylint:disable=too-many-arguments,too-many-locals
+        log_path, start, end, pattern, flags, context=0, max_results=1000,
+        deadline=None, block_size=SEARCH_BLOCK_SIZE,
+):
+    """
+    Search the lines of a log between offsets ``start``, and ``end`` for a
+    pattern from ``compile_pattern``. Each matching line is returned once as
+    a dict with its ``line`` number relative to ``start``, the ``offset`` of
+    the line, its ``text``, and up to ``context`` lines ``before``, and
+    ``after`` it. The number of ``newlines`` in the segment is returned too,
+    so that line numbers can be made absolute. Scanning stops after
+    ``max_results`` matches, or at the ``deadline`` (a ``time.time()``
+    value, so that it's the same in every process), in which case the
+    result isn't ``complete``. This runs in a worker process, so it only
+    takes, and returns picklable values
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage')
+    >>> log_path.write('ok 1\\nerror 2\\nok 3\\nok 4\\nerror 5 error\\nok 6')
+    >>> pattern, flags = compile_pattern('ERROR', ignore_case=True)
+
+    >>> result = search_segment(log_path.strpath, 5, 37, pattern, flags, 1)
+    >>> result.newlines, result.complete
+    (4, True)
+    >>> for match in result.matches:
+    ...     print(match['line'], match['offset'], match['text'],
+    ...           match['before'], match['after'])
+    0 5 error 2 ['ok 1'] ['ok 3']
+    3 23 error 5 error ['ok 4'] ['ok 6']
+
+    >>> result = search_segment(
+    ...     log_path.strpath, 0, 41, pattern, flags, block_size=4,
+    ... )
+    >>> [(match['line'], match['offset']) for match in result.matches]
+    [(1, 5), (4, 23)]
+
+    >>> result = search_segment(
+    ...     log_path.strpath, 0, 41, pattern, flags, max_results=1,
+    ... )
+    >>> len(result.matches), result.complete
+    (1, False)
+
+    >>> pattern, flags = compile_pattern('^$')
+    >>> log_path.write('a\\n\\nb\\n')
+    >>> [match['line'] for match in search_segment(
+    ...     log_path.strpath, 0, 5, pattern, flags, block_size=2,
+    ... ).matches]
+    [1]
+    >>> search_segment(
+    ...     log_path.strpath, 0, 5, pattern, flags, deadline=time.time() - 1,
+    ... )
+    SegmentResult(matches=[], newlines=0, complete=False)
+    """
+    regex = re.compile(pattern, flags)
+    matches = []
+    newlines = 0
+    previous = collections.deque(maxlen=context)
+    # Matches still waiting for lines after them
+    waiting = []
+
+    with open_log(py.path.local(log_path)) as handle:
+        previous.extend(_context_before(handle, start, context))
+
+        handle.seek(start)
+        offset = block_start = start
+        carry = b''
+        while True:
+            if deadline is not None and time.time() > deadline:
+                return SegmentResult(matches, newlines, False)
+
+            data = b''
+            if offset < end:
+                data = handle.read(min(block_size, end - offset))
+                offset += len(data)
+            block = carry + data
+            if not block:
+                break
+
+            # Only whole lines are scanned, until the end of the segment
+            carry = b''
+            if data and offset < end:
+                cut = block.rfind(b'\n') + 1
+                block, carry = block[:cut], block[cut:]
+
+            for match, remain in waiting:
+                lines, _ = _lines_after(block, 0, remain)
+                match['after'].extend(_decode(line) for line in lines)
+            waiting = [
+                (match, context - len(match['after']))
+                for match, _ in waiting if len(match['after']) < context
+            ]
+
+            pos = 0
+            found = regex.search(block)
+            # Empty matches after a new line at the end of the block are at
+            # the start of the next block, or after the end of the log
+            while found is not None and not (
+                    found.start() == len(block) and block.endswith(b'\n')
+            ):
+                line_start = block.rfind(b'\n', 0, found.start()) + 1
+                line_end = block.find(b'\n', found.start())
+                if line_end < 0:
+                    line_end = len(block)
+
+                newlines += block.count(b'\n', pos, line_start)
+                pos = line_start
+                after, _ = _lines_after(block, line_end + 1, context)
+                match = {
+                    'line': newlines,
+                    'offset': block_start + line_start,
+                    'text': _decode(block[line_start:line_end]),
+                    'before': [
+                        _decode(line) for line in
+                        _lines_before(block, line_start, context, previous)
+                    ],
+                    'after': [_decode(line) for line in after],
+                }
+                matches.append(match)
+                if len(after) < context:
+                    waiting.append((match, context - len(after)))
+                if len(matches) >= max_results:
+                    return SegmentResult(matches, newlines, False)
+
+                found = regex.search(block, line_end + 1)
+
+            newlines += block.count(b'\n', pos)
+            previous.extend(_lines_before(block, len(block), context))
+            block_start += len(block)
+
+        # Lines after the segment, for matches at its end
+        if waiting:
+            lines, _ = _lines_after(handle.read(CONTEXT_WINDOW), 0, context)
+            for match, remain in waiting:
+                match['after'].extend(_decode(line) for line in lines[:remain])
+
+    return SegmentResult(matches, newlines, True)
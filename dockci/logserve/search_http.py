@@ -0,0 +1,252 @@
+""" HTTP API for searching stage logs """
+import asyncio
+import collections
+import json
+import time
+
+import py
+
+from aiohttp import web
+
+from .aiofile import run_io
+from .api import instrumented, try_qs_int
+from .logs import job_stage_slugs, resolve_log
+from .search import compile_pattern, plan_segments, search_segment
+
+
+def _recent_jobs(project_slug, count):
+    """
+    Slugs of the ``count`` most recently changed jobs of a project, newest
+    first, or ``None`` if the project has no log directory
+
+    Examples:
+
+    >>> monkeypatch = getfixture('monkeypatch')
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> monkeypatch.chdir(tmp_dir)
+    >>> for job_slug, mtime in (('a', 30), ('b', 10), ('c', 20)):
+    ...     job_path = tmp_dir.join('data', 'p', job_slug).ensure(dir=True)
+    ...     job_path.setmtime(mtime)
+    >>> _recent_jobs('p', 2)
+    ['a', 'c']
+    >>> _recent_jobs('other', 2)
+    """
+    try:
+        job_paths = py.path.local('data').join(project_slug).listdir(
+            lambda path: (
+                path.check(dir=True) and not path.basename.startswith('.')
+            )
+        )
+    except py.error.ENOENT:
+        return None
+
+    job_paths.sort(key=lambda path: path.mtime(), reverse=True)
+    return [path.basename for path in job_paths[:count]]
+
+
+def _search_params(request):
+    """ Pattern, flags, context lines, result limit, timeout, and number of
+    recent jobs of a search request. Raises ``ValueError`` if any are
+    invalid """
+    app = request.app
+    query = request.GET.get('q')
+    if not query:
+        raise ValueError("q is required")
+
+    pattern, flags = compile_pattern(
+        query,
+        literal=bool(try_qs_int(request, 'literal')),
+        ignore_case=bool(try_qs_int(request, 'ignore_case')),
+    )
+
+    context = try_qs_int(request, 'context') or 0
+    limit = try_qs_int(request, 'limit') or app.search_max_results
+    timeout = try_qs_int(request, 'timeout') or app.search_timeout
+    jobs = try_qs_int(request, 'jobs') or 10
+    if context < 0 or limit < 0 or timeout < 0 or jobs < 0:
+        raise ValueError(
+            "context, limit, timeout, and jobs can't be negative"
+        )
+
+    return (
+        pattern, flags, min(context, app.search_max_context),
+        min(limit, app.search_max_results), min(timeout, app.search_timeout),
+        min(jobs, app.search_max_jobs),
+    )
+
+
+@asyncio.coroutine
+def _search_keys(request, jobs):
+    """ Stage keys to search, in the order results are sent, or ``None`` if
+    the project, or job wasn't found. For a project, the stages of its most
+    recent ``jobs`` are searched """
+    params = request.match_info
+    project_slug = params['project_slug']
+    if 'stage_slug' in params:
+        return [(project_slug, params['job_slug'], params['stage_slug'])]
+
+    if 'job_slug' in params:
+        job_slugs = [params['job_slug']]
+    else:
+        job_slugs = yield from run_io(
+            request, _recent_jobs, project_slug, jobs,
+        )
+        if job_slugs is None:
+            return None
+
+    keys = []
+    for job_slug in job_slugs:
+        stage_slugs = yield from run_io(
+            request, job_stage_slugs, project_slug, job_slug,
+        )
+        if stage_slugs is None and 'job_slug' in params:
+            return None
+        keys.extend(
+            (project_slug, job_slug, stage_slug)
+            for stage_slug in stage_slugs or ()
+        )
+    return keys
+
+
+class SearchResults(object):
+    """
+    Sends the results of scanned log segments as NDJSON, in log order.
+    Segments are scanned out of order, so line numbers are relative to
+    their segment; they're made absolute here, from the new lines counted
+    in the segments before
+    """
+    def __init__(self, response, limit):
+        self.response = response
+        self.limit = limit
+        self.matches = 0
+        self.timed_out = False
+        self._line = 0
+
+    @property
+    def done(self):
+        """ Whether no more results can be sent """
+        return self.timed_out or self.matches >= self.limit
+
+    def send(self, key, first, result):
+        """ Send the matches of a segment. ``first`` is whether it's the
+        first segment of a stage """
+        if first:
+            self._line = 0
+
+        lines = []
+        for match in result.matches[:self.limit - self.matches]:
+            match['line'] += self._line
+            match.update(
+                type='match', project=key[0], job=key[1], stage=key[2],
+            )
+            lines.append(json.dumps(match, sort_keys=True) + '\n')
+
+        self._line += result.newlines
+        self.matches += len(lines)
+        if not result.complete and self.matches < self.limit:
+            self.timed_out = True
+        if lines:
+            self.response.write(''.join(lines).encode())
+
+    def send_summary(self):
+        """ Send the last line, which says why the results ended """
+        self.response.write((json.dumps({
+            'type': 'summary',
+            'matches': self.matches,
+            'truncated': self.matches >= self.limit,
+            'timed_out': self.timed_out,
+        }, sort_keys=True) + '\n').encode())
+
+
+@asyncio.coroutine
+def _search(request, results, keys,  # pylint:disable=too-many-arguments
+            pattern, flags, context, deadline):
+    """
+    Scan the logs of stages for a pattern on the search executor, and send
+    the results. A few more segments than there are workers are queued
+    ahead of the one being sent, so workers are kept busy without scanning
+    far past the result limit
+    """
+    app = request.app
+    pending = collections.deque()
+
+    @asyncio.coroutine
+    def send_next():
+        """ Wait for the oldest pending segment, and send its results """
+        key, first, future = pending.popleft()
+        results.send(key, first, (yield from future))
+        yield from results.response.drain()
+
+    try:
+        for key in keys:
+            found = yield from resolve_log(request, key)
+            if found is None:
+                continue
+            log_path = found[0]
+            segments = yield from run_io(
+                request, plan_segments, log_path, app.search_segment_size,
+            )
+
+            for idx, (start, end) in enumerate(segments):
+                while len(pending) > app.search_workers and not results.done:
+                    yield from send_next()
+                if results.done:
+                    return
+
+                pending.append((key, idx == 0, app.loop.run_in_executor(
+                    app.search_executor, search_segment,
+                    log_path.strpath, start, end, pattern, flags, context,
+                    results.limit, deadline,
+                )))
+
+        while pending and not results.done:
+            yield from send_next()
+
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+
+
+@instrumented('search')
+@asyncio.coroutine
+def handle_search(request):
+    """
+    Search the logs of a stage, every stage of a job, or the stages of a
+    project's most recent ``jobs`` for lines matching the regular expression
+    ``q``. With ``literal``, ``q`` is plain text; with ``ignore_case``,
+    case is ignored.
+
+    Matching lines are streamed as NDJSON in log order, each with its stage,
+    ``line`` number, byte ``offset``, ``text``, and ``context`` lines
+    ``before``, and ``after`` it. A ``summary`` line comes last, saying
+    whether the results were ``truncated`` at the ``limit``, or
+    ``timed_out`` after ``timeout`` seconds
+    """
+    try:
+        pattern, flags, context, limit, timeout, jobs = _search_params(
+            request,
+        )
+    except ValueError as ex:
+        return web.Response(body=str(ex).encode(), status=400)
+
+    keys = yield from _search_keys(request, jobs)
+    if keys is None:
+        return web.Response(status=404)
+    if 'stage_slug' in request.match_info:
+        found = yield from resolve_log(request, keys[0])
+        if found is None:
+            return web.Response(status=404)
+
+    response = web.StreamResponse(status=200, headers={
+        'content-type': 'application/x-ndjson',
+        'cache-control': 'no-cache',
+    })
+    yield from response.prepare(request)
+
+    results = SearchResults(response, limit)
+    yield from _search(
+        request, results, keys, pattern, flags, context,
+        time.time() + timeout,
+    )
+    results.send_summary()
+    return response
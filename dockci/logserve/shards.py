@@ -0,0 +1,83 @@
+""" How the consumer shares stages between worker processes """
+
+
+class ShardConfig(object):
+    """
+    Which messages a consumer gets. Unsharded, it gets every message from
+    an exclusive ``queue``. Sharded, messages come through a consistent hash
+    exchange instead, so that every stage is consumed by exactly one shard,
+    and its log stays in order. Shard queues aren't exclusive, so that
+    stages keep their shard while a worker restarts; instead, only one
+    consumer may consume from each. They're removed by the broker after
+    ``expires`` seconds without a consumer, so that they don't keep
+    collecting messages if the number of shards changes.
+
+    Status messages have their own routing keys, so they can't be hashed to
+    the shard of their stage. Instead, only ``STATUS_SHARD`` gets them. It
+    passes each finished stage on through the shard exchange, as a message
+    of type ``FINALIZE_TYPE`` with the stage's content routing key. That
+    reaches the shard writing the stage after all of the stage's content,
+    so only that shard finalizes it, once it's all written
+
+    Examples:
+
+    >>> unsharded = ShardConfig('dockci.logserve')
+    >>> unsharded.queue, unsharded.name, unsharded.gets_status
+    ('dockci.logserve', 'consumer', True)
+    >>> sharded = ShardConfig('dockci.logserve', 2)
+    >>> sharded.queue, sharded.name, sharded.gets_status
+    ('dockci.logserve.shard.2', 'consumer.2', False)
+    >>> ShardConfig('dockci.logserve', 0).gets_status
+    True
+    >>> unsharded.queue_arguments()
+    {'exclusive': True}
+    >>> ShardConfig('dockci.logserve', 2, expires=10).queue_arguments()
+    {'arguments': {'x-expires': 10000}}
+    >>> ShardConfig.content_key(('proj', 'job', 'stage'))
+    'dockci.proj.job.stage.content'
+    """
+    EXCHANGE = 'dockci.logserve.shards'
+    EXCHANGE_TYPE = 'x-consistent-hash'
+    QUEUE = 'dockci.logserve.shard.%s'
+    WEIGHT = '1'
+    STATUS_SHARD = 0
+    FINALIZE_TYPE = 'dockci.logserve.finalize'
+
+    def __init__(self, queue, shard=None, expires=300):
+        self.unsharded_queue = queue
+        self.shard = shard
+        self.expires = expires
+
+    @property
+    def sharded(self):
+        """ Whether messages come through the shard exchange """
+        return self.shard is not None
+
+    @property
+    def gets_status(self):
+        """ Whether status messages come to this consumer """
+        return self.shard in (None, self.STATUS_SHARD)
+
+    @property
+    def queue(self):
+        """ Name of the queue to consume """
+        if self.shard is None:
+            return self.unsharded_queue
+        return self.QUEUE % self.shard
+
+    @property
+    def name(self):
+        """ Name of the consumer in its events """
+        return 'consumer' if self.shard is None else 'consumer.%s' % self.shard
+
+    def queue_arguments(self):
+        """ Extra args to declare the queue with """
+        if self.shard is None:
+            return {'exclusive': True}
+        return {'arguments': {'x-expires': int(self.expires * 1000)}}
+
+    @staticmethod
+    def content_key(key):
+        """ Routing key of content for a stage, which the shard exchange
+        hashes to the stage's shard """
+        return 'dockci.%s.%s.%s.content' % key
@@ -0,0 +1,49 @@
+""" Stage, and job status messages """
+import json
+
+
+# States in status messages for stages, and jobs that have finished
+FINAL_STATES = frozenset((
+    'success', 'fail', 'failed', 'broken', 'error', 'errored',
+    'cancelled', 'canceled', 'done', 'complete', 'completed', 'finished',
+))
+
+
+def is_final_status(body):
+    """
+    Whether a status message body says that its stage, or job has finished.
+    The body is a JSON object with a ``state`` (or ``status``), or a
+    ``success`` flag that's ``null`` until finished; or just the state
+
+    Examples:
+
+    >>> is_final_status(b'{"state": "running"}')
+    False
+    >>> is_final_status(b'{"state": "success"}')
+    True
+    >>> is_final_status(b'{"status": "Broken"}')
+    True
+    >>> is_final_status(b'{"success": null}')
+    False
+    >>> is_final_status(b'{"success": false}')
+    True
+    >>> is_final_status(b'fail')
+    True
+    >>> is_final_status(b'\\xff')
+    False
+    """
+    try:
+        text = body.decode()
+    except UnicodeDecodeError:
+        return False
+    try:
+        status = json.loads(text)
+    except ValueError:
+        status = text.strip()
+
+    if isinstance(status, dict):
+        if 'state' in status or 'status' in status:
+            status = status.get('state', status.get('status'))
+        else:
+            return status.get('success') is not None
+    return isinstance(status, str) and status.lower() in FINAL_STATES
@@ -0,0 +1,818 @@
+""" Append side of stage log storage, used by the consumer """
+import collections
+import fcntl
+import functools
+import json
+import os
+import shutil
+import time
+
+import py
+
+from .archive import archive_path, is_archive, ArchiveReader
+from .index import build_index, index_path, LineIndex
+from .metrics import Counter, Histogram
+from .notify import MAX_PAYLOAD
+
+
+DURABILITY_NONE = 'none'
+DURABILITY_FLUSH = 'flush'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_CHOICES = (DURABILITY_NONE, DURABILITY_FLUSH, DURABILITY_FSYNC)
+
+FLUSH_SECONDS = Histogram(
+    'logserve_writer_flush_seconds',
+    'Time to write buffered data to a stage log, and its index.',
+)
+FLUSH_BYTES = Counter(
+    'logserve_writer_flushed_bytes_total', 'Bytes written to stage logs.',
+)
+FSYNC_SECONDS = Histogram(
+    'logserve_writer_fsync_seconds', 'Time to fsync a stage log.',
+)
+RESTORED_LOGS = Counter(
+    'logserve_writer_restored_logs_total',
+    'Compacted stage logs restored from their archive to be appended to.',
+)
+
+
+def final_path(log_path):
+    """
+    Path to the marker recording that a stage log is complete
+
+    Examples:
+
+    >>> final_path(py.path.local('/data/proj/job/stage')).strpath
+    '/data/proj/job/.stage.final'
+    """
+    return log_path.dirpath().join('.%s.final' % log_path.basename)
+
+
+def load_final(log_path):
+    """
+    The final ``size``, and ``lines`` of a complete stage log as a dict, or
+    ``None`` if it's still being written
+    """
+    try:
+        final = json.loads(final_path(log_path).read())
+    except (py.error.ENOENT, ValueError):
+        return None
+    return final if isinstance(final, dict) else None
+
+
+def finalize_log(log_path):
+    """
+    Record that a stage log is complete, with its current size, and line
+    count. An existing marker is only replaced if the log has grown. Returns
+    the marker
+
+    Examples:
+
+    >>> log_path = getfixture('tmpdir').join('stage')
+    >>> log_path.write('abc\\ndef')
+    >>> final = finalize_log(log_path)
+    >>> final['size'], final['lines']
+    (7, 2)
+    >>> load_final(log_path) == final
+    True
+
+    >>> log_path.write('abc\\ndef\\n')
+    >>> finalize_log(log_path)['size']
+    8
+    """
+    final = load_final(log_path)
+    size = log_path.size()
+    if final is not None and final.get('size', -1) >= size:
+        return final
+
+    with log_path.open('rb') as handle:
+        index = LineIndex.for_log(log_path, handle)
+    if index is None:
+        index = build_index(log_path, exclusive=False)
+
+    final = {'size': index.size, 'lines': index.lines}
+    save_final(log_path, final)
+    return final
+
+
+def save_final(log_path, final):
+    """ Write the final marker for a log """
+    marker_path = final_path(log_path)
+    tmp_path = marker_path.dirpath().join('.%s.%s.tmp' % (
+        marker_path.basename, os.getpid(),
+    ))
+    tmp_path.write(json.dumps(final, sort_keys=True))
+    os.rename(tmp_path.strpath, marker_path.strpath)
+
+
+def restore_log(log_path):
+    """
+    Decompress the archive of a compacted stage log back to a plain log, so
+    that it can be appended to. The plain log keeps the archive's final
+    marker, and modification time, so it looks the same to readers until it
+    grows. The archive, and its sidecar files are removed once the plain log
+    is in place. Returns whether there was an archive
+
+    Examples:
+
+    >>> from .compact import compact_log
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> log_path = tmp_dir.join('stage')
+    >>> log_path.write('abc\\ndef\\n')
+    >>> _ = finalize_log(log_path)
+    >>> _ = compact_log(log_path)
+    >>> restore_log(log_path)
+    True
+    >>> sorted(path.basename for path in tmp_dir.listdir())
+    ['.stage.final', 'stage']
+    >>> log_path.read_binary(), load_final(log_path)['size']
+    (b'abc\\ndef\\n', 8)
+    >>> restore_log(log_path)
+    False
+    """
+    archive = archive_path(log_path)
+    tmp_path = log_path.dirpath().join('.%s.%s.tmp' % (
+        log_path.basename, os.getpid(),
+    ))
+    try:
+        reader = ArchiveReader.open(archive)
+    except py.error.ENOENT:
+        return False
+
+    try:
+        with reader, tmp_path.open('wb') as dest:
+            shutil.copyfileobj(reader, dest, reader.frame_size)
+            dest.flush()
+            os.fsync(dest.fileno())
+        stat = archive.stat()
+        os.utime(tmp_path.strpath, ns=(stat.atime_ns, stat.mtime_ns))
+
+        final = load_final(archive)
+        if final is not None:
+            save_final(log_path, final)
+        try:
+            # Never replace a plain log, which has everything in the archive
+            os.link(tmp_path.strpath, log_path.strpath)
+        except FileExistsError:
+            pass
+
+    finally:
+        if tmp_path.check():
+            tmp_path.remove()
+
+    remove_archive(log_path)
+    RESTORED_LOGS.inc()
+    return True
+
+
+def remove_archive(log_path):
+    """ Remove the archive of a stage log, and its sidecar files """
+    archive = archive_path(log_path)
+    for path in (archive, index_path(archive), final_path(archive)):
+        try:
+            path.remove()
+        except py.error.ENOENT:
+            pass
+
+
+class WriteBuffer(object):
+    """
+    Data appended to a stage log in memory, and not yet written out. It's
+    ``dirty`` from the first append until the policy applied at commit has
+    made everything durable. The first ``acked`` chunks were acknowledged
+    while still buffered; the rest can be discarded if the connection to
+    the broker is lost, since they'll be redelivered
+
+    Examples:
+
+    >>> buffer = WriteBuffer()
+    >>> buffer.append(b'abc', now=10)
+    >>> buffer.append(b'de', now=11)
+    >>> buffer.size, buffer.since, buffer.dirty
+    (5, 10, True)
+    >>> buffer.ack()
+    >>> buffer.append(b'fg', now=12)
+    >>> buffer.peek(buffer.acked)
+    b'abcde'
+    >>> buffer.discard_unacked()
+    2
+    >>> buffer.drop()
+    >>> buffer.size, buffer.since, buffer.acked, buffer.dirty
+    (0, None, 0, True)
+    """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.since = None
+        self.acked = 0
+        self.dirty = False
+
+    def append(self, data, now=None):
+        """ Add data to the end of the buffer """
+        self.dirty = True
+        if self.since is None:
+            self.since = time.monotonic() if now is None else now
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def ack(self):
+        """ Mark everything in the buffer as acknowledged """
+        self.acked = len(self.chunks)
+
+    def peek(self, count=None):
+        """ Data of the first ``count`` chunks, or all of them """
+        return b''.join(self.chunks[:count])
+
+    def drop(self, count=None):
+        """ Remove the first ``count`` chunks, or all of them, once they've
+        been written out """
+        if count is None:
+            count = len(self.chunks)
+        self._remove(0, count)
+        self.acked = max(self.acked - count, 0)
+
+    def discard_unacked(self):
+        """ Remove the chunks that haven't been acknowledged. Returns the
+        number of bytes removed """
+        return self._remove(self.acked, len(self.chunks))
+
+    def _remove(self, start, end):
+        """ Remove a slice of chunks. Returns the number of bytes removed """
+        removed = sum(len(chunk) for chunk in self.chunks[start:end])
+        del self.chunks[start:end]
+        self.size -= removed
+        if not self.chunks:
+            self.since = None
+        return removed
+
+
+class StageWriter(object):
+    """
+    Coalesces appends to a single stage log in memory, writing them to the
+    file in one call when flushed. The file handle is opened lazily, and kept
+    open until ``close`` is called. While it's open, it holds a shared lock
+    on the log, so that the log isn't compacted under it. A stage that has
+    been compacted is restored from its archive when it's opened, so that
+    late data is appended to the rest of the log. The log's ``LineIndex``
+    sidecar is kept up to date with each flush, and ``on_flush`` is called
+    with the writer, and the data after it's been written
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> stage_path = tmp_dir.join('project', 'job', 'stage')
+
+    >>> writer = StageWriter(stage_path)
+    >>> writer.write(b'abc')
+    >>> writer.write(b'def')
+    >>> writer.buffered
+    6
+    >>> stage_path.check()
+    False
+
+    >>> writer.flush()
+    >>> writer.buffered
+    0
+    >>> stage_path.read_binary()
+    b'abcdef'
+    >>> writer.index.size
+    6
+
+    >>> writer.write(b'ghi')
+    >>> writer.dirty
+    True
+    >>> writer.sync()
+    >>> writer.dirty
+    False
+    >>> writer.close()
+    >>> stage_path.read_binary()
+    b'abcdefghi'
+    >>> LineIndex.load(index_path(stage_path)).size
+    9
+    """
+    def __init__(self, path, key=None, on_flush=None):
+        self.path = path
+        self.key = key
+        self.on_flush = on_flush
+        self.index = None
+        self._handle = None
+        self._index_handle = None
+        self.buffer = WriteBuffer()
+
+    @property
+    def buffered(self):
+        """ Number of bytes buffered """
+        return self.buffer.size
+
+    @property
+    def buffered_since(self):
+        """ When the oldest buffered data was written, or ``None`` """
+        return self.buffer.since
+
+    @property
+    def dirty(self):
+        """ Whether data has been written since the last durable commit """
+        return self.buffer.dirty
+
+    def write(self, data):
+        """ Add data to the end of the buffer """
+        if data:
+            self.buffer.append(data)
+
+    def _open(self):
+        """ Open, and lock the append handle, creating the job directory if
+        needed. The log is only created if it hasn't been compacted; if it
+        was compacted while waiting for the lock, the handle is reopened """
+        self.path.dirpath().ensure(dir=True)
+        flags = os.O_WRONLY | os.O_APPEND
+        while True:
+            try:
+                fileno = os.open(self.path.strpath, flags, 0o644)
+            except FileNotFoundError:
+                if not restore_log(self.path):
+                    flags |= os.O_CREAT
+                continue
+
+            # We do our own buffering, so don't double up in the io layer
+            handle = open(fileno, 'ab', buffering=0)
+            fcntl.flock(fileno, fcntl.LOCK_SH)
+            try:
+                if os.path.samestat(os.fstat(fileno), os.stat(str(self.path))):
+                    break
+            except FileNotFoundError:
+                pass
+            handle.close()
+
+        # An archive left by interrupted compaction would be out of date
+        remove_archive(self.path)
+        self._open_index()
+        return handle
+
+    def _open_index(self):
+        """ Load the line index, rebuilding it if it's missing or stale """
+        idx_path = index_path(self.path)
+        index = LineIndex.load(idx_path)
+        size = self.path.size()
+
+        if index is None or index.size > size:
+            index = LineIndex()
+        if index.size < size or not idx_path.check():
+            with self.path.open('rb') as handle:
+                index.catch_up(handle, size)
+            index.save(idx_path)
+
+        self.index = index
+        self._index_handle = open(idx_path.strpath, 'r+b', buffering=0)
+
+    def flush(self, acked_only=False):
+        """
+        Write buffered data to the file in a single call. With
+        ``acked_only``, only data acknowledged while buffered is written. If
+        the write fails, anything partially written is truncated, and the
+        data is kept in the buffer, so that the next flush of this writer
+        retries it
+        """
+        count = self.buffer.acked if acked_only else len(self.buffer.chunks)
+        if not count:
+            return
+
+        if self._handle is None:
+            self._handle = self._open()
+
+        data = self.buffer.peek(count)
+
+        with FLUSH_SECONDS.time():
+            view = memoryview(data)
+            try:
+                while view:
+                    view = view[self._handle.write(view):]
+            except OSError:
+                self._handle.truncate(self.index.size)
+                raise
+
+            self.buffer.drop(count)
+            self.index.feed(data)
+            self.index.sync(self._index_handle)
+        FLUSH_BYTES.inc(len(data))
+
+        if self.on_flush is not None:
+            self.on_flush(self, data)
+
+    def sync(self):
+        """ Flush buffered data, and fsync the file """
+        self.flush()
+        if self._handle is not None:
+            with FSYNC_SECONDS.time():
+                os.fsync(self._handle.fileno())
+        self.buffer.dirty = False
+
+    def close(self):
+        """ Flush remaining data, and close the handle """
+        try:
+            self.flush()
+        finally:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            if self._index_handle is not None:
+                self._index_handle.close()
+                self._index_handle = None
+
+
+class StageWriterPool(object):
+    """
+    Bounded LRU pool of ``StageWriter`` objects keyed by project, job, and
+    stage slugs. When the pool is full, the least recently written stage is
+    flushed and closed to make room.
+
+    Buffered data is written out by ``commit``, which applies the
+    ``durability`` policy to every stage written since the last commit:
+    ``none`` leaves data in the buffers unless they've reached
+    ``buffer_size`` bytes, ``flush`` writes buffers out to the OS, and
+    ``fsync`` also waits for them to reach disk. ``write`` returns whether a
+    buffer has reached ``buffer_size``, so the caller knows to commit. Data
+    that was acknowledged while buffered is written by ``flush_due`` once
+    it has been held for ``buffer_age`` seconds; data that wasn't is
+    dropped by ``discard_unacked``, since it will be redelivered.
+
+    If a ``notifier`` is given, an ``append`` event is published each time
+    data is written out to a stage, with the end of the data as its payload,
+    and a ``finalize`` event when a stage is finalized
+
+    Examples:
+
+    >>> tmp_dir = getfixture('tmpdir')
+    >>> pool = StageWriterPool(tmp_dir, max_handles=2, buffer_size=4)
+
+    >>> pool.write('proj', 'job', 'a', b'ab')
+    False
+    >>> pool.write('proj', 'job', 'b', b'cd')
+    False
+    >>> tmp_dir.join('proj', 'job', 'a').check()
+    False
+
+    Buffer size threshold reached
+
+    >>> pool.write('proj', 'job', 'a', b'ef')
+    True
+    >>> pool.commit()
+    >>> tmp_dir.join('proj', 'job', 'a').read_binary()
+    b'abef'
+
+    Evicts ``b``, which has been written least recently
+
+    >>> _ = pool.write('proj', 'job', 'b', b'ij')
+    >>> _ = pool.write('proj', 'job', 'a', b'kl')
+    >>> _ = pool.write('proj', 'job', 'c', b'gh')
+    >>> len(pool)
+    2
+    >>> tmp_dir.join('proj', 'job', 'b').read_binary()
+    b'cdij'
+
+    Unacknowledged data is dropped, rather than written
+
+    >>> pool.discard_unacked()
+    4
+    >>> pool.close_all()
+    >>> len(pool)
+    0
+    >>> tmp_dir.join('proj', 'job', 'a').read_binary()
+    b'abef'
+    >>> tmp_dir.join('proj', 'job', 'c').check()
+    False
+
+    Buffers acknowledged under the ``none`` policy are written once due
+
+    >>> pool = StageWriterPool(tmp_dir, durability='none', buffer_age=1)
+    >>> _ = pool.write('proj', 'job', 'd', b'kl')
+    >>> pool.commit()
+    >>> _ = pool.write('proj', 'job', 'd', b'mn')
+    >>> pool.flush_due(now=time.monotonic() + 1)
+    >>> tmp_dir.join('proj', 'job', 'd').read_binary()
+    b'kl'
+    >>> pool.discard_unacked()
+    2
+
+    >>> pool = StageWriterPool(tmp_dir, durability='flush')
+    >>> _ = pool.write('proj', 'job', 'd', b'mn')
+    >>> pool.commit()
+    >>> tmp_dir.join('proj', 'job', 'd').read_binary()
+    b'klmn'
+
+    >>> _ = pool.write('proj', 'job', 'd', b'op')
+    >>> ('proj', 'job', 'd') in pool
+    True
+    >>> pool.finalize('proj', 'job', 'd')['size']
+    6
+    >>> ('proj', 'job', 'd') in pool
+    False
+    >>> pool.finalize('proj', 'job', 'nothing')
+    >>> _ = pool.write('proj', 'job', 'e', b'qr')
+    >>> pool.job_stages('proj', 'job')
+    ['a', 'b', 'd', 'e']
+
+    A writer that fails to close when it's evicted stays in the pool, with
+    its data, and the write that evicted it fails
+
+    >>> small_pool = StageWriterPool(tmp_dir, max_handles=1)
+    >>> _ = tmp_dir.join('proj', 'job', 'g').ensure(dir=True)
+    >>> _ = small_pool.write('proj', 'job', 'g', b'uv')
+    >>> try:
+    ...     small_pool.write('proj', 'job', 'h', b'wx')
+    ... except OSError:
+    ...     print('failed')
+    failed
+    >>> small_pool.writer('proj', 'job', 'g').buffered
+    2
+    >>> ('proj', 'job', 'h') in small_pool
+    False
+    >>> small_pool.discard_unacked()
+    2
+    >>> small_pool.close_all()
+
+    Stages that have been compacted are restored, then appended to
+
+    >>> from .compact import compact_log
+    >>> _ = pool.write('proj', 'job', 'f', b'st')
+    >>> _ = pool.finalize('proj', 'job', 'f')
+    >>> compact_log(tmp_dir.join('proj', 'job', 'f')).basename
+    'f.zlog'
+    >>> _ = pool.write('proj', 'job', 'f', b'uv')
+    >>> pool.commit()
+    >>> tmp_dir.join('proj', 'job', 'f').read_binary()
+    b'stuv'
+    >>> tmp_dir.join('proj', 'job', 'f.zlog').check()
+    False
+
+    >>> StageWriterPool(tmp_dir, durability='sometimes')
+    Traceback (most recent call last):
+      ...
+    ValueError: Unknown durability policy: 'sometimes'
+    """
+    def __init__(self, root,  # pylint:disable=too-many-arguments
+                 max_handles=64, buffer_size=64 * 1024, buffer_age=0.5,
+                 durability=DURABILITY_FLUSH, notifier=None):
+        if durability not in DURABILITY_CHOICES:
+            raise ValueError("Unknown durability policy: %r" % durability)
+
+        self.root = root
+        self.max_handles = max_handles
+        self.buffer_size = buffer_size
+        self.buffer_age = buffer_age
+        self.durability = durability
+        self.notifier = notifier
+        self._writers = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._writers)
+
+    def __contains__(self, key):
+        return key in self._writers
+
+    def writer(self, project_slug, job_slug, stage_slug):
+        """ Get the writer for a stage, opening it if necessary """
+        key = (project_slug, job_slug, stage_slug)
+        try:
+            self._writers.move_to_end(key)
+            return self._writers[key]
+        except KeyError:
+            pass
+
+        while len(self._writers) >= self.max_handles:
+            self._close_key(next(iter(self._writers)))
+
+        writer = StageWriter(
+            self.root.join(project_slug, job_slug, stage_slug),
+            key=key,
+            on_flush=self._on_flush,
+        )
+        self._writers[key] = writer
+        return writer
+
+    def _on_flush(self, writer, data):
+        """ Publish an append event for data written out by a writer """
+        if self.notifier is None:
+            return
+
+        project_slug, job_slug, stage_slug = writer.key
+        self.notifier.publish({
+            'event': 'append',
+            'project': project_slug,
+            'job': job_slug,
+            'stage': stage_slug,
+            'offset': writer.index.size - len(data),
+            'size': writer.index.size,
+            'lines': writer.index.lines,
+            'mtime': time.time(),
+        }, data[-MAX_PAYLOAD:])
+
+    def job_stages(self, project_slug, job_slug):
+        """ Slugs of the stages of a job that have been written to, and
+        haven't been archived """
+        stages = set(
+            key[2] for key in self._writers
+            if key[:2] == (project_slug, job_slug)
+        )
+        try:
+            stages.update(
+                log_path.basename
+                for log_path in self.root.join(project_slug, job_slug).listdir(
+                    lambda path: (path.check(file=True) and
+                                  not path.basename.startswith('.') and
+                                  not is_archive(path)),
+                )
+            )
+        except py.error.ENOENT:
+            pass
+        return sorted(stages)
+
+    def finalize(self, project_slug, job_slug, stage_slug):
+        """
+        Flush, and close a finished stage, then record that it's complete.
+        Returns the final marker, or ``None`` if the stage has no log
+        """
+        key = (project_slug, job_slug, stage_slug)
+        if key in self._writers:
+            self._close_key(key)
+
+        log_path = self.root.join(project_slug, job_slug, stage_slug)
+        if not log_path.check(file=True):
+            return None
+
+        final = finalize_log(log_path)
+        if self.notifier is not None:
+            self.notifier.publish({
+                'event': 'finalize',
+                'project': project_slug,
+                'job': job_slug,
+                'stage': stage_slug,
+                'size': final['size'],
+                'lines': final['lines'],
+                'mtime': log_path.mtime(),
+            })
+        return final
+
+    def write(self, project_slug, job_slug, stage_slug, data):
+        """ Append data to a stage. Returns whether its buffer is full, so
+        should be committed """
+        writer = self.writer(project_slug, job_slug, stage_slug)
+        writer.write(data)
+        return writer.buffered >= self.buffer_size
+
+    def flush_due(self, now=None):
+        """ Write out data acknowledged while buffered, in writers that have
+        held data longer than buffer_age """
+        if now is None:
+            now = time.monotonic()
+        for writer in self._writers.values():
+            if (
+                writer.buffered_since is not None and
+                now - writer.buffered_since >= self.buffer_age
+            ):
+                writer.flush(acked_only=True)
+
+    def commit(self):
+        """ Apply the durability policy to all stages written since the last
+        commit. Data left buffered is marked acknowledged """
+        for writer in self._writers.values():
+            if not writer.dirty:
+                continue
+            if self.durability == DURABILITY_FSYNC:
+                writer.sync()
+            elif (
+                self.durability == DURABILITY_FLUSH or
+                writer.buffered >= self.buffer_size
+            ):
+                writer.flush()
+            writer.buffer.ack()
+            writer.buffer.dirty = False
+
+    def _close_key(self, key):
+        """ Close the writer for a stage, honoring the fsync policy if it's
+        dirty. It's only removed from the pool once it has closed cleanly,
+        so that if it fails, its data is still buffered for a retry """
+        writer = self._writers[key]
+        if self.durability == DURABILITY_FSYNC and writer.dirty:
+            writer.sync()
+        writer.close()
+        del self._writers[key]
+
+    def discard_unacked(self):
+        """ Drop buffered data that hasn't been acknowledged, because the
+        connection it was delivered on is gone. Returns the number of bytes
+        dropped """
+        return sum(
+            writer.buffer.discard_unacked()
+            for writer in self._writers.values()
+        )
+
+    def close_all(self):
+        """ Flush, and close all writers in the pool """
+        while self._writers:
+            self._close_key(next(iter(self._writers)))
+
+
+class WriterQueue(object):
+    """
+    Runs calls on a ``StageWriterPool`` one at a time, in the order they're
+    queued, so that the pool is never used by two threads at once. With a
+    ``run_sync`` hook, calls run away from the event loop, in batches of
+    everything queued while the last batch ran. The hook is called with a
+    function to run, and a callback to call on the event loop afterwards,
+    with the exception it raised, or ``None``. Without one, calls run
+    straight away.
+
+    Each call's ``callback`` is called on the event loop, in order, with its
+    result, and the exception it raised, or ``None``. A batch stops at the
+    first call that raises, and the rest of it runs after the callbacks, so
+    that they can deal with the failure first
+
+    Examples:
+
+    >>> def show(result, error):
+    ...     print(result, error and type(error).__name__)
+    >>> queue = WriterQueue()
+    >>> queue.call(lambda: 1, show)
+    1 None
+    >>> queue.call(lambda: {}['a'], show)
+    None KeyError
+
+    >>> batches = []
+    >>> queue = WriterQueue(lambda *args: batches.append(args))
+    >>> queue.call(lambda: 1, show)
+    >>> queue.call(lambda: {}['a'], show)
+    >>> queue.call(lambda: 3, show)
+    >>> len(batches), queue.idle
+    (1, False)
+    >>> func, callback = batches.pop()
+    >>> func(); callback(None)
+    1 None
+    >>> func, callback = batches.pop()
+    >>> func(); callback(None)
+    None KeyError
+    >>> func, callback = batches.pop()
+    >>> func(); callback(None)
+    3 None
+    >>> queue.idle
+    True
+    """
+    def __init__(self, run_sync=None):
+        self.run_sync = run_sync
+        self._queued = collections.deque()
+        self._running = False
+
+    @property
+    def idle(self):
+        """ Whether no calls are queued, or running """
+        return not self._running and not self._queued
+
+    def call(self, func, callback=None):
+        """ Queue a call of ``func``, then ``callback`` with its outcome """
+        self._queued.append((func, callback))
+        if not self._running:
+            self._next()
+
+    def _next(self):
+        """ Run everything queued """
+        calls = list(self._queued)
+        self._queued.clear()
+        outcomes = []
+        self._running = True
+        if self.run_sync is None:
+            self._run(calls, outcomes)
+            self._done(calls, outcomes, None)
+        else:
+            self.run_sync(
+                functools.partial(self._run, calls, outcomes),
+                functools.partial(self._done, calls, outcomes),
+            )
+
+    @staticmethod
+    def _run(calls, outcomes):
+        """ Make calls until one raises, adding ``(result, exception)`` to
+        ``outcomes`` for each """
+        for func, _ in calls:
+            try:
+                outcomes.append((func(), None))
+            except Exception as ex:  # pylint:disable=broad-except
+                outcomes.append((None, ex))
+                return
+
+    def _done(self, calls, outcomes, error):
+        """ Call the callbacks of a batch, then run what's queued. Calls
+        that didn't run are queued again, unless the batch couldn't be run
+        at all, in which case they get its exception """
+        rest = calls[len(outcomes):]
+        if error is None:
+            self._queued.extendleft(reversed(rest))
+        else:
+            outcomes.extend((None, error) for _ in rest)
+
+        try:
+            for (_, callback), (result, call_error) in zip(calls, outcomes):
+                if callback is not None:
+                    callback(result, call_error)
+        finally:
+            self._running = False
+        if self._queued:
+            self._next()
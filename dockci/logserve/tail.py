@@ -0,0 +1,185 @@
+""" In memory cache of the most recently written data in each stage log """
+import collections
+
+from .notify import stage_key
+from .scan import find_nth, rfind_nth
+
+
+class StageTail(object):
+    """
+    Window of a stage log, from offset ``start`` to the end of the data that
+    has been written to it
+
+    Examples:
+
+    >>> tail = StageTail(10, b'abc\\ndef\\nghi')
+    >>> tail.end
+    21
+
+    >>> tail.log_range(-3, None, None, None)
+    (18, 21)
+    >>> tail.log_range(-30, None, None, None)
+    >>> tail.log_range(None, -2, None, 2)
+    (14, 21)
+    >>> tail.log_range(None, -3, None, None)
+    >>> tail.log_range(-7, None, None, 1)
+    (14, 18)
+    >>> tail.read(14, 18)
+    b'def\\n'
+
+    >>> StageTail(0, b'abc\\ndef').log_range(None, -20, 2, None)
+    (0, 2)
+    """
+    def __init__(self, start, data):
+        self.start = start
+        self.data = bytearray(data)
+
+    @property
+    def end(self):
+        """ Offset of the end of the data """
+        return self.start + len(self.data)
+
+    def _seek(self, byte_seek, line_seek):
+        """ Relative offset of a negative seek, or ``None`` if it falls
+        outside of the window """
+        if line_seek is not None and line_seek < 0:
+            found = self.data.count(b'\n')
+            if found >= -line_seek:
+                return rfind_nth(self.data, b'\n', -line_seek) + 1
+            return 0 if self.start == 0 else None
+
+        if byte_seek is not None and byte_seek < 0:
+            if -byte_seek <= len(self.data):
+                return len(self.data) + byte_seek
+
+        return None
+
+    def log_range(self, byte_seek, line_seek, bytes_count, lines_count):
+        """
+        Resolve seek and count params to a ``(start, end)`` byte range, like
+        ``logs.log_range``. Returns ``None`` unless the range is a negative
+        seek from the end that's inside the window
+        """
+        rel_start = self._seek(byte_seek, line_seek)
+        if rel_start is None:
+            return None
+
+        rel_end = len(self.data)
+        if bytes_count is not None:
+            rel_end = min(rel_start + max(bytes_count, 0), rel_end)
+        elif lines_count is not None:
+            rest = self.data[rel_start:]
+            if lines_count <= 0:
+                rel_end = rel_start
+            elif rest.count(b'\n') >= lines_count:
+                rel_end = rel_start + find_nth(rest, b'\n', lines_count) + 1
+
+        return self.start + rel_start, self.start + rel_end
+
+    def read(self, start, end):
+        """ Data between the given offsets, which must be in the window """
+        return bytes(self.data[start - self.start:end - self.start])
+
+
+class TailCache(object):
+    """
+    LRU cache of the last ``stage_size`` bytes of recently written stages.
+    When the windows add up to more than ``max_size`` bytes, the least
+    recently used are dropped.
+
+    It's fed by ``append`` events from a ``Listener``, which carry the end of
+    the data written as their payload. An event without data that the cache
+    can use drops the stage's window, since the cache can't follow it. A
+    window is only returned for a log that's the size the cache expects, so
+    stale windows are never used
+
+    Examples:
+
+    >>> cache = TailCache(stage_size=4, max_size=6)
+    >>> cache.append('a', 3, b'abc')
+    >>> cache.append('a', 6, b'def')
+    >>> cache.get('a', 6).data
+    bytearray(b'cdef')
+    >>> cache.get('a', 7)
+
+    Out of order data replaces the window
+
+    >>> cache.append('a', 9, b'i')
+    >>> cache.get('a', 9).start
+    8
+
+    >>> cache.append('b', 4, b'abcd')
+    >>> cache.append('c', 4, b'abcd')
+    >>> cache.get('a', 9), cache.get('b', 4)
+    (None, None)
+    >>> cache.size
+    4
+
+    >>> cache.on_event({
+    ...     'event': 'append', 'project': 'p', 'job': 'j', 'stage': 's',
+    ...     'size': 3,
+    ... }, b'abc')
+    >>> cache.get(('p', 'j', 's'), 3).data
+    bytearray(b'abc')
+    >>> cache.on_event({
+    ...     'event': 'append', 'project': 'p', 'job': 'j', 'stage': 's',
+    ...     'size': 9,
+    ... }, b'')
+    >>> len(cache)
+    0
+    """
+    def __init__(self, stage_size=64 * 1024, max_size=64 * 1024 * 1024):
+        self.stage_size = stage_size
+        self.max_size = max_size
+        self.size = 0
+        self._tails = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._tails)
+
+    def append(self, key, size, data):
+        """ Add ``data``, ending at offset ``size``, to a stage's window """
+        start = size - len(data)
+        tail = self._tails.pop(key, None)
+        if tail is not None:
+            self.size -= len(tail.data)
+            if tail.end == start:
+                tail.data.extend(data)
+            else:
+                tail = None
+        if tail is None:
+            tail = StageTail(start, data)
+
+        excess = len(tail.data) - self.stage_size
+        if excess > 0:
+            del tail.data[:excess]
+            tail.start += excess
+
+        self._tails[key] = tail
+        self.size += len(tail.data)
+        while self.size > self.max_size:
+            _, evicted = self._tails.popitem(last=False)
+            self.size -= len(evicted.data)
+
+    def discard(self, key):
+        """ Drop a stage's window """
+        tail = self._tails.pop(key, None)
+        if tail is not None:
+            self.size -= len(tail.data)
+
+    def get(self, key, size):
+        """ The window for a stage, if its end matches the log ``size`` """
+        tail = self._tails.get(key)
+        if tail is None or tail.end != size:
+            return None
+        self._tails.move_to_end(key)
+        return tail
+
+    def on_event(self, event, payload):
+        """ ``Listener`` callback to keep windows up to date """
+        if event.get('event') != 'append':
+            return
+        if payload:
+            self.append(stage_key(event), event['size'], payload)
+        else:
+            self.discard(stage_key(event))
@@ -1,5 +1,6 @@
 """ Shared utilities for DockCI log server consumer, and API """
 import logging
+import os
 import signal
 import sys
 
@@ -23,9 +24,15 @@ def run_wrapper(name):
             """ Do run setup, and call the function """
             logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
             logger = logging.getLogger(name)
+            stopping = []
 
             def handle_signal(*_):
-                """ Handle stop signals by calling handlers and exiting """
+                """ Handle stop signals by calling handlers and exiting.
+                Signals while stopping are ignored, so that a stop isn't cut
+                short when a whole process group is signalled """
+                if stopping:
+                    return
+                stopping.append(True)
                 logger.info("Shutting down")
                 for handler in stop_handlers:
                     handler()
@@ -42,3 +49,43 @@ def run_wrapper(name):
 
         return inner
     return outer
+
+
+def env_int(name, default):
+    """
+    Get an ``int`` from the environment variable ``name``, or ``default`` if
+    it's not set
+
+    Examples:
+
+    >>> monkeypatch = getfixture('monkeypatch')
+    >>> monkeypatch.setenv('LOGSERVE_TEST_VALUE', '12')
+    >>> env_int('LOGSERVE_TEST_VALUE', 5)
+    12
+
+    >>> monkeypatch.delenv('LOGSERVE_TEST_VALUE')
+    >>> env_int('LOGSERVE_TEST_VALUE', 5)
+    5
+    """
+    value = os.environ.get(name, '')
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    """
+    Get a ``float`` from the environment variable ``name``, or ``default`` if
+    it's not set
+
+    Examples:
+
+    >>> monkeypatch = getfixture('monkeypatch')
+    >>> monkeypatch.setenv('LOGSERVE_TEST_VALUE', '0.25')
+    >>> env_float('LOGSERVE_TEST_VALUE', 5)
+    0.25
+
+    >>> monkeypatch.delenv('LOGSERVE_TEST_VALUE')
+    >>> env_float('LOGSERVE_TEST_VALUE', 5)
+    5
+    """
+    value = os.environ.get(name, '')
+    return float(value) if value else default
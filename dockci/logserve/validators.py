@@ -0,0 +1,148 @@
+""" Cache validators, and byte ranges of log responses """
+import calendar
+import email.utils
+import math
+
+
+# Finalized logs never change again
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def entity_tag(stat, encoding=None, weak=False):
+    """
+    Entity tag for a log. Logs are only ever appended to, so their size, and
+    modification time identify their content. Encoded responses have their
+    own tags. Responses encoded as they're streamed aren't byte for byte
+    the same each time, so their tags must be ``weak``
+
+    Examples:
+
+    >>> class Stat(object):
+    ...     size = 255
+    ...     mtime_ns = 1466000000123456789
+    >>> entity_tag(Stat())
+    '"ff-1458473ba014cd15"'
+    >>> entity_tag(Stat(), 'gzip')
+    '"ff-1458473ba014cd15-gzip"'
+    >>> entity_tag(Stat(), 'gzip', weak=True)
+    'W/"ff-1458473ba014cd15-gzip"'
+    """
+    if encoding is None:
+        etag = '"%x-%x"' % (stat.size, stat.mtime_ns)
+    else:
+        etag = '"%x-%x-%s"' % (stat.size, stat.mtime_ns, encoding)
+    return 'W/' + etag if weak else etag
+
+
+def set_validators(response, etag, mtime, final=False):
+    """ Add cache validators for a log to a response. Logs that are still
+    being written change, so caches must revalidate them; ``final`` logs
+    can be cached forever """
+    response.headers['etag'] = etag
+    response.headers['cache-control'] = (
+        IMMUTABLE_CACHE_CONTROL if final else 'no-cache'
+    )
+    response.last_modified = mtime
+
+
+def _opaque_tag(etag):
+    """
+    Entity tag without its weakness indicator, for weak comparison
+
+    Examples:
+
+    >>> _opaque_tag('W/"ff-gzip"')
+    '"ff-gzip"'
+    >>> _opaque_tag('"ff"')
+    '"ff"'
+    """
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(request, etag, mtime):
+    """ Whether conditional request headers match the log. Entity tags are
+    compared weakly """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return any(
+            tag.strip() == '*' or
+            _opaque_tag(tag.strip()) == _opaque_tag(etag)
+            for tag in if_none_match.split(',')
+        )
+
+    modified_since = request.if_modified_since
+    return modified_since is not None and mtime <= modified_since.timestamp()
+
+
+def if_range(request, etag, mtime):
+    """ Whether the ``If-Range`` header, if any, allows a range response.
+    Entity tags are compared strongly, so weak tags never match """
+    value = request.headers.get('If-Range')
+    if value is None:
+        return True
+    if value.startswith(('"', 'W/')):
+        return not etag.startswith('W/') and value == etag
+
+    modified = email.utils.parsedate(value)
+    return (
+        modified is not None and
+        calendar.timegm(modified) == math.ceil(mtime)
+    )
+
+
+def byte_range(value, size):
+    """
+    ``(start, end)`` offsets for a ``Range`` header of a log that's ``size``
+    bytes long, or ``None`` if the header should be ignored. Only a single
+    byte range is supported. Raises ``ValueError`` if the range is past the
+    end of the log
+
+    Examples:
+
+    >>> byte_range('bytes=0-3', 10)
+    (0, 4)
+    >>> byte_range('bytes=5-', 10)
+    (5, 10)
+    >>> byte_range('bytes=8-30', 10)
+    (8, 10)
+    >>> byte_range('bytes=-3', 10)
+    (7, 10)
+    >>> byte_range('bytes=-30', 10)
+    (0, 10)
+
+    >>> byte_range('bytes=0-1,4-5', 10)
+    >>> byte_range('lines=0-1', 10)
+    >>> byte_range('bytes=3-1', 10)
+    >>> byte_range('bytes=-', 10)
+
+    >>> byte_range('bytes=10-', 10)
+    Traceback (most recent call last):
+      ...
+    ValueError: Range not satisfiable
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if (
+        not sep or not (first or last) or
+        not (first.isdigit() or not first) or
+        not (last.isdigit() or not last)
+    ):
+        return None
+
+    if first:
+        start = int(first)
+        end = size
+        if last:
+            if int(last) < start:
+                return None
+            end = min(int(last) + 1, size)
+    else:
+        start = max(size - int(last), 0)
+        end = size if int(last) else start
+
+    if start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
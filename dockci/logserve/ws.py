@@ -0,0 +1,374 @@
+""" Multiplexed WebSocket streaming of stage logs """
+import asyncio
+import collections
+import json
+import struct
+
+from aiohttp import web
+
+from .aiofile import run_io
+from .api import check_slug, instrumented, json_int, json_ranges
+from .archive import open_log
+from .flow import ChunkSizer, ResponseFlow
+from .follow import follow_log, StageBroadcaster
+from .logs import log_range, resolve_log, stream_file, READ_CHUNK_SIZE
+
+
+# Stream id, and log offset at the start of each WebSocket data frame
+WS_FRAME_HEADER = struct.Struct('>IQ')
+
+
+class CreditWindow(object):
+    """
+    Bytes that a client has let a stream send, and the data held until it
+    lets more be sent
+
+    Examples:
+
+    >>> loop = asyncio.new_event_loop()
+    >>> window = CreditWindow(4, loop)
+    >>> window.hold(b'abcdef')
+    >>> window.take(), window.take()
+    (b'abcd', None)
+    >>> window.grant(5)
+    >>> window.take(), window.credit, window.pending
+    (b'ef', 3, 0)
+    >>> loop.close()
+    """
+    def __init__(self, credit, loop):
+        self.credit = credit
+        self.pending = 0
+        self._chunks = collections.deque()
+        self._granted = asyncio.Event(loop=loop)
+
+    def hold(self, data):
+        """ Hold data until it can be sent """
+        self._chunks.append(data)
+        self.pending += len(data)
+
+    def take(self):
+        """ Next held data that the credit allows to be sent, or ``None`` """
+        if not self._chunks or self.credit <= 0:
+            return None
+
+        data = self._chunks.popleft()
+        if len(data) > self.credit:
+            self._chunks.appendleft(data[self.credit:])
+            data = data[:self.credit]
+        self.credit -= len(data)
+        self.pending -= len(data)
+        return data
+
+    def grant(self, credit):
+        """ Let ``credit`` more bytes be sent """
+        self.credit += credit
+        self._granted.set()
+
+    @asyncio.coroutine
+    def wait(self):
+        """ Wait until the client grants more credit """
+        self._granted.clear()
+        yield from self._granted.wait()
+
+
+class WebSocketStream(object):
+    """
+    One stage log streamed over a multiplexed WebSocket. It stands in for
+    the response when the log is sent, so logs are streamed the same way as
+    for ``log_init``. Data is sent in binary frames that start with
+    ``WS_FRAME_HEADER``: the stream id, and the offset of the data in the
+    log.
+
+    The client grants each stream credit in bytes. Data past the credit is
+    held in the stream's ``CreditWindow``, and ``drain`` waits until the
+    client grants more, so a slow stream doesn't hold back the others, and
+    no more than the credit is ever buffered
+
+    Examples:
+
+    >>> class WebSocket(object):
+    ...     closed = False
+    ...     def send_bytes(self, data):
+    ...         size = WS_FRAME_HEADER.size
+    ...         print(WS_FRAME_HEADER.unpack(data[:size]), data[size:])
+    >>> loop = asyncio.new_event_loop()
+    >>> stream = WebSocketStream(WebSocket(), 7, 4, loop)
+    >>> stream.offset = 10
+    >>> stream.write(b'abcdef')
+    (7, 10) b'abcd'
+    >>> stream.window.pending
+    2
+    >>> stream.add_credit(5)
+    (7, 14) b'ef'
+    >>> stream.window.credit, stream.window.pending, stream.offset
+    (3, 0, 16)
+    >>> loop.run_until_complete(stream.drain())
+    >>> loop.close()
+    """
+    def __init__(self, ws, stream_id, credit, loop):
+        self.ws = ws
+        self.stream_id = stream_id
+        self.offset = 0
+        self.task = None
+        self.window = CreditWindow(credit, loop)
+
+    @asyncio.coroutine
+    def prepare(self, _):
+        """ Nothing to prepare, since the WebSocket is already open """
+        return self
+
+    def write(self, data):
+        """ Send data, or hold it until there's credit """
+        self.window.hold(data)
+        self._send_pending()
+
+    def _send_pending(self):
+        """ Send as much held data as the credit allows """
+        while not self.ws.closed:
+            data = self.window.take()
+            if data is None:
+                return
+
+            self.ws.send_bytes(
+                WS_FRAME_HEADER.pack(self.stream_id, self.offset) + data
+            )
+            self.offset += len(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        """ Wait until all data written has been sent """
+        while self.window.pending and not self.ws.closed:
+            yield from self.window.wait()
+            self._send_pending()
+
+    def add_credit(self, credit):
+        """ Let the client receive ``credit`` more bytes """
+        self.window.grant(credit)
+        self._send_pending()
+
+    def send_json(self, message):
+        """ Send a control message about this stream """
+        if not self.ws.closed:
+            message = dict(message, id=self.stream_id)
+            self.ws.send_str(json.dumps(message, sort_keys=True))
+
+
+def _subscribe_params(command):
+    """
+    Stage key, ``(seek, seek_lines, count, count_lines)``, follow flag, and
+    initial credit of a WebSocket ``subscribe`` command. Raises
+    ``ValueError`` if the command is invalid
+
+    Examples:
+
+    >>> _subscribe_params({
+    ...     'project': 'p', 'job': 'j', 'stage': 's',
+    ...     'seek_lines': -10, 'follow': True,
+    ... })
+    (('p', 'j', 's'), (None, -10, None, None), True, None)
+
+    >>> _subscribe_params({'project': 'p', 'job': 'j', 'stage': '../s'})
+    Traceback (most recent call last):
+      ...
+    ValueError: stage must be a slug
+    >>> _subscribe_params({
+    ...     'project': 'p', 'job': 'j', 'stage': 's',
+    ...     'count': 1, 'count_lines': 1,
+    ... })
+    Traceback (most recent call last):
+      ...
+    ValueError: bytes_count and lines_count are mutually exclusive
+    """
+    key = tuple(
+        check_slug(name, command.get(name))
+        for name in ('project', 'job', 'stage')
+    )
+    return (
+        key, json_ranges(command), bool(command.get('follow')),
+        json_int(command, 'credit', minimum=1),
+    )
+
+
+@asyncio.coroutine
+def _find_range(request, key,  # pylint:disable=too-many-arguments
+                log_path, size,
+                byte_seek, line_seek, bytes_count, lines_count):
+    """ Resolve seek and count params for a stage to a ``(start, end)``
+    byte range, from the tail cache if the range is in it """
+    if (byte_seek or 0) < 0 or (line_seek or 0) < 0:
+        tail = request.app.tail_cache.get(key, size)
+        if tail is not None:
+            cached = tail.log_range(
+                byte_seek, line_seek, bytes_count, lines_count,
+            )
+            if cached is not None:
+                return cached
+
+    handle = yield from run_io(request, open_log, log_path)
+    try:
+        return (yield from run_io(
+            request, log_range, log_path, handle,
+            byte_seek, line_seek, bytes_count, lines_count,
+        ))
+
+    finally:
+        yield from run_io(request, handle.close)
+
+
+@asyncio.coroutine
+def _send_stream(request, stream, key, ranges, follow):
+    """ Send a stage log on a WebSocket stream, then tell the client that
+    the stream ended """
+    found = yield from resolve_log(request, key)
+    if found is None:
+        stream.send_json({
+            'type': 'error', 'status': 404, 'message': 'Stage not found',
+        })
+        return
+    log_path, stat, final = found
+
+    subscription = None
+    if follow and final is None and ranges[2] is None and ranges[3] is None:
+        # Subscribe before the range is resolved, so no appends are missed
+        broadcaster = StageBroadcaster.for_stage(request.app, key, log_path)
+        subscription = broadcaster.subscribe()
+
+    # Streams have their own flow control, with the credit their client
+    # grants them
+    flow = ResponseFlow(
+        request.app.loop, ChunkSizer(READ_CHUNK_SIZE, READ_CHUNK_SIZE),
+    )
+    try:
+        start, end = yield from _find_range(
+            request, key, log_path, stat.size, *ranges
+        )
+        stream.offset = start
+        yield from stream_file(request, stream, flow, log_path, start, end)
+        if subscription is not None:
+            yield from follow_log(
+                request, stream, flow, log_path, subscription, end,
+            )
+        yield from stream.drain()
+
+    except (OSError, ValueError):
+        request.app.logger.exception('Failed to stream %s', log_path)
+        stream.send_json({
+            'type': 'error', 'status': 500, 'message': 'Failed to read log',
+        })
+        return
+
+    finally:
+        if subscription is not None:
+            subscription.broadcaster.unsubscribe(subscription)
+
+    stream.send_json({'type': 'end', 'offset': stream.offset})
+
+
+def _send_error(ws, stream_id, status, message):
+    """ Send an error for a WebSocket command """
+    if not ws.closed:
+        ws.send_str(json.dumps({
+            'type': 'error', 'id': stream_id,
+            'status': status, 'message': message,
+        }, sort_keys=True))
+
+
+def _handle_command(request, ws, streams, data):
+    """ Handle a JSON command from a log WebSocket client """
+    try:
+        command = json.loads(data)
+        kind = command['type']
+        stream_id = json_int(command, 'id', minimum=0, maximum=2 ** 32 - 1)
+    except (ValueError, KeyError, TypeError) as ex:
+        _send_error(ws, None, 400, "Invalid command: %s" % ex)
+        return
+    if stream_id is None:
+        _send_error(ws, None, 400, "Invalid command: id is required")
+        return
+
+    stream = streams.get(stream_id)
+    if kind == 'subscribe':
+        try:
+            key, ranges, follow, credit = _subscribe_params(command)
+        except ValueError as ex:
+            _send_error(ws, stream_id, 400, str(ex))
+            return
+        if stream is not None:
+            _send_error(ws, stream_id, 409, "Stream id is in use")
+            return
+        if len(streams) >= request.app.ws_max_streams:
+            _send_error(ws, stream_id, 429, "Too many streams")
+            return
+
+        stream = streams[stream_id] = WebSocketStream(
+            ws, stream_id, credit or request.app.ws_credit, request.app.loop,
+        )
+        stream.task = request.app.loop.create_task(
+            _send_stream(request, stream, key, ranges, follow),
+        )
+        stream.task.add_done_callback(
+            lambda _: streams.get(stream_id) is stream and streams.pop(
+                stream_id
+            )
+        )
+
+    elif kind == 'credit':
+        try:
+            credit = json_int(command, 'bytes', minimum=1)
+        except ValueError as ex:
+            _send_error(ws, stream_id, 400, str(ex))
+            return
+        # Credit for a stream that just ended is ignored
+        if stream is not None and credit is not None:
+            stream.add_credit(credit)
+
+    elif kind == 'unsubscribe':
+        if stream is not None:
+            del streams[stream_id]
+            stream.task.cancel()
+
+    else:
+        _send_error(ws, stream_id, 400, "Unknown command type")
+
+
+@instrumented('log_ws')
+@asyncio.coroutine
+def handle_log_ws(request):
+    """
+    Stream any number of stage logs over one WebSocket. The client sends
+    JSON text commands, each with a stream ``id`` it chooses:
+
+    - ``subscribe`` starts streaming the log of the ``project``, ``job``,
+      and ``stage``. It takes the ``seek``, ``seek_lines``, ``count``,
+      ``count_lines``, and ``follow`` params of ``log_init``, and an
+      initial ``credit`` in bytes
+    - ``credit`` lets ``bytes`` more of the stream be sent
+    - ``unsubscribe`` stops the stream
+
+    Log data is sent in binary frames (see ``WebSocketStream``). Once a
+    stream has been sent, an ``end`` text message gives the offset it ended
+    at. Commands that fail get an ``error``
+    text message, with an HTTP status
+    """
+    ws = web.WebSocketResponse()
+    yield from ws.prepare(request)
+
+    streams = {}
+    try:
+        while True:
+            msg = yield from ws.receive()
+            if msg.tp == web.MsgType.text:
+                _handle_command(request, ws, streams, msg.data)
+            elif msg.tp == web.MsgType.binary:
+                _send_error(ws, None, 400, "Commands must be text")
+            else:
+                break
+
+    finally:
+        tasks = [stream.task for stream in streams.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            yield from asyncio.wait(tasks, loop=request.app.loop)
+
+    return ws
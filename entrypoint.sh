@@ -36,8 +36,21 @@ function run-http {
 function run-consumer {
   _run consumer
 }
+function run-all {
+  _run combined
+}
+function run-compactor {
+  _run compact
+}
+function rebuild-index {
+  _run index
+}
+function benchmark {
+  python -m "benchmarks.$1" "${@:2}"
+}
 
 case "$1" in
-  styletest|doctest|ci|run-http|run-consumer) "$1" ;;
+  styletest|doctest|ci|run-http|run-consumer|run-all|run-compactor|rebuild-index) "$1" ;;
+  benchmark) "$@" ;;
   *) "$@" ;;
 esac